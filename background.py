@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# backgrounds of warped images: only the border which the warp leaves uncovered is filled,
+# the rest is left to cv2.warpAffine(borderMode=cv2.BORDER_TRANSPARENT).
+# noise: tiles of uniform noise, made once per process from tile_seed. each block of tile_size of an image
+# takes a tile and an offset from np.random, so that the same seed of the image gives the same background.
+#   back = background.zeros(hw, image)
+#   background.noise(back, background.uncovered(M, image.shape[:2], hw))
+#   cv2.warpAffine(image, M, hw[::-1], back, borderMode=cv2.BORDER_TRANSPARENT)
+
+import math
+import numpy as np
+
+# pixels of a side of a tile
+tile_size = 64
+# tiles in the pool
+tiles = 16
+tile_seed = 0
+# pixels of the edge of the warped image filled too: the warp may leave them, or blend them with dst,
+# where the interpolation needs pixels outside of the image. 4 for cv2.INTER_LANCZOS4 is not enough:
+# cv2.warpAffine() with cv2.BORDER_TRANSPARENT blends pixels of dst a few pixels away in the row.
+margin = 8
+
+# channels -> tiles of ( tiles, tile_size, tile_size, channels )
+_pools = {}
+
+def _pool(c):
+    pool = _pools.get(c)
+    if pool is None:
+        pool = _pools[c] = np.random.RandomState(tile_seed).randint(0, 256, (tiles, tile_size, tile_size, c), np.uint8)
+    return pool
+
+# -> image of hw of the channels of the image. zeros rather than np.empty(), whatever the warp may read.
+# the pages of zeros are not written until the warp or the fill touches them.
+def zeros(hw, image):
+    return np.zeros(tuple(hw[:2]) + image.shape[2:], image.dtype)
+
+# x of the edges of the convex polygon at each y -> min, max. inf, -inf where not on it.
+def _span(corners, y):
+    l = np.full(len(y), np.inf)
+    r = np.full(len(y), -np.inf)
+    for ( px, py ), ( qx, qy ) in zip(corners, np.roll(corners, -1, axis=0)):
+        if py == qy:
+            continue
+        on = ( min(py, qy) <= y ) & ( y <= max(py, qy) )
+        x = px + (y - py) * (qx - px) / (qy - py)
+        l = np.where(on, np.minimum(l, x), l)
+        r = np.where(on, np.maximum(r, x), r)
+    return l, r
+
+# M: 2x3 from the image of src_hw to the image of hw.
+# -> ( left, right ) per row of the image of hw: columns [ left, right ) are written by the warp surely,
+# the rest is the border to be filled.
+def uncovered(M, src_hw, hw):
+    h, w = src_hw
+    corners = np.array(( ( 0, 0, 1 ), ( w-1, 0, 1 ), ( w-1, h-1, 1 ), ( 0, h-1, 1 ), ), dtype=np.float64)
+    corners = corners.dot(np.asarray(M, dtype=np.float64).T)
+    y = np.arange(hw[0], dtype=np.float64)
+    # of the polygon shrunk by margin: covered from margin rows above to margin rows below.
+    l = np.full(hw[0], -np.inf)
+    r = np.full(hw[0], np.inf)
+    for dy in range(-margin, margin + 1):
+        ld, rd = _span(corners, y + dy)
+        l = np.maximum(l, ld)
+        r = np.minimum(r, rd)
+    with np.errstate(invalid='ignore'):
+        left = np.clip(np.ceil(l) + margin, 0, hw[1])
+        right = np.clip(np.floor(r) - margin + 1, 0, hw[1])
+    # not on the polygon: all the row.
+    none = ~( left < right )
+    left[none] = 0
+    right[none] = 0
+    return left.astype(np.intp), right.astype(np.intp)
+
+# fills the border of each row with rows[y]: ( height or 1, width, channels ) rows of the pattern.
+def _fill(back, spans, rows):
+    left, right = spans
+    back = back.reshape(back.shape[:2] + ( -1, ))
+    h, w = back.shape[:2]
+    n = len(rows)
+    for y, ( l, r ) in enumerate(zip(left.tolist(), right.tolist())):
+        row = rows[y % n]
+        if 0 < l:
+            back[y, :l] = row[:l]
+        if r < w:
+            back[y, r:] = row[r:]
+
+# noise of a tile at an offset per block of tile_size, from np.random: not periodic across the image.
+def noise(back, spans):
+    h, w = back.shape[:2]
+    c = back.shape[2] if 2 < back.ndim else 1
+    grid = ( math.ceil(h / tile_size), math.ceil(w / tile_size), )
+    index = np.random.randint(tiles, size=grid)
+    oy, ox = np.random.randint(tile_size, size=( 2, ) + grid)
+    y = np.arange(h)[:, None]
+    x = np.arange(w)[None, :]
+    by, bx = y // tile_size, x // tile_size
+    # ( h, w, c ): rows of the image
+    rows = _pool(c)[index[by, bx], (y + oy[by, bx]) % tile_size, (x + ox[by, bx]) % tile_size]
+    _fill(back, spans, rows)
+
+# value: a value, or per channel.
+def plain(back, spans, value):
+    w = back.shape[1]
+    c = back.shape[2] if 2 < back.ndim else 1
+    row = np.empty(( 1, w, c ), back.dtype)
+    row[:] = value
+    _fill(back, spans, row)
+
+# end of file
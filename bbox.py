@@ -189,4 +189,188 @@ class BBox():
             self.calc_int()
         return cv2.rectangle(np.copy(cv2img), (self.xmin, self.ymin) , (self.xmax, self.ymax), bgr, px)
 
+def _first_bad(ok, *vals):
+    i = np.flatnonzero(~np.asarray(ok))[0]
+    return ', '.join('{}'.format(np.broadcast_to(v, np.shape(ok))[i]) for v in vals)
+
+# N boxes as float64 columns (structure of arrays).
+# same conversions, rounding and range checks as BBox, batched.
+# hw=(h, w): h and w are scalars or arrays of N, so that one array may hold boxes of several images.
+# get() returns an (N, 4) array, bit-identical to stacking BBox.get() of each box.
+class BBoxArray():
+    h_1 = None
+    w_1 = None
+
+    @staticmethod
+    def prefer_small(p, newp, eps):
+        dlt = newp - p
+        return np.maximum(0, np.where((dlt <= 0) | (eps > dlt), newp, newp - 1))
+
+    @staticmethod
+    def prefer_large(p, newp, eps, maxp):
+        dlt = p - newp
+        return np.minimum(maxp, np.where((dlt <= 0) | (eps > dlt), newp, newp + 1))
+
+    def is_absolute(self):
+        return self._type in ( BBox.VOC, BBox.ILSVRC )
+
+    def calc_absolute(self):
+        if not self.is_absolute():
+            self.xmin = self._xmin * self.w_1
+            self.xmax = self._xmax * self.w_1
+            self.ymin = self._ymin * self.h_1
+            self.ymax = self._ymax * self.h_1
+
+        # np.rint rounds half to even as round() does.
+        ixmin, iymin, ixmax, iymax = ( np.rint(self.xmin), np.rint(self.ymin), np.rint(self.xmax), np.rint(self.ymax) )
+        self.xmin = self.prefer_small(self.xmin, ixmin, self.eps)
+        self.ymin = self.prefer_small(self.ymin, iymin, self.eps)
+        self.xmax = self.prefer_large(self.xmax, ixmax, self.eps, self.w_1)
+        self.ymax = self.prefer_large(self.ymax, iymax, self.eps, self.h_1)
+
+        ok = (0 <= self.xmin) & (self.xmin < self.w_1)
+        assert ok.all(), _first_bad(ok, self.xmin, self.w_1)
+        ok = (0 <= self.ymin) & (self.ymin < self.h_1)
+        assert ok.all(), _first_bad(ok, self.ymin, self.h_1)
+        ok = (0 < self.xmax) & (self.xmax <= self.w_1)
+        assert ok.all(), _first_bad(ok, self.xmax, self.w_1)
+        ok = (0 < self.ymax) & (self.ymax <= self.h_1)
+        assert ok.all(), _first_bad(ok, self.ymax, self.h_1)
+        ok = (0 <= self.xmin) & (self.xmin < self.xmax)
+        assert ok.all(), _first_bad(ok, self.xmin, self.xmax)
+        ok = (0 <= self.ymin) & (self.ymin < self.ymax)
+        assert ok.all(), _first_bad(ok, self.ymin, self.ymax)
+
+    def calc_relative(self):
+        self.cx = (self.xmin + self.xmax) / 2.0 / self.w_1
+        self.cy = (self.ymin + self.ymax) / 2.0 / self.h_1
+        self.rw = (self.xmax - self.xmin) / self.w_1
+        self.rh = (self.ymax - self.ymin) / self.h_1
+        self._xmin = self.xmin / self.w_1
+        self._xmax = self.xmax / self.w_1
+        self._ymin = self.ymin / self.h_1
+        self._ymax = self.ymax / self.h_1
+        self._check_relative()
+        ok = (0 <= self._xmin) & (self._xmin < 1)
+        assert ok.all(), _first_bad(ok, self._xmin)
+        ok = (0 <= self._ymin) & (self._ymin < 1)
+        assert ok.all(), _first_bad(ok, self._ymin)
+        ok = (0 < self._xmax) & (self._xmax <= 1)
+        assert ok.all(), _first_bad(ok, self._xmax, self.xmax, self.w_1)
+        ok = (0 < self._ymax) & (self._ymax <= 1)
+        assert ok.all(), _first_bad(ok, self._ymax, self.ymax, self.h_1)
+
+    def _check_relative(self):
+        ok = (0 < self.cx) & (self.cx < 1)
+        assert ok.all(), _first_bad(ok, self.cx)
+        ok = (0 < self.cy) & (self.cy < 1)
+        assert ok.all(), _first_bad(ok, self.cy)
+        ok = (0 < self.rw) & (self.rw <= 1)
+        assert ok.all(), _first_bad(ok, self.rw)
+        ok = (0 < self.rh) & (self.rh <= 1)
+        assert ok.all(), _first_bad(ok, self.rh)
+
+    def __init__(self, *, hw=None, type_, bbox, label=None, eps=10e-2):
+        self._type = type_
+        self._label = None if label is None else np.asarray(label, dtype=np.int32).reshape(-1)
+        self.eps = eps
+        bbox = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)
+        assert self._label is None or len(self._label) == len(bbox), '{}, {}'.format(len(self._label), len(bbox))
+        c0, c1, c2, c3 = bbox.T
+        if self.is_absolute():
+            if type_ == BBox.VOC:
+                self.xmin, self.ymin, self.xmax, self.ymax = (c0-1, c1-1, c2-1, c3-1)
+            else:
+                assert type_ == BBox.ILSVRC
+                self.xmin, self.ymin, self.xmax, self.ymax = (c0, c1, c2, c3)
+            ok = (0 <= self.xmin) & (self.xmin < self.xmax)
+            assert ok.all(), _first_bad(ok, self.xmin, self.xmax)
+            ok = (0 <= self.ymin) & (self.ymin < self.ymax)
+            assert ok.all(), _first_bad(ok, self.ymin, self.ymax)
+        else:
+            if type_ == BBox.OPEN_IMAGES:
+                self._xmin, self._ymin, self._xmax, self._ymax = (c0, c1, c2, c3)
+                self.cx = (self._xmin + self._xmax) / 2.0
+                self.cy = (self._ymin + self._ymax) / 2.0
+                self.rw = self._xmax - self._xmin
+                self.rh = self._ymax - self._ymin
+            else:
+                assert type_ == BBox.YOLO, type_
+                self.cx, self.cy, self.rw, self.rh = (c0, c1, c2, c3)
+                r2 = self.rw / 2.0
+                self._xmin = self.cx - r2
+                self._xmax = self.cx + r2
+                r2 = self.rh / 2.0
+                self._ymin = self.cy - r2
+                self._ymax = self.cy + r2
+            self._check_relative()
+        if hw:
+            self.set_size(hw)
+
+    def set_size(self, hw):
+        assert self.h_1 is None
+        assert self.w_1 is None
+        self.h_1 = np.asarray(hw[0], dtype=np.float64) - 1
+        self.w_1 = np.asarray(hw[1], dtype=np.float64) - 1
+        self.calc_absolute()
+        if self.is_absolute():
+            self.calc_relative()
+
+    def __len__(self):
+        return len(self.cx) if hasattr(self, 'cx') else len(self.xmin)
+
+    def get(self, type_):
+        if type_ == BBox.VOC:
+            return np.stack((1+self.xmin, 1+self.ymin, 1+self.xmax, 1+self.ymax), axis=1)
+        if type_ == BBox.ILSVRC:
+            return np.stack((self.xmin, self.ymin, self.xmax, self.ymax), axis=1)
+        if type_ == BBox.OPEN_IMAGES:
+            return np.stack((self._xmin, self._ymin, self._xmax, self._ymax), axis=1)
+        assert type_ == BBox.YOLO, type_
+        return np.stack((self.cx, self.cy, self.rw, self.rh), axis=1)
+
+    @property
+    def label(self):
+        return self._label
+
+    def h_flip(self):
+        self.cx = 1 - self.cx
+        self._xmin, self._xmax = ( 1 - self._xmax, 1 - self._xmin )
+        if self.w_1 is not None:
+            self.xmin, self.xmax = ( self.w_1 - self.xmax, self.w_1 - self.xmin )
+
+    def v_flip(self):
+        self.cy = 1 - self.cy
+        self._ymin, self._ymax = ( 1 - self._ymax, 1 - self._ymin )
+        if self.h_1 is not None:
+            self.ymin, self.ymax = ( self.h_1 - self.ymax, self.h_1 - self.ymin )
+
+    # x <-> y, exact: of the image transposed.
+    def transpose(self):
+        self.cx, self.cy = ( self.cy, self.cx )
+        self.rw, self.rh = ( self.rh, self.rw )
+        self._xmin, self._ymin = ( self._ymin, self._xmin )
+        self._xmax, self._ymax = ( self._ymax, self._xmax )
+        if self.w_1 is not None:
+            self.xmin, self.ymin = ( self.ymin, self.xmin )
+            self.xmax, self.ymax = ( self.ymax, self.xmax )
+            self.w_1, self.h_1 = ( self.h_1, self.w_1 )
+
+    # the 4 corners of all the boxes by one M.dot(), into the image of wh.
+    def warpAffine(self, M, wh):
+        assert self.w_1 is not None
+        assert self.h_1 is not None
+        n = len(self)
+        corners = np.empty(( 3, n, 4 ))
+        corners[0] = np.stack(( self.xmin, self.xmax, self.xmin, self.xmax ), axis=1)
+        corners[1] = np.stack(( self.ymin, self.ymin, self.ymax, self.ymax ), axis=1)
+        corners[2] = 1
+        n_corners = M.dot(corners.reshape(3, -1)).reshape(2, n, 4)
+        self.xmin, self.ymin = n_corners.min(axis=2)
+        self.xmax, self.ymax = n_corners.max(axis=2)
+        self.w_1 = np.float64(wh[0] - 1)
+        self.h_1 = np.float64(wh[1] - 1)
+        self.calc_relative()
+        self.calc_absolute()
+
 # end of file
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# persistent caches: pickled object, replaced atomically.
+
+import os
+import pickle
+import tempfile
+
+def load(file, default=None):
+    if not file or not os.path.exists(file):
+        return default
+    try:
+        with open(file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        print('Ignoring broken cache: {}: {}'.format(file, e))
+        return default
+
+def save(file, obj):
+    dir_ = os.path.dirname(file)
+    if dir_:
+        os.makedirs(dir_, exist_ok=True)
+    with tempfile.NamedTemporaryFile(mode='wb', delete=False, prefix='tmp.', dir=dir_ or '.') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_file = f.name
+    os.replace(temp_file, file)
+
+# end of file
@@ -9,29 +9,94 @@
 # this is for mapping to my own dataset after that.
 
 import os
+import io
 import pathlib
 import glob
+import argparse
+import contextlib
+from imageindex import ImageIndex
+import manifest
+import labelstore
+import sink
+import prefetch
+import metrics
 use_mapping=True
+# ( label mapping, output directory ) per target.
+# each label file is read once for all the targets.
+targets = []
 if True:
-    from label_chihuahua import ChihuahuaCOCOLabelNames as COCOLabelNames
-    COCOLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', '/opt/darknet/data/coco.names')
-    assert 'dog' in COCOLabelNames.label_names()
-    assert 0 <= COCOLabelNames.label_index_src('dog')
-    assert 0 == COCOLabelNames.label_index_dst('dog')
-    assert 1 == COCOLabelNames.label_index_dst('chihuahua')
-    OUT_dir = '/data/work/dog/00input-chihuahua'
-else:
-    from label_dog import DogCOCOLabelNames as COCOLabelNames
-    COCOLabelNames.init('/data/work/dog/00input-dog/dog.txt', '/opt/darknet/data/coco.names')
-    assert 'dog' in COCOLabelNames.label_names()
-    assert 0 == COCOLabelNames.label_index('dog')
-    assert 0 <= COCOLabelNames.label_index_src('dog')
-    assert 0 == COCOLabelNames.label_index_dst('dog')
-    OUT_dir = '/data/work/dog/00input-dog'
-resume=False
+    from label_chihuahua import ChihuahuaCOCOLabelNames
+    labels = ChihuahuaCOCOLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', '/opt/darknet/data/coco.names')
+    assert 'dog' in labels.label_names()
+    assert 0 <= labels.label_index_src('dog')
+    assert 0 == labels.label_index_dst('dog')
+    assert 1 == labels.label_index_dst('chihuahua')
+    targets.append(( labels, '/data/work/dog/00input-chihuahua', ))
+if False:
+    from label_dog import DogCOCOLabelNames
+    labels = DogCOCOLabelNames.init('/data/work/dog/00input-dog/dog.txt', '/opt/darknet/data/coco.names')
+    assert 'dog' in labels.label_names()
+    assert 0 == labels.label_index('dog')
+    assert 0 <= labels.label_index_src('dog')
+    assert 0 == labels.label_index_dst('dog')
+    targets.append(( labels, '/data/work/dog/00input-dog', ))
+# skip the items which the manifest says are up to date. False to convert all again.
+resume=True
+# labels into packed directories of labelstore.py, one per split, instead of a file per image.
+packed=False
+# label files written by background I/O threads of sink.py, 0 to write them in the main thread.
+io_threads=1
+
+# [ ( coco id, bbox ), ... ] -> ( lines, use for negative )
+def map_lines(labels, src):
+    lines = []
+    use_for_negative = False
+    n_discarded = 0
+    n_negative = 0
+    for id_, bbox in src:
+        try:
+            id_ = labels.label_index(int(id_))
+        except ValueError:
+            n_discarded += 1
+            continue
+        if isinstance(id_, (tuple, list)):
+            for i in id_:
+                lines.append('{} {}'.format(i, bbox))
+        elif 0 <= id_:
+            lines.append('{} {}'.format(id_, bbox))
+        else:
+            use_for_negative = True
+            n_negative += 1
+    metrics.count('boxes', len(lines))
+    metrics.count('discarded', n_discarded)
+    metrics.count('negatives', n_negative)
+    return lines, use_for_negative
+
+# -> ( rel, label file, Manifest.recorded() of each target ), ...
+# only the queries of the manifests here: the files are stat'ed by read_item().
+def lookup_items(items, COCO_labels_dir, split):
+    for bbox_in in glob.glob(pathlib.PurePath(os.path.join(COCO_labels_dir, split, '**/*.txt')).as_posix(), recursive=True):
+        rel = os.path.relpath(bbox_in, start=COCO_labels_dir)
+        yield rel, bbox_in, [ items_.recorded(rel) for items_ in items ]
+
+# the manifests checked, and the label file of an item to be converted read, on an I/O thread of prefetch.py.
+# -> ( rel, label file, manifest.check() of each target, stamp or None, [ ( coco id, bbox ), ... ] or None )
+def read_item(item):
+    rel, bbox_in, recorded = item
+    checks = [ manifest.check(recorded_, bbox_in) for recorded_ in recorded ]
+    if all(checked is not None for checked in checks):
+        return ( rel, bbox_in, checks, None, None, )
+    with metrics.timer('read'), open(bbox_in, 'rb') as fbbox_in:
+        data = fbbox_in.read()
+    with metrics.timer('parse'):
+        src = []
+        for line in io.StringIO(data.decode(), newline='\n'):
+            id_, bbox = line.split(maxsplit=1)
+            src.append(( id_, bbox, ))
+    return ( rel, bbox_in, checks, manifest.stamp(bbox_in, data), src, )
 
 def main():
-    global OUT_dir, resume
+    global resume
 
     #####
     # input: follow the procedure described on https://pjreddie.com/darknet/yolo/
@@ -43,58 +108,65 @@ def main():
     # output
     NAME='coco'
 
-    for d in ( 'images', 'labels', 'lists' ):
-        if not os.path.exists(os.path.join(OUT_dir, d)):
-            os.makedirs(os.path.join(OUT_dir, d), exist_ok=True)
-    if not os.path.exists(os.path.join(OUT_dir, 'images', NAME)):
-        os.symlink(COCO_images_dir, os.path.join(OUT_dir, 'images', NAME))
-    for split in splits:
-        os.makedirs(os.path.join(OUT_dir, 'labels', NAME, split), exist_ok=True)
+    for _, OUT_dir in targets:
+        for d in ( 'images', 'labels', 'lists' ):
+            if not os.path.exists(os.path.join(OUT_dir, d)):
+                os.makedirs(os.path.join(OUT_dir, d), exist_ok=True)
+        if not os.path.exists(os.path.join(OUT_dir, 'images', NAME)):
+            os.symlink(COCO_images_dir, os.path.join(OUT_dir, 'images', NAME))
+        for split in splits:
+            os.makedirs(os.path.join(OUT_dir, 'labels', NAME, split), exist_ok=True)
 
     # create labels and lists
-    with open(os.path.join(OUT_dir, 'lists', NAME + '.txt'), 'w') as flist:
+    with contextlib.ExitStack() as stack:
+        out = stack.enter_context(sink.Sink(io_threads))
+        flists = [ stack.enter_context(manifest.open_atomic(os.path.join(OUT_dir, 'lists', NAME + '.txt'), sink.buffer_size))
+                   for _, OUT_dir in targets ]
+        writers = [ stack.enter_context(labelstore.Writer([ os.path.join(OUT_dir, 'labels', NAME, split) for split in splits ], resume))
+                    if packed else None for _, OUT_dir in targets ]
+        items = [ stack.enter_context(manifest.Manifest(os.path.join(OUT_dir, 'cache', 'manifest-' + NAME + '.sqlite'), labels.fingerprint(), resume,
+                                                        writer.exists if writer else None, out.flush))
+                  for ( labels, OUT_dir ), writer in zip(targets, writers) ]
+        progress = sink.Progress(NAME)
+        # the images are the same for all the targets.
+        OUT_dir = targets[0][1]
+        images = stack.enter_context(ImageIndex(os.path.join(OUT_dir, 'images', NAME), os.path.join(OUT_dir, 'cache', 'images-' + NAME + '.pickle')))
         for split in splits:
-            for bbox_in in glob.glob(pathlib.PurePath(os.path.join(COCO_labels_dir, split, '**/*.txt')).as_posix(), recursive=True):
-                lines = []
-                use_for_negative = False
-                with open(bbox_in, 'r', newline='\n') as fbbox_in:
-                    for line in fbbox_in:
-                        id_, bbox = line.split(maxsplit=1)
-                        try:
-                            id_ = COCOLabelNames.label_index(int(id_))
-                        except ValueError:
-                            continue
-                        if isinstance(id_, (tuple, list)):
-                            for i in id_:
-                                lines.append('{} {}'.format(i, bbox))
-                        elif 0 <= id_:
-                            lines.append('{} {}'.format(id_, bbox))
-                        else:
-                            use_for_negative = True
-                if use_for_negative or lines:
-                    rel = os.path.relpath(bbox_in, start=COCO_labels_dir)
-                    img_stem = os.path.join('images', NAME, rel[:-4])
-                    img = None
-                    for ext in ('.jpg', '.png', '.jpeg', '.JPEG' ):
-                        if os.path.isfile(os.path.join(OUT_dir, img_stem + ext)):
-                            img = img_stem + ext
-                            break
-                    if not img: raise FileNotFoundError(img_stem)
-                    img = pathlib.PurePath(img).as_posix()
-                    bbox_out = os.path.join(OUT_dir, 'labels', NAME, rel)
-                    print(',{}'.format(os.path.basename(bbox_out)), end='')
-                    if not resume and os.path.exists(bbox_out):
-                        raise FileExistsError(bbox_out)
-                    with open(bbox_out, 'w') as fbbox_out:
-                        for line in lines:
-                            fbbox_out.write(line)
-                    flist.write('{}\n'.format(img))
-                else:
-                    #print('skip {}'.format(os.path.basename(bbox_in)))
-                    print('.', end='', flush=True)
-    print('({})'.format(OUT_dir))
+            # read ahead, and converted in order.
+            for rel, bbox_in, checks, stamp, src in prefetch.imap(read_item, lookup_items(items, COCO_labels_dir, split)):
+                progress.update(rel)
+                for ( labels, OUT_dir ), flist, items_, writer, checked in zip(targets, flists, items, writers, checks):
+                    if checked is not None:
+                        done = items_.up_to_date(rel, checked)
+                        if done:
+                            flist.write('{}\n'.format(done))
+                            metrics.count('images')
+                        continue
+                    with metrics.timer('map'):
+                        lines, use_for_negative = map_lines(labels, src)
+                    if use_for_negative or lines:
+                        img = images.find(rel[:-4], ('.jpg', '.png', '.jpeg', '.JPEG' ))
+                        if not img: raise FileNotFoundError(os.path.join('images', NAME, rel[:-4]))
+                        img = pathlib.PurePath(os.path.join('images', NAME, img)).as_posix()
+                        bbox_out = os.path.join(OUT_dir, 'labels', NAME, rel)
+                        ( writer or out ).write(bbox_out, lines)
+                        flist.write('{}\n'.format(img))
+                        metrics.count('images')
+                        items_.record(rel, stamp, bbox_out, img)
+                    else:
+                        metrics.count('skipped')
+                        items_.record(rel, stamp, None, None)
+            out.flush()
+        progress.done()
+    for ( _, OUT_dir ), items_ in zip(targets, items):
+        print('({})'.format(OUT_dir))
+        print('up to date: {}'.format(items_.n_up_to_date))
 
 if __name__=='__main__':
-    main()
+    parser = argparse.ArgumentParser(description='convert COCO labels of yolo to my own dataset.')
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    with metrics.session(args.metrics):
+        main()
 
 # end of file
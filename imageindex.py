@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# stem -> file names of an image tree, instead of os.path.isfile() per extension.
+# each directory is read once by os.scandir(). the index is persisted, and
+# a directory is read again only when its mtime has changed.
+
+import os
+import pathlib
+import cache
+
+class ImageIndex():
+    def __init__(self, root, cache_file=None):
+        self._root = root
+        self._cache_file = cache_file
+        # relative directory -> ( mtime_ns, { stem: ( name, ... ) } )
+        self._dirs = cache.load(cache_file, {})
+        self._checked = set()
+        self._dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    @property
+    def root(self):
+        return self._root
+
+    def save(self):
+        if self._cache_file and self._dirty:
+            cache.save(self._cache_file, self._dirs)
+            self._dirty = False
+
+    def _stems(self, rel_dir):
+        entry = self._dirs.get(rel_dir)
+        if rel_dir in self._checked:
+            return entry[1] if entry else {}
+        self._checked.add(rel_dir)
+        try:
+            mtime_ns = os.stat(os.path.join(self._root, rel_dir)).st_mtime_ns
+        except FileNotFoundError:
+            if entry:
+                del self._dirs[rel_dir]
+                self._dirty = True
+            return {}
+        if entry and entry[0] == mtime_ns:
+            return entry[1]
+        stems = {}
+        with os.scandir(os.path.join(self._root, rel_dir)) as it:
+            for e in it:
+                if e.is_file():
+                    stems.setdefault(os.path.splitext(e.name)[0], []).append(e.name)
+        stems = { stem: tuple(sorted(names)) for stem, names in stems.items() }
+        self._dirs[rel_dir] = ( mtime_ns, stems )
+        self._dirty = True
+        return stems
+
+    # relative stem -> file names of the stem
+    def find_all(self, rel_stem):
+        rel_dir, stem = os.path.split(rel_stem)
+        return self._stems(rel_dir).get(stem, ())
+
+    # relative stem -> relative file (posix) with the first extension found in exts, None if not found.
+    def find(self, rel_stem, exts):
+        names = self.find_all(rel_stem)
+        if names:
+            rel_dir, stem = os.path.split(rel_stem)
+            for ext in exts:
+                if stem + ext in names:
+                    return pathlib.PurePath(os.path.join(rel_dir, stem + ext)).as_posix()
+        return None
+
+# end of file
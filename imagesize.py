@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# (height, width) of an image file without decoding it.
+# JPEG: SOF marker, rotated by EXIF orientation as cv2.imread() does.
+# PNG: IHDR chunk.
+# others, or whatever not understood: cv2.imread().
+
+import argparse
+import os
+import struct
+import timeit
+import cv2
+import cache
+
+# SOF0..SOF15 except DHT, JPG and DAC
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - frozenset(( 0xC4, 0xC8, 0xCC, ))
+# markers without length
+_JPEG_STANDALONE = frozenset(range(0xD0, 0xD8)) | frozenset(( 0x01, ))
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _exif_orientation(data):
+    # data: APP1 payload after 'Exif\0\0'
+    if len(data) < 8:
+        return None
+    order = data[:2]
+    if order == b'II':
+        endian = '<'
+    elif order == b'MM':
+        endian = '>'
+    else:
+        return None
+    ifd = struct.unpack(endian + 'I', data[4:8])[0]
+    if len(data) < ifd + 2:
+        return None
+    n = struct.unpack(endian + 'H', data[ifd:ifd + 2])[0]
+    for i in range(n):
+        entry = data[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        if len(entry) < 12:
+            return None
+        tag, type_ = struct.unpack(endian + 'HH', entry[:4])
+        if 0x0112 == tag and 3 == type_:
+            return struct.unpack(endian + 'H', entry[8:10])[0]
+    return None
+
+# -> (height, width, EXIF orientation or None) of the SOF marker, not rotated.
+def _probe_jpeg(f):
+    orientation = None
+    while True:
+        b = f.read(1)
+        if not b:
+            return None
+        if b != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in _JPEG_STANDALONE:
+            continue
+        if 0xD9 == marker or 0xDA == marker:
+            # EOI or SOS before SOF
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if marker in _JPEG_SOF:
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            _, h, w = struct.unpack('>BHH', sof)
+            if not h or not w:
+                return None
+            return (h, w, orientation)
+        if 0xE1 == marker and orientation is None:
+            data = f.read(length - 2)
+            if data[:6] == b'Exif\x00\x00':
+                orientation = _exif_orientation(data[6:])
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+def _probe_png(f):
+    # length, type, 13 bytes of data, crc
+    ihdr = f.read(8 + 13 + 4)
+    if len(ihdr) < 25 or ihdr[4:8] != b'IHDR':
+        return None
+    w, h = struct.unpack('>II', ihdr[8:16])
+    # eXIf chunk may rotate the image.
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return None
+        length, type_ = struct.unpack('>I4s', head)
+        if type_ == b'eXIf':
+            return None
+        if type_ in ( b'IDAT', b'IEND', ):
+            return (h, w)
+        f.seek(length + 4, os.SEEK_CUR)
+
+# file -> (height, width), None if the header is not understood.
+def probe(file):
+    with open(file, 'rb') as f:
+        head = f.read(8)
+        if head[:2] == b'\xff\xd8':
+            f.seek(2)
+            hwo = _probe_jpeg(f)
+            if hwo is None:
+                return None
+            h, w, orientation = hwo
+            # 5..8: transposed
+            return (w, h) if orientation in ( 5, 6, 7, 8, ) else (h, w)
+        if head == _PNG_SIGNATURE:
+            return _probe_png(f)
+    return None
+
+# JPEG file -> (height, width, EXIF orientation or None) as stored, None if not a JPEG or not understood.
+def probe_jpeg(file):
+    with open(file, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        return _probe_jpeg(f)
+
+# (height, width) by decoding.
+def decode(file):
+    img = cv2.imread(file)
+    if img is None:
+        raise FileNotFoundError(file)
+    return img.shape[:2]
+
+class ImageSize():
+    def __init__(self, cache_file=None):
+        self._cache_file = cache_file
+        # realpath -> ( mtime_ns, file size, height, width )
+        self._sizes = cache.load(cache_file, {})
+        self._dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    def save(self):
+        if self._cache_file and self._dirty:
+            cache.save(self._cache_file, self._sizes)
+            self._dirty = False
+
+    # file -> (height, width)
+    def get(self, file):
+        key = os.path.realpath(file)
+        st = os.stat(key)
+        entry = self._sizes.get(key)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2:]
+        hw = probe(key)
+        if hw is None:
+            hw = decode(key)
+        self._sizes[key] = ( st.st_mtime_ns, st.st_size, *hw )
+        self._dirty = True
+        return tuple(hw)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro-benchmark of the header probe.')
+    parser.add_argument('--repeat', '-n', default=5, type=int)
+    parser.add_argument('image', nargs='+')
+    args = parser.parse_args()
+
+    for image in args.image:
+        hw = probe(image)
+        assert hw is None or hw == decode(image), image
+    for func in ( decode, probe, ):
+        sec = min(timeit.repeat(lambda: [ func(image) for image in args.image ], number=1, repeat=args.repeat))
+        print('{:10s}: {:f} sec, {:f} msec/file'.format(func.__name__, sec, 1000 * sec / len(args.image)))
+
+# end of file
@@ -5,15 +5,34 @@
 # Copyright (c) 2019 Fumiyuki Shimizu
 # MIT License: https://opensource.org/licenses/MIT
 
-import threading
+# label spaces and mappings between them.
+# init() of each class returns a new instance. e.g.
+#   labels = DogVOCLabelNames.init(fileDog, fileVOC)
+#   labels.label_index('dog')
+# any number of instances can be used in a process.
+
+import os
+import types
+import hashlib
+import tempfile
 import csv
+import numpy as np
 
-def _read_file_or_tuple(file_or_tuple, *, use_lower, expected_num, is_csv):
-    if isinstance(file_or_tuple, (tuple, list)):
-        label_names = file_or_tuple
-    else:
+# compiled mappings of MappedLabelNames. None not to cache.
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'darkconv')
+# changes when the format of the compiled mapping changes.
+_CACHE_VERSION = 2
+
+# ( realpath, mtime_ns, use_lower, is_csv ) -> label names.
+# mappings from the same label file read it once.
+_files = {}
+
+def _read_file(file, *, use_lower, is_csv):
+    key = ( os.path.realpath(file), os.stat(file).st_mtime_ns, use_lower, is_csv, )
+    label_names = _files.get(key)
+    if label_names is None:
         label_names = []
-        with open(file_or_tuple, 'r', newline='') as f:
+        with open(file, 'r', newline='') as f:
             if is_csv:
                 for row in csv.reader(f):
                     if row:
@@ -23,137 +42,280 @@ def _read_file_or_tuple(file_or_tuple, *, use_lower, expected_num, is_csv):
                     id_ = line.split()
                     if id_:
                         label_names.append(id_[0].lower() if use_lower else id_[0])
+        label_names = _files[key] = tuple(label_names)
+    return list(label_names)
+
+def _read_file_or_tuple(file_or_tuple, *, use_lower, expected_num, is_csv):
+    if isinstance(file_or_tuple, (tuple, list)):
+        label_names = file_or_tuple
+    else:
+        label_names = _read_file(file_or_tuple, use_lower=use_lower, is_csv=is_csv)
     if expected_num:
         assert expected_num == len(label_names), '{}, {}'.format(expected_num, len(label_names))
     return label_names
 
+def _load_table(file):
+    if not file or not os.path.exists(file):
+        return None
+    try:
+        return np.load(file, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        print('Ignoring broken cache: {}: {}'.format(file, e))
+        return None
+
+def _save_table(file, table):
+    if not file:
+        return
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with tempfile.NamedTemporaryFile(mode='wb', delete=False, prefix='tmp.', dir=os.path.dirname(file)) as f:
+        np.save(f, table)
+        temp_file = f.name
+    os.replace(temp_file, file)
+
+# row of the index table -> dst index, tuple of dst indices, NEGATIVE or DISCARD
+# is_tuple: mapped to a tuple, even of one or no index.
+def _row_to_index(row, is_tuple):
+    if is_tuple:
+        return tuple(i for i in row if 0 <= i)
+    return row[0]
+
+# label_index_many() returns rows of the index table:
+#   (N, K) int32, K is the max number of dst indices of a label.
+#   indices >= 0 first, then padded by DISCARD.
+#   NEGATIVE in column 0: the image is used for negative.
+#   DISCARD  in column 0: the label is skipped.
 class LabelNames():
-    _lock = threading.Lock()
-    _label_names = None
-    _use_lower = None
+    NEGATIVE = -1
+    DISCARD = -2
 
-    def __new__(self):
-        raise NotImplementedError('singleton')
+    def __new__(cls):
+        raise NotImplementedError('use init()')
 
     @classmethod
     def init(cls, file_or_tuple, *, expected_num=None, use_lower=False, is_csv=False):
-        if cls._label_names is not None:
-            assert False, 'init() called again.'
-            return
-        super().__new__(cls)
-        with cls._lock:
-            if cls._label_names is not None:
-                assert False, 'init() called again.'
-                return
-            cls._label_names = _read_file_or_tuple(file_or_tuple, use_lower=use_lower, expected_num=expected_num, is_csv=is_csv)
-            cls._use_lower = use_lower
-            return cls
+        self = super().__new__(cls)
+        self._label_names = _read_file_or_tuple(file_or_tuple, use_lower=use_lower, expected_num=expected_num, is_csv=is_csv)
+        self._use_lower = use_lower
+        label_dict = {}
+        for i, name in enumerate(self._label_names):
+            # list.index() returns the first one.
+            label_dict.setdefault(name, i)
+        self._label_dict = types.MappingProxyType(label_dict)
+        self._index_table = np.arange(len(self._label_names), dtype=np.int32).reshape(-1, 1)
+        return self
 
-    @classmethod
-    def save(cls, file):
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.fingerprint())
+
+    def save(self, file):
         with open(file, 'w', newline='\n') as fo:
-            for label in cls._label_names:
+            for label in self._label_names:
                 fo.write('{}\n'.format(label))
 
-    @classmethod
-    def use_lower(cls):
-        return cls._use_lower
+    def use_lower(self):
+        return self._use_lower
 
-    @classmethod
-    def label_names(cls):
-        return cls._label_names
+    def _hash(self, h):
+        h.update('{}\n'.format(self._use_lower).encode())
+        for name in self._label_names:
+            h.update('{}\n'.format(name).encode())
+        h.update(self._index_table.tobytes())
 
-    @classmethod
-    def label_name(cls, i):
-        return cls._label_names[i]
+    # same fingerprint, same results of label_index() and label_index_many().
+    def fingerprint(self):
+        h = hashlib.sha1()
+        self._hash(h)
+        return h.hexdigest()
 
-    @classmethod
-    def label_index(cls, name):
-        return cls._label_names.index(name.lower() if cls._use_lower else name)
+    def label_names(self):
+        return self._label_names
 
-class MappedLabelNames(LabelNames):
-    _mapper = None
-    _label_src = None
-    _label_dst = None
-    _label_names_for_negative = None
+    def label_name(self, i):
+        return self._label_names[i]
+
+    def label_index(self, name):
+        try:
+            return self._label_dict[name.lower() if self._use_lower else name]
+        except KeyError:
+            # same exception which list.index() raises.
+            raise ValueError('{} is not in list'.format(name)) from None
 
+    def _index_row(self, name):
+        return self._index_table[self.label_index(name)]
+
+    # ndarray of names or indices -> rows of the index table
+    def label_index_many(self, src):
+        src = np.asarray(src)
+        if src.dtype.kind in 'iu':
+            return self._index_table[src]
+        names, inverse = np.unique(src, return_inverse=True)
+        rows = np.empty((len(names), self._index_table.shape[1]), dtype=np.int32)
+        for i, name in enumerate(names.tolist()):
+            rows[i] = self._index_row(name)
+        return rows[inverse.reshape(-1)]
+
+class MappedLabelNames(LabelNames):
     @classmethod
     def init(cls, label_dst, label_src, label_mapper=None, file_or_tuple_for_negative=None):
-        super().init(label_src.label_names(), use_lower=label_src.use_lower())
+        self = super().init(label_src.label_names(), use_lower=label_src.use_lower())
 
-        cls._mapper = {} if label_mapper is None else label_mapper
-        cls._label_src = label_src
-        cls._label_dst = label_dst
-        cls._label_names_for_negative = set(_read_file_or_tuple(file_or_tuple_for_negative,
+        self._mapper = {} if label_mapper is None else dict(label_mapper)
+        self._label_src = label_src
+        self._label_dst = label_dst
+        self._label_names_for_negative = set(_read_file_or_tuple(file_or_tuple_for_negative,
                 use_lower=label_src.use_lower(), expected_num=None, is_csv=False)) if file_or_tuple_for_negative else set()
 
-        assert set(cls._mapper.keys()) <= set(cls._label_names), \
-            'Invalid mapper keys: {}'.fomat(set(cls._mapper.keys()) - set(cls._label_names))
+        # the same inputs compile to the same table: validated and printed once.
+        # the cached table has one more column: 1 if mapped to a tuple.
+        cache_file = self._cache_file()
+        table = _load_table(cache_file)
+        if table is not None:
+            self._index_table = table[:, :-1]
+            self._index_tuple = 0 != table[:, -1]
+            self._index_list = self._table_to_list()
+            print('Label mapping {}: {} (cached: {})'.format(type(self).__name__, self.fingerprint(), cache_file))
+            return self
 
-        assert set(cls._label_names_for_negative) <= set(cls._label_names), \
-            'Invalid negative keys: {}'.fomat(set(cls._label_names_for_negative) - set(cls._label_names))
+        assert set(self._mapper.keys()) <= set(self._label_names), \
+            'Invalid mapper keys: {}'.format(set(self._mapper.keys()) - set(self._label_names))
 
-        dup = set(cls._mapper.keys()) & set(cls._label_names_for_negative)
-        assert 0 == len(dup), 'Both in mapper and negative: {}'.fomat(dup)
+        assert set(self._label_names_for_negative) <= set(self._label_names), \
+            'Invalid negative keys: {}'.format(set(self._label_names_for_negative) - set(self._label_names))
+
+        dup = set(self._mapper.keys()) & set(self._label_names_for_negative)
+        assert 0 == len(dup), 'Both in mapper and negative: {}'.format(dup)
 
         mapper_values = []
-        for val in cls._mapper.values():
+        for val in self._mapper.values():
             if isinstance(val, (tuple, list)):
                 mapper_values.extend(val)
             elif val:
                 mapper_values.append(val)
         assert set(label_dst.label_names()) >= set(mapper_values), \
             'Invalid mapped values: {}'.format(set(mapper_values) - set(label_dst.label_names()))
-        for src_label in label_src.label_names():
-            try:
-                dst_index = cls.label_index(src_label)
-            except:
+        index_list = [ self._compile_index(nm) for nm in self._label_names ]
+        width = max([1] + [ len(x) for x in index_list if isinstance(x, tuple) ])
+        table = np.full((len(index_list), width + 1), self.DISCARD, dtype=np.int32)
+        table[:, -1] = 0
+        for i, dst_index in enumerate(index_list):
+            if isinstance(dst_index, tuple):
+                table[i, :len(dst_index)] = dst_index
+                table[i, -1] = 1
+            else:
+                table[i, 0] = dst_index
+        _save_table(cache_file, table)
+        # from the table as from the cache: both give the same label_index().
+        self._index_table = table[:, :-1]
+        self._index_tuple = 0 != table[:, -1]
+        self._index_list = self._table_to_list()
+
+        for src_label, dst_index in zip(self._label_names, self._index_list):
+            if dst_index == self.DISCARD:
                 print('{}(skip),'.format(src_label), end='', flush=True)
                 continue
             if isinstance(dst_index, (tuple, list)):
-                print('{}->{},'.format(src_label, tuple(cls.label_name_dst(x) for x in dst_index)))
+                print('{}->{},'.format(src_label, tuple(self.label_name_dst(x) for x in dst_index)))
             elif 0 <= dst_index:
-                print('{}->{},'.format(src_label, cls.label_name_dst(dst_index)))
+                print('{}->{},'.format(src_label, self.label_name_dst(dst_index)))
             else:
                 print('{}(neg),'.format(src_label))
-        return cls
+        print('Label mapping {}: {}'.format(type(self).__name__, self.fingerprint()))
+        return self
 
-    @classmethod
-    def label_names_for_negative(cls):
-        return cls._label_names_for_negative
+    # hash of the inputs of the compiled mapping
+    def _cache_file(self):
+        if cache_dir is None:
+            return None
+        h = hashlib.sha1()
+        h.update('{}\n'.format(_CACHE_VERSION).encode())
+        self._label_src._hash(h)
+        h.update(b'->\n')
+        self._label_dst._hash(h)
+        h.update(repr(sorted(self._mapper.items())).encode())
+        h.update(repr(sorted(self._label_names_for_negative)).encode())
+        return os.path.join(cache_dir, 'mapping-{}-{}.npy'.format(type(self).__name__, h.hexdigest()))
 
-    @classmethod
-    def label_names_dst(cls):
-        return cls._label_dst.label_names()
+    def _table_to_list(self):
+        return [ _row_to_index(row, is_tuple) for row, is_tuple in zip(self._index_table.tolist(), self._index_tuple.tolist()) ]
 
-    @classmethod
-    def label_name_dst(cls, i):
-        return cls._label_dst.label_name(i)
+    def _hash(self, h):
+        super()._hash(h)
+        h.update(self._index_tuple.tobytes())
+        h.update(b'->\n')
+        self._label_dst._hash(h)
 
-    @classmethod
-    def label_index_src(cls, src_label):
-        return cls._label_src.label_index(src_label)
+    def label_names_for_negative(self):
+        return self._label_names_for_negative
 
-    @classmethod
-    def label_index_dst(cls, dst_label):
-        return cls._label_dst.label_index(dst_label)
+    def label_names_dst(self):
+        return self._label_dst.label_names()
+
+    def label_name_dst(self, i):
+        return self._label_dst.label_name(i)
+
+    def label_index_src(self, src_label):
+        return self._label_src.label_index(src_label)
+
+    def label_index_dst(self, dst_label):
+        return self._label_dst.label_index(dst_label)
+
+    # src label name -> dst index, tuple of dst indices, NEGATIVE or DISCARD
+    def _compile_index(self, nm):
+        if nm in self._label_names_for_negative:
+            return self.NEGATIVE
+        if nm in self._mapper:
+            nm = self._mapper[nm]
+            if nm is None:
+                return self.DISCARD
+            if isinstance(nm, (tuple, list)):
+                return tuple(self.label_index_dst(n) for n in nm)
+        try:
+            return self.label_index_dst(nm)
+        except ValueError:
+            return self.DISCARD
 
     # src label -> dst index
-    @classmethod
-    def label_index(cls, src_label):
+    def label_index(self, src_label):
         if isinstance(src_label, int):
-            nm = cls.label_name(src_label)
+            dst_index = self._index_list[src_label]
         else:
-            nm = src_label.lower() if cls._use_lower else src_label
-        if nm in cls._label_names_for_negative:
-            return -1
-        if nm in cls._mapper:
-            nm = cls._mapper[nm]
-            if nm is None:
-                # same exception which list.index() raises.
-                raise ValueError('Discarding the label: {}'.format(src_label))
-            if isinstance(nm, (tuple, list)):
-                return tuple(cls.label_index_dst(n) for n in nm)
-        return cls.label_index_dst(nm)
+            nm = src_label.lower() if self._use_lower else src_label
+            i = self._label_dict.get(nm)
+            dst_index = self._compile_index(nm) if i is None else self._index_list[i]
+        if dst_index == self.DISCARD:
+            # same exception which list.index() raises.
+            raise ValueError('Discarding the label: {}'.format(src_label))
+        return dst_index
+
+    def _index_row(self, name):
+        nm = name.lower() if self._use_lower else name
+        i = self._label_dict.get(nm)
+        if i is not None:
+            return self._index_table[i]
+        # not a source label: neither negative nor mapped, so a single index at most.
+        row = np.full(self._index_table.shape[1], self.DISCARD, dtype=np.int32)
+        row[0] = self._compile_index(nm)
+        return row
+
+if __name__ == '__main__':
+    # self-check: a mapping from the cache gives the same results as the compiled one.
+    with tempfile.TemporaryDirectory() as cache_dir:
+        src = LabelNames.init(( 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', ))
+        dst = LabelNames.init(( 'dog', 'cat', ))
+        mapper = { 'a': ( 'dog', ), 'b': (), 'c': None, 'd': ( 'dog', 'cat', ), 'e': 'cat', 'f': [ 'cat', ], }
+        compiled, cached = [ MappedLabelNames.init(dst, src, mapper, ( 'g', )) for _ in range(2) ]
+        assert compiled.fingerprint() == cached.fingerprint()
+        for name in src.label_names():
+            results = []
+            for labels in ( compiled, cached, ):
+                try:
+                    results.append(labels.label_index(name))
+                except ValueError:
+                    results.append('DISCARD')
+            assert results[0] == results[1] and type(results[0]) is type(results[1]), '{}: {}'.format(name, results)
+            print('{}: {}'.format(name, results[0]))
+        assert np.array_equal(compiled.label_index_many(src.label_names()), cached.label_index_many(src.label_names()))
+        # a tuple of one index is not the index itself.
+        assert MappedLabelNames.init(dst, src, { 'a': 'dog', }).fingerprint() != compiled.fingerprint()
 
 # end of file
@@ -11,30 +11,30 @@ from label_default import OpenImagesLabelNames, COCOLabelNames, ILSVRCLabelNames
 class ChihuahuaLabelNames(LabelNames):
     @classmethod
     def init(cls, file=None):
-        super().init(file, expected_num=3)
-        assert 'dog' in cls.label_names(), cls.label_names()
-        assert 'chihuahua' in cls.label_names(), cls.label_names()
-        assert 0 == cls.label_index('dog')
-        assert 1 == cls.label_index('chihuahua')
-        assert 2 == cls.label_index('G')
-        return cls
+        self = super().init(file, expected_num=3)
+        assert 'dog' in self.label_names(), self.label_names()
+        assert 'chihuahua' in self.label_names(), self.label_names()
+        assert 0 == self.label_index('dog')
+        assert 1 == self.label_index('chihuahua')
+        assert 2 == self.label_index('G')
+        return self
 
 class GLabelNames(LabelNames):
     @classmethod
     def init(cls, file=None):
-        super().init(file, expected_num=1)
-        return cls
+        self = super().init(file, expected_num=1)
+        return self
 
 class ChihuahuaGLabelNames(MappedLabelNames):
     mapper = { 'G': ( 'G', 'chihuahua', 'dog', ) }
 
     @classmethod
     def init(cls, fileChihuahua=None, fileG=None):
-        super().init(ChihuahuaLabelNames.init(fileChihuahua), GLabelNames.init(fileG),
+        self = super().init(ChihuahuaLabelNames.init(fileChihuahua), GLabelNames.init(fileG),
               label_mapper=cls.mapper)
-        assert 'G' in cls.label_names()
-        assert set(( 2, 1, 0 )) == set(cls.label_index('G'))
-        return cls
+        assert 'G' in self.label_names()
+        assert set(( 2, 1, 0 )) == set(self.label_index('G'))
+        return self
 
 class ChihuahuaVOCLabelNames(MappedLabelNames):
     mapper = { 'dog': None, } # chihuahua is not separated
@@ -42,11 +42,11 @@ class ChihuahuaVOCLabelNames(MappedLabelNames):
 
     @classmethod
     def init(cls, fileChihuahua=None, fileVOC=None):
-        super().init(ChihuahuaLabelNames.init(fileChihuahua), VOCLabelNames.init(fileVOC),
+        self = super().init(ChihuahuaLabelNames.init(fileChihuahua), VOCLabelNames.init(fileVOC),
               label_mapper=cls.mapper, file_or_tuple_for_negative=cls._neg)
-        assert 'dog' in cls.label_names()
-        assert -1 == cls.label_index('cat')
-        return cls
+        assert 'dog' in self.label_names()
+        assert -1 == self.label_index('cat')
+        return self
 
 class ChihuahuaCOCOLabelNames(MappedLabelNames):
     mapper = { 'dog': None, } # chihuahua is not separated
@@ -54,11 +54,11 @@ class ChihuahuaCOCOLabelNames(MappedLabelNames):
 
     @classmethod
     def init(cls, fileChihuahua=None, fileCOCO=None):
-        super().init(ChihuahuaLabelNames.init(fileChihuahua), COCOLabelNames.init(fileCOCO),
+        self = super().init(ChihuahuaLabelNames.init(fileChihuahua), COCOLabelNames.init(fileCOCO),
               label_mapper=cls.mapper, file_or_tuple_for_negative=cls._neg)
-        assert 'dog' in cls.label_names()
-        assert -1 == cls.label_index('cat')
-        return cls
+        assert 'dog' in self.label_names()
+        assert -1 == self.label_index('cat')
+        return self
 
 class ChihuahuaOpenImagesLabelNames(MappedLabelNames):
     mapper = { '/m/0bt9lr': None, }	# Dog. chihuahua is not separated
@@ -70,11 +70,11 @@ class ChihuahuaOpenImagesLabelNames(MappedLabelNames):
 
     @classmethod
     def init(cls, fileChihuahua=None, fileOpenImages=None):
-        super().init(ChihuahuaLabelNames.init(fileChihuahua), OpenImagesLabelNames.init(fileOpenImages),
+        self = super().init(ChihuahuaLabelNames.init(fileChihuahua), OpenImagesLabelNames.init(fileOpenImages),
               label_mapper=cls.mapper, file_or_tuple_for_negative=cls._neg)
-        assert '/m/0bt9lr' in cls.label_names()
-        assert -1 == cls.label_index('/m/03k3r')
-        return cls
+        assert '/m/0bt9lr' in self.label_names()
+        assert -1 == self.label_index('/m/03k3r')
+        return self
 
 class ChihuahuaILSVRCLabelNames(MappedLabelNames):
     mapper = { 'n02085620': ( 'chihuahua', 'dog', ) }
@@ -200,13 +200,14 @@ class ChihuahuaILSVRCLabelNames(MappedLabelNames):
 
     @classmethod
     def init(cls, fileChihuahua=None, fileILSVRC=None):
+        mapper = dict(cls.mapper)
         for key in cls._dog:
-            cls.mapper[key] = 'dog'
-        super().init(ChihuahuaLabelNames.init(fileChihuahua), ILSVRCLabelNames.init(fileILSVRC), label_mapper=cls.mapper)
-        assert 'dog' in cls.label_names_dst()
-        assert set(( 1, 0 )) == set(cls.label_index('n02085620'))
-        assert 0 == cls.label_index('n02085782')
-        assert 0 == cls.label_index('n02113978')
-        return cls
+            mapper[key] = 'dog'
+        self = super().init(ChihuahuaLabelNames.init(fileChihuahua), ILSVRCLabelNames.init(fileILSVRC), label_mapper=mapper)
+        assert 'dog' in self.label_names_dst()
+        assert set(( 1, 0 )) == set(self.label_index('n02085620'))
+        assert 0 == self.label_index('n02085782')
+        assert 0 == self.label_index('n02113978')
+        return self
 
 # end of file
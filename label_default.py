@@ -10,10 +10,10 @@ from label import LabelNames
 class OpenImagesLabelNames(LabelNames):
     @classmethod
     def init(cls, file=None):
-        super().init('/data/huge/OpenImages/labels/class-descriptions-boxable.csv' if file is None else file, expected_num=601, is_csv=True)
-        assert '/m/0bt9lr' in cls.label_names()
-        assert '/m/0306r'  in cls.label_names()
-        return cls
+        self = super().init('/data/huge/OpenImages/labels/class-descriptions-boxable.csv' if file is None else file, expected_num=601, is_csv=True)
+        assert '/m/0bt9lr' in self.label_names()
+        assert '/m/0306r'  in self.label_names()
+        return self
 
 class ILSVRCLabelNames(LabelNames):
     @classmethod
@@ -24,25 +24,25 @@ class ILSVRCLabelNames(LabelNames):
         # has a synset id of n01440764, and it contains the fish tench.
         #-----------------------------------
         # -> need +1 for submission
-        super().init('/data/huge/ILSVRC/LOC_synset_mapping.txt' if file is None else file, expected_num=1000)
-        assert 'n02085620' in cls.label_names()
-        assert 'n02085782' in cls.label_names()
-        assert 'n02088364' in cls.label_names()
-        return cls
+        self = super().init('/data/huge/ILSVRC/LOC_synset_mapping.txt' if file is None else file, expected_num=1000)
+        assert 'n02085620' in self.label_names()
+        assert 'n02085782' in self.label_names()
+        assert 'n02088364' in self.label_names()
+        return self
 
 class COCOLabelNames(LabelNames):
     @classmethod
     def init(cls, file=None):
-        super().init('/opt/darknet/data/coco.names' if file is None else file, expected_num=80)
-        assert 'dog' in cls.label_names()
-        return cls
+        self = super().init('/opt/darknet/data/coco.names' if file is None else file, expected_num=80)
+        assert 'dog' in self.label_names()
+        return self
 
 class VOCLabelNames(LabelNames):
     @classmethod
     def init(cls, file=None):
-        super().init('/opt/darknet/data/voc.names' if file is None else file, expected_num=20, use_lower=True)
-        assert 'dog' in cls.label_names()
-        assert 'cow' in cls.label_names()
-        return cls
+        self = super().init('/opt/darknet/data/voc.names' if file is None else file, expected_num=20, use_lower=True)
+        assert 'dog' in self.label_names()
+        assert 'cow' in self.label_names()
+        return self
 
 # end of file
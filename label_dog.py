@@ -11,27 +11,27 @@ from label_default import OpenImagesLabelNames, COCOLabelNames, ILSVRCLabelNames
 class DogLabelNames(LabelNames):
     @classmethod
     def init(cls, file=None):
-        super().init(file, expected_num=1)
-        assert 'dog' in cls.label_names()
-        return cls
+        self = super().init(file, expected_num=1)
+        assert 'dog' in self.label_names()
+        return self
 
 class DogVOCLabelNames(MappedLabelNames):
     _neg = ( 'cat', 'cow', 'horse', 'sheep', )
 
     @classmethod
     def init(cls, fileDog=None, fileVOC=None):
-        super().init(DogLabelNames.init(fileDog), VOCLabelNames.init(fileVOC), file_or_tuple_for_negative=cls._neg)
-        return cls
+        self = super().init(DogLabelNames.init(fileDog), VOCLabelNames.init(fileVOC), file_or_tuple_for_negative=cls._neg)
+        return self
 
 class DogCOCOLabelNames(MappedLabelNames):
     _neg = ( 'cat', 'horse', 'sheep', 'cow', 'elephant', 'zebra', 'giraffe', )
 
     @classmethod
     def init(cls, fileDog=None, fileCOCO=None):
-        super().init(DogLabelNames.init(fileDog), COCOLabelNames.init(fileCOCO), file_or_tuple_for_negative=cls._neg)
-        assert 'dog' in cls.label_names()
-        assert  0 == cls.label_index('dog')
-        return cls
+        self = super().init(DogLabelNames.init(fileDog), COCOLabelNames.init(fileCOCO), file_or_tuple_for_negative=cls._neg)
+        assert 'dog' in self.label_names()
+        assert  0 == self.label_index('dog')
+        return self
 
 class DogOpenImagesLabelNames(MappedLabelNames):
     _neg = (
@@ -45,12 +45,12 @@ class DogOpenImagesLabelNames(MappedLabelNames):
 
     @classmethod
     def init(cls, fileDog=None, fileOpenImages=None):
-        super().init(DogLabelNames.init(fileDog), OpenImagesLabelNames.init(fileOpenImages),
+        self = super().init(DogLabelNames.init(fileDog), OpenImagesLabelNames.init(fileOpenImages),
               label_mapper=cls._mapper, file_or_tuple_for_negative=cls._neg)
-        assert 'dog' in cls.label_names_dst()
-        assert  0 == cls.label_index('/m/0bt9lr')
-        assert -1 == cls.label_index('/m/03k3r')
-        return cls
+        assert 'dog' in self.label_names_dst()
+        assert  0 == self.label_index('/m/0bt9lr')
+        assert -1 == self.label_index('/m/03k3r')
+        return self
 
 class DogILSVRCLabelNames(MappedLabelNames):
     _dog = (
@@ -179,11 +179,11 @@ class DogILSVRCLabelNames(MappedLabelNames):
         mapper = {}
         for key in cls._dog:
             mapper[key] = 'dog'
-        super().init(DogLabelNames.init(fileDog), ILSVRCLabelNames.init(fileILSVRC), label_mapper=mapper)
-        assert 'dog' in cls.label_names_dst()
-        assert 0 == cls.label_index('n02085620')
-        assert 0 == cls.label_index('n02085782')
-        assert 0 == cls.label_index('n02113978')
-        return cls
+        self = super().init(DogLabelNames.init(fileDog), ILSVRCLabelNames.init(fileILSVRC), label_mapper=mapper)
+        assert 'dog' in self.label_names_dst()
+        assert 0 == self.label_index('n02085620')
+        assert 0 == self.label_index('n02085782')
+        assert 0 == self.label_index('n02113978')
+        return self
 
 # end of file
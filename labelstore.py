@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# packed label directory: the yolo label files of a directory in two files, instead of a file per image.
+#   <dir>.data: rows of ( label int16, YOLO style BBOX float32*4 ), contiguous. memory-mappable.
+#   <dir>.index: CSV: key, first row, number of rows. key: label file relative to <dir>.
+# rows are appended. a key written again appends its rows again, and its last index line wins.
+# a crash leaves at most a torn index line and rows without an index line, dropped when appended next.
+
+import os
+import argparse
+import numpy as np
+import metrics
+
+ROW = np.dtype([ ( 'label', '<i2' ), ( 'bbox', '<f4', ( 4, ) ) ])
+# rows parsed from label files keep the values float() gives.
+TEXT_ROW = np.dtype([ ( 'label', '<i4' ), ( 'bbox', '<f8', ( 4, ) ) ])
+
+def _files(dir_):
+    dir_ = os.path.normpath(dir_)
+    return dir_ + '.data', dir_ + '.index'
+
+def is_packed(dir_):
+    return os.path.exists(_files(dir_)[1])
+
+# -> { key: ( first row, number of rows ) }, rows, bytes of the complete lines
+def _load_index(index_file):
+    index = {}
+    rows = 0
+    size = 0
+    with open(index_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            key, start, count = line[:-1].decode().rsplit(',', 2)
+            start, count = int(start), int(count)
+            index[key] = ( start, count, )
+            rows = max(rows, start + count)
+            size += len(line)
+    return index, rows, size
+
+# lines of a yolo label file -> rows
+def to_rows(lines, dtype=ROW):
+    vals = [ line.split() for line in lines ]
+    vals = [ v for v in vals if v ]
+    rows = np.zeros(len(vals), dtype=dtype)
+    if vals:
+        vals = np.array(vals, dtype=np.float64)
+        assert ( np.iinfo(dtype['label']).max >= vals[:, 0] ).all(), vals[:, 0].max()
+        rows['label'] = vals[:, 0]
+        rows['bbox'] = vals[:, 1:5]
+    return rows
+
+# float32 has 9 significant digits at most.
+def to_line(label, bbox):
+    return '{} {:1.9f} {:1.9f} {:1.9f} {:1.9f}\n'.format(label, *bbox)
+
+def to_lines(rows):
+    return [ to_line(label, bbox) for label, bbox in zip(rows['label'].tolist(), rows['bbox'].tolist()) ]
+
+class _Packing():
+    def __init__(self, dir_, append):
+        self.dir = os.path.normpath(dir_)
+        data_file, index_file = _files(self.dir)
+        os.makedirs(os.path.dirname(data_file) or '.', exist_ok=True)
+        self.keys = set()
+        self.rows = 0
+        append = append and os.path.exists(index_file)
+        if append:
+            index, self.rows, size = _load_index(index_file)
+            self.keys = set(index)
+            data_size = os.path.getsize(data_file) if os.path.exists(data_file) else 0
+            assert self.rows * ROW.itemsize <= data_size, 'Rows lost: {}'.format(data_file)
+            os.truncate(index_file, size)
+            if data_size:
+                os.truncate(data_file, self.rows * ROW.itemsize)
+        mode = 'ab' if append else 'wb'
+        self.data = open(data_file, mode)
+        self.index = open(index_file, mode)
+
+    def write(self, key, rows):
+        # rows first: an index line never refers to rows not written.
+        self.data.write(rows.tobytes())
+        self.data.flush()
+        self.index.write('{},{},{}\n'.format(key, self.rows, len(rows)).encode())
+        self.index.flush()
+        self.rows += len(rows)
+        self.keys.add(key)
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+# writes label files into the packed directories which contain them.
+# append: False to pack from scratch.
+class Writer():
+    def __init__(self, dirs, append=True):
+        self._packings = [ _Packing(dir_, append) for dir_ in dirs ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for packing in self._packings:
+            packing.close()
+
+    # label file -> packing, key
+    def _find(self, file):
+        file = os.path.normpath(file)
+        for packing in self._packings:
+            if file.startswith(packing.dir + os.sep):
+                return packing, os.path.relpath(file, start=packing.dir)
+        raise ValueError('Not in any packed directory: {}'.format(file))
+
+    # lines of a yolo label file
+    def write(self, file, lines):
+        packing, key = self._find(file)
+        with metrics.timer('write'):
+            packing.write(key, to_rows(lines))
+
+    # whether the label file has been packed. for manifest.Manifest(exists=).
+    def exists(self, file):
+        packing, key = self._find(file)
+        return key in packing.keys
+
+class Reader():
+    def __init__(self, dir_):
+        self._dir = os.path.normpath(dir_)
+        data_file, index_file = _files(self._dir)
+        self._index, rows, _ = _load_index(index_file)
+        if rows:
+            self._data = np.memmap(data_file, dtype=ROW, mode='r', shape=( rows, ))
+        else:
+            self._data = np.zeros(0, dtype=ROW)
+
+    @property
+    def dir(self):
+        return self._dir
+
+    def keys(self):
+        return self._index.keys()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    # -> rows of ROW, a view of the data file
+    def rows(self, key):
+        start, count = self._index[key]
+        return self._data[start:start + count]
+
+    def labels(self, key):
+        return self.rows(key)['label']
+
+    # -> (N, 4) YOLO style BBOX
+    def bboxes(self, key):
+        return self.rows(key)['bbox']
+
+    def lines(self, key):
+        return to_lines(self.rows(key))
+
+    # writes the classic layout: <dir>/<key>, or <out_dir>/<key>.
+    def export(self, out_dir=None):
+        out_dir = self._dir if out_dir is None else out_dir
+        for key in self._index:
+            file = os.path.join(out_dir, key)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'w', newline='\n') as f:
+                f.writelines(self.lines(key))
+
+# a yolo label tree: the label files of a directory, its packed files, or both. the label files win.
+# image id: image file relative to the images directory, without the extension.
+# rows of a label file are parsed when first asked for, and kept until the file changes.
+# rows of the packed files are views of the memory map.
+class YoloDataset():
+    def __init__(self, dir_):
+        self._dir = os.path.normpath(dir_)
+        self._packed = Reader(self._dir) if is_packed(self._dir) else None
+        self._stamp = _stamp(_files(self._dir)[1])
+        # key -> ( stamp of the label file, rows )
+        self._parsed = {}
+
+    @property
+    def dir(self):
+        return self._dir
+
+    # whether the packed files have changed since indexed.
+    def is_stale(self):
+        return self._stamp != _stamp(_files(self._dir)[1])
+
+    def __contains__(self, image_id):
+        key = image_id + '.txt'
+        return os.path.exists(os.path.join(self._dir, key)) or ( self._packed is not None and key in self._packed )
+
+    # -> rows of ROW from the packed files, or of TEXT_ROW from the label file
+    def rows(self, image_id):
+        key = image_id + '.txt'
+        file = os.path.join(self._dir, key)
+        stamp = _stamp(file)
+        if stamp is None:
+            if self._packed is None or key not in self._packed:
+                raise FileNotFoundError(file)
+            return self._packed.rows(key)
+        parsed = self._parsed.get(key)
+        if parsed is None or parsed[0] != stamp:
+            with open(file, 'r') as f:
+                parsed = self._parsed[key] = ( stamp, to_rows(f, TEXT_ROW), )
+        return parsed[1]
+
+    def __getitem__(self, image_id):
+        return self.rows(image_id)
+
+    def labels(self, image_id):
+        return self.rows(image_id)['label']
+
+    # -> (N, 4) YOLO style BBOX
+    def bboxes(self, image_id):
+        return self.rows(image_id)['bbox']
+
+    # in the order of the list file, whose lines are image files under list_base.
+    # -> ( image file relative to list_base, rows ), ...
+    def iter_list(self, list_file, list_base):
+        with open(list_file, 'r', newline='\n') as f:
+            for image_file in f:
+                if image_file.endswith('\n'):
+                    image_file = image_file[:-1]
+                rel_image_file = os.path.relpath(image_file, start=list_base)
+                assert '..' not in rel_image_file, '{},{},{}'.format(image_file, list_base, rel_image_file)
+                yield rel_image_file, self.rows(os.path.splitext(rel_image_file)[0])
+
+def _stamp(file):
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+# label directory -> YoloDataset, per process. kept across the calls, e.g. of sideaug.aug_all().
+_datasets = {}
+
+def dataset(dir_):
+    dir_ = os.path.normpath(dir_)
+    ds = _datasets.get(dir_)
+    if ds is None or ds.is_stale():
+        ds = _datasets[dir_] = YoloDataset(dir_)
+    return ds
+
+# renames the directory and its packed files, whichever exist.
+def rename(src, dst):
+    if os.path.exists(src):
+        os.rename(src, dst)
+    if is_packed(src):
+        for src_file, dst_file in zip(_files(src), _files(dst)):
+            if os.path.exists(src_file):
+                os.rename(src_file, dst_file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='packed label directories.')
+    parser.add_argument('--export', '-e', action='store_true', help='write the label files of the directories.')
+    parser.add_argument('--out-dir', '-o', help='directory to export to, instead of the packed directory itself.')
+    parser.add_argument('dir', nargs='+', help='packed directory: <dir>.data and <dir>.index')
+    args = parser.parse_args()
+    assert not args.out_dir or 1 == len(args.dir), '--out-dir with multiple directories.'
+
+    for dir_ in args.dir:
+        reader = Reader(dir_)
+        rows = sum(len(reader.rows(key)) for key in reader.keys())
+        print('{}: {} files, {} rows'.format(dir_, len(reader), rows))
+        if args.export:
+            reader.export(args.out_dir)
+
+# end of file
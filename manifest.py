@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# manifest of a conversion in SQLite: what each output was made from.
+#   key: item, relative to the dataset. e.g. split/id
+#   size, mtime_ns, digest: the input. size and mtime_ns are None for an input without a file.
+#   fingerprint: of the label mapping.
+#   output: label file, None if nothing is written. lines of files if more than one.
+#   list_line: image in the list file, '' if not listed.
+# a rerun converts only the items whose input or label mapping has changed, or whose output is missing.
+# lookup() does it all in the calling thread. or, to stat the files on I/O threads, e.g. of prefetch.py:
+#   recorded = items.recorded(key)           # SQLite, in the thread of the manifest
+#   checked = manifest.check(recorded, file) # the input and the output files, on any thread or process
+#   list_line = items.up_to_date(key, checked) if checked else None
+
+import os
+import hashlib
+import sqlite3
+import tempfile
+import contextlib
+import metrics
+
+# records per commit. a crash loses at most this many records, and those items are converted again.
+commit_interval = 10000
+
+def digest(data):
+    return hashlib.sha1(data.encode() if isinstance(data, str) else data).hexdigest()
+
+# input file -> ( size, mtime_ns, digest )
+def stamp(file, data=None):
+    st = os.stat(file)
+    if data is None:
+        with open(file, 'rb') as f:
+            data = f.read()
+    return ( st.st_size, st.st_mtime_ns, digest(data), )
+
+# output of the manifest -> files
+def _outputs(output):
+    return output.split('\n') if output else ()
+
+# list files are replaced when completed.
+# buffering: bytes, e.g. sink.buffer_size. -1 for the default.
+@contextlib.contextmanager
+def open_atomic(file, buffering=-1):
+    dir_ = os.path.dirname(file) or '.'
+    with tempfile.NamedTemporaryFile(mode='w', buffering=buffering, newline='\n', delete=False, prefix='tmp.', dir=dir_) as f:
+        try:
+            yield f
+        except:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, file)
+
+# recorded: of Manifest.recorded(), None if not recorded.
+#   file: input file. its digest is calculated only when its size or mtime has changed.
+#   digest_: digest of the input without a file.
+# -> ( list line, output, stamp of the input if touched or None ) when the item is up to date,
+#    to be given to Manifest.up_to_date(). None if it has to be converted.
+def check(recorded, file=None, digest_=None):
+    if recorded is None:
+        return None
+    size, mtime_ns, recorded_digest, output, list_line, check_output = recorded
+    with metrics.timer('lookup'):
+        if check_output and not all(os.path.exists(f) for f in _outputs(output)):
+            return None
+        touched = None
+        if file is None:
+            if digest_ != recorded_digest:
+                return None
+        else:
+            try:
+                st = os.stat(file)
+            except FileNotFoundError:
+                return None
+            if ( st.st_size, st.st_mtime_ns ) != ( size, mtime_ns ):
+                # touched, or really changed
+                touched = stamp(file)
+                if touched[2] != recorded_digest:
+                    return None
+    return ( list_line, output, touched, )
+
+class Manifest():
+    # resume: False to convert everything again. recorded anyway.
+    # exists: output -> whether it exists, checked by recorded(). e.g. labelstore.Writer.exists
+    #   None: output files, checked by check() with the input.
+    # before_commit: makes the recorded outputs durable. e.g. sink.Sink.flush
+    def __init__(self, file, fingerprint, resume=True, exists=None, before_commit=None):
+        os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+        self._db = sqlite3.connect(file)
+        self._db.execute('CREATE TABLE IF NOT EXISTS items ('
+                         'key TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT,'
+                         'fingerprint TEXT, output TEXT, list_line TEXT)')
+        self._fingerprint = fingerprint
+        self._resume = resume
+        self._exists = exists
+        self._before_commit = before_commit
+        self._seen = set()
+        self._uncommitted = 0
+        self.n_up_to_date = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._commit()
+        except:
+            # the outputs of the records may not have been written.
+            self._db.rollback()
+            raise
+        finally:
+            self._db.close()
+
+    def _commit(self):
+        if self._before_commit:
+            self._before_commit()
+        self._db.commit()
+        self._uncommitted = 0
+
+    def _see(self, key, output):
+        if key in self._seen:
+            raise FileExistsError('{} appears again: {}'.format(key, output))
+        self._seen.add(key)
+
+    # -> recorded list line when the item is up to date, None if it has to be converted.
+    #   file, digest_: as of check().
+    def lookup(self, key, file=None, digest_=None):
+        checked = check(self.recorded(key), file, digest_)
+        return None if checked is None else self.up_to_date(key, checked)
+
+    # -> what the manifest has of the item, to be given to check(). None if it has to be converted.
+    # no file is read, but by exists.
+    def recorded(self, key):
+        if not self._resume:
+            return None
+        with metrics.timer('lookup'):
+            row = self._db.execute('SELECT size, mtime_ns, digest, fingerprint, output, list_line FROM items WHERE key = ?',
+                                   ( key, )).fetchone()
+            if row is None:
+                return None
+            size, mtime_ns, recorded_digest, fingerprint, output, list_line = row
+            if fingerprint != self._fingerprint:
+                return None
+            if self._exists is not None and not all(self._exists(f) for f in _outputs(output)):
+                return None
+        return ( size, mtime_ns, recorded_digest, output, list_line, self._exists is None, )
+
+    # checked: of check(), not None.
+    # -> recorded list line
+    def up_to_date(self, key, checked):
+        list_line, output, touched = checked
+        if touched:
+            size, mtime_ns, _ = touched
+            self._db.execute('UPDATE items SET size = ?, mtime_ns = ? WHERE key = ?', ( size, mtime_ns, key, ))
+        self._see(key, output)
+        self.n_up_to_date += 1
+        metrics.count('up_to_date')
+        return list_line
+
+    # stamp_: ( size, mtime_ns, digest ) of the input.
+    # output: file, files, or None.
+    def record(self, key, stamp_, output, list_line):
+        if isinstance(output, (tuple, list)):
+            output = '\n'.join(output)
+        self._see(key, output)
+        metrics.count('converted')
+        self._db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         ( key, *stamp_, self._fingerprint, output, list_line or '', ))
+        self._uncommitted += 1
+        if commit_interval <= self._uncommitted:
+            self._commit()
+
+# end of file
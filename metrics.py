@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# run metrics of the converters: seconds and calls per stage, counters, throughput.
+# off unless a session has a file, e.g. by --metrics. then written as JSON at the end,
+# and replaced by a snapshot every snapshot_interval seconds while running.
+#   with metrics.timer('parse'): ...
+#   metrics.count('boxes', n)
+# a worker process sends take() back with its results, and the parent merge()s it.
+# a pool enables the metrics of its workers, whatever the start method:
+#   multiprocessing.Pool(jobs, metrics.init_worker, ( metrics.enabled(), ))
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import contextlib
+
+# seconds between the snapshots, None for the final one only.
+snapshot_interval = 60
+
+_enabled = False
+# of the process which writes the file.
+_pid = None
+_file = None
+_name = None
+_started = None
+_snapshot_at = None
+_lock = threading.Lock()
+# stage -> [ seconds, calls ]
+_stages = {}
+# name -> count
+_counters = {}
+
+def add_argument(parser):
+    parser.add_argument('--metrics', metavar='JSON',
+                        help='write the run metrics to the file: seconds per stage, counters and throughput.')
+
+def enabled():
+    return _enabled
+
+def add_time(stage, seconds, calls=1):
+    with _lock:
+        t = _stages.setdefault(stage, [ 0.0, 0 ])
+        t[0] += seconds
+        t[1] += calls
+
+@contextlib.contextmanager
+def timer(stage):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, time.perf_counter() - start)
+
+# -> the items of the iterable. each next() is timed as the stage.
+def timed(stage, iterable):
+    it = iter(iterable)
+    while True:
+        with timer(stage):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    if _snapshot_at is not None and _snapshot_at <= time.monotonic():
+        snapshot()
+
+# -> the metrics since the last take(), reset. to be merge()d into the parent process.
+def take():
+    global _stages, _counters
+    with _lock:
+        taken = ( _stages, _counters, )
+        _stages = {}
+        _counters = {}
+    return taken
+
+# initializer of the worker processes: metrics on as in the parent, nothing counted yet.
+def init_worker(enabled_):
+    global _enabled, _snapshot_at
+    _enabled = enabled_
+    # only the parent writes snapshots.
+    _snapshot_at = None
+    take()
+
+def merge(taken):
+    stages, counters = taken
+    with _lock:
+        for stage, ( seconds, calls ) in stages.items():
+            t = _stages.setdefault(stage, [ 0.0, 0 ])
+            t[0] += seconds
+            t[1] += calls
+        for name, n in counters.items():
+            _counters[name] = _counters.get(name, 0) + n
+
+def report(final=True, error=None):
+    elapsed = time.monotonic() - _started
+    with _lock:
+        stages = { stage: { 'seconds': seconds, 'calls': calls,
+                            'per_second': calls / seconds if seconds else None, }
+                   for stage, ( seconds, calls ) in sorted(_stages.items()) }
+        counters = dict(sorted(_counters.items()))
+    return {
+        'name': _name,
+        'argv': sys.argv,
+        'final': final,
+        'error': error,
+        'elapsed': elapsed,
+        # seconds of the stages of the worker processes and threads are summed up: may exceed elapsed.
+        'stages': stages,
+        'counters': counters,
+        'throughput': { name: n / elapsed if elapsed else None for name, n in counters.items() },
+    }
+
+def _write(obj):
+    dir_ = os.path.dirname(_file)
+    if dir_:
+        os.makedirs(dir_, exist_ok=True)
+    with tempfile.NamedTemporaryFile(mode='w', newline='\n', delete=False, prefix='tmp.', dir=dir_ or '.') as f:
+        json.dump(obj, f, indent=1)
+        f.write('\n')
+        temp_file = f.name
+    os.replace(temp_file, _file)
+
+def snapshot():
+    global _snapshot_at
+    if not _enabled or os.getpid() != _pid:
+        return
+    _snapshot_at = time.monotonic() + snapshot_interval if snapshot_interval else None
+    _write(report(final=False))
+
+# file: JSON, None for off.
+@contextlib.contextmanager
+def session(file, name=None):
+    global _enabled, _pid, _file, _name, _started, _snapshot_at
+    if not file:
+        yield
+        return
+    _enabled = True
+    _pid = os.getpid()
+    _file = file
+    _name = name or os.path.basename(sys.argv[0])
+    _started = time.monotonic()
+    # nothing of a former session.
+    take()
+    _snapshot_at = _started + snapshot_interval if snapshot_interval else None
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _write(report(error=error))
+        _enabled = False
+        print('metrics: {}'.format(file))
+
+# end of file
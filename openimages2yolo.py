@@ -8,55 +8,190 @@
 import os
 import pathlib
 import contextlib
+import argparse
+import numpy as np
 import pandas as pd
-import csv
-from bbox import BBox
+from bbox import BBox, BBoxArray
+from imageindex import ImageIndex
+import manifest
+import labelstore
+import sink
+import metrics
 use_mapping=False
+# ( label mapping, output directory ) per target.
+# the annotations are read once for all the targets.
+targets = []
 if not use_mapping:
     from label_default import OpenImagesLabelNames
-    OpenImagesLabelNames.init('/data/huge/OpenImages/labels/class-descriptions-boxable.csv')
-    assert 0 <= OpenImagesLabelNames.label_index('/m/0bt9lr')
-    OUT_dir = '/data/huge/OpenImages/yolo'
-elif True:
-    from label_chihuahua import ChihuahuaOpenImagesLabelNames as OpenImagesLabelNames
-    OpenImagesLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', '/data/huge/OpenImages/labels/class-descriptions-boxable.csv')
-    assert '/m/0bt9lr' in OpenImagesLabelNames.label_names()
-    assert 0 <= OpenImagesLabelNames.label_index_src('/m/0bt9lr')
-    assert 0 == OpenImagesLabelNames.label_index_dst('dog')
-    OUT_dir = '/data/work/dog/00input-chihuahua'
+    labels = OpenImagesLabelNames.init('/data/huge/OpenImages/labels/class-descriptions-boxable.csv')
+    assert 0 <= labels.label_index('/m/0bt9lr')
+    targets.append(( labels, '/data/huge/OpenImages/yolo', ))
 else:
-    from label_dog import DogOpenImagesLabelNames as OpenImagesLabelNames
-    OpenImagesLabelNames.init('/data/work/dog/00input-dog/dog.txt', '/data/huge/OpenImages/labels/class-descriptions-boxable.csv')
-    assert '/m/0bt9lr' in OpenImagesLabelNames.label_names()
-    assert 0 == OpenImagesLabelNames.label_index('/m/0bt9lr')
-    assert 0 <= OpenImagesLabelNames.label_index_src('/m/0bt9lr')
-    assert 0 == OpenImagesLabelNames.label_index_dst('dog')
-    OUT_dir = '/data/work/dog/00input-dog'
-resume=False
-
-def write_lines(flist, OUT_dir, NAME, split, image_id, lines):
-    global use_mapping, resume
-
-    img_stem = os.path.join('images', NAME, split, image_id)
-    img = None
-    for ext in ( '.jpg', '.png', '.JPEG' ):
-        if os.path.isfile(os.path.join(OUT_dir, img_stem + ext)):
-            img = img_stem + ext
-            break
-    if not img: raise FileNotFoundError(img_stem)
-    img = pathlib.PurePath(img).as_posix()
+    if True:
+        from label_chihuahua import ChihuahuaOpenImagesLabelNames
+        labels = ChihuahuaOpenImagesLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', '/data/huge/OpenImages/labels/class-descriptions-boxable.csv')
+        assert '/m/0bt9lr' in labels.label_names()
+        assert 0 <= labels.label_index_src('/m/0bt9lr')
+        assert 0 == labels.label_index_dst('dog')
+        targets.append(( labels, '/data/work/dog/00input-chihuahua', ))
+    if False:
+        from label_dog import DogOpenImagesLabelNames
+        labels = DogOpenImagesLabelNames.init('/data/work/dog/00input-dog/dog.txt', '/data/huge/OpenImages/labels/class-descriptions-boxable.csv')
+        assert '/m/0bt9lr' in labels.label_names()
+        assert 0 == labels.label_index('/m/0bt9lr')
+        assert 0 <= labels.label_index_src('/m/0bt9lr')
+        assert 0 == labels.label_index_dst('dog')
+        targets.append(( labels, '/data/work/dog/00input-dog', ))
+# skip the items which the manifest says are up to date. False to convert all again.
+resume=True
+# labels into packed directories of labelstore.py, one per split, instead of a file per image.
+packed=False
+# label files written by background I/O threads of sink.py, 0 to write them in the main thread.
+io_threads=1
+# rows per read_csv() chunk. memory is bounded by this and the largest ImageID group.
+chunksize=1000000
+
+#ImageID,Source,LabelName,Confidence,XMin,XMax,YMin,YMax,IsOccluded,IsTruncated,IsGroupOf,IsDepiction,IsInside
+_bbox_columns = ( 'ImageID', 'LabelName', 'XMin', 'XMax', 'YMin', 'YMax', )
+_bbox_dtypes = { 'ImageID': str, 'LabelName': str,
+                 'XMin': np.float64, 'XMax': np.float64, 'YMin': np.float64, 'YMax': np.float64, }
+
+def read_chunks(file, chunksize):
+    # yields DataFrames of whole ImageID groups. rows must be grouped by ImageID,
+    # and a group split by read_csv() is carried over to the next chunk.
+    # round_trip: same float values as float() of csv.DictReader.
+    tail = None
+    for chunk in metrics.timed('read', pd.read_csv(file, usecols=_bbox_columns, dtype=_bbox_dtypes, chunksize=chunksize,
+                                                   float_precision='round_trip', keep_default_na=False)):
+        if tail is not None:
+            chunk = pd.concat(( tail, chunk ), ignore_index=True)
+        ids = chunk['ImageID'].to_numpy()
+        bounds = np.flatnonzero(ids[1:] != ids[:-1])
+        if not len(bounds):
+            tail = chunk
+            continue
+        tail = chunk.iloc[bounds[-1] + 1:]
+        yield chunk.iloc[:bounds[-1] + 1]
+    if tail is not None and len(tail):
+        yield tail
+
+def pair_keys(image_ids, label_names):
+    # (ImageID, LabelName) -> one fixed width string, to be searched by np.searchsorted().
+    return np.char.add(np.char.add(np.asarray(image_ids, dtype=str), ','), np.asarray(label_names, dtype=str))
+
+def read_nonverified(file, label_names):
+    #ImageID,Source,LabelName,Confidence
+    #000002b66c9c498e,verification,/m/014j1m,0
+    conf = pd.read_csv(file, usecols=( 'ImageID', 'Source', 'LabelName', 'Confidence', ),
+                       dtype={ 'ImageID': str, 'Source': str, 'LabelName': str, 'Confidence': np.float64, })
+    print('confidence sources: {}'.format(conf['Source'].unique()))
+    conf = conf.loc[(conf['Confidence']==0) & (conf['LabelName'].isin(label_names))]
+    # sorted and unique
+    return np.unique(pair_keys(conf['ImageID'].to_numpy(), conf['LabelName'].to_numpy()))
+
+def is_nonverified(nonverified_keys, keys):
+    if not len(nonverified_keys) or not len(keys):
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.searchsorted(nonverified_keys, keys)
+    pos[len(nonverified_keys) <= pos] = 0
+    return nonverified_keys[pos] == keys
+
+# outs: ( label mapping, list file, manifest, labelstore.Writer or sink.Sink, output directory ) per target.
+# the bboxes kept by any of the targets are converted once.
+# -> number of the images written or up to date
+def convert_chunk(outs, images, NAME, split, chunk, nonverified_keys):
+    global _min_xmin, _min_ymin, _max_xmax, _max_ymax
+
+    ids = chunk['ImageID'].to_numpy()
+    label_names = chunk['LabelName'].to_numpy()
+    with metrics.timer('map'):
+        tables = []
+        keeps = []
+        negatives = []
+        for labels, _, _, _, _ in outs:
+            table = labels.label_index_many(label_names)
+            skip = labels.DISCARD == table[:, 0]
+            negative = labels.NEGATIVE == table[:, 0]
+            if skip.any() or negative.any():
+                assert use_mapping
+            if skip.any():
+                print('Skipping {}:{} rows'.format(split, np.count_nonzero(skip)))
+            metrics.count('discarded', np.count_nonzero(skip))
+            metrics.count('negatives', np.count_nonzero(negative))
+            tables.append(table)
+            keeps.append(~skip & ~negative)
+            negatives.append(negative)
+        keep_any = np.logical_or.reduce(keeps)
+        if nonverified_keys is not None and len(nonverified_keys):
+            # a negative verification drops the boxes of that label only.
+            nonveri = np.zeros(len(ids), dtype=bool)
+            nonveri[keep_any] = is_nonverified(nonverified_keys, pair_keys(ids[keep_any], label_names[keep_any]))
+            for keep in keeps:
+                if ( nonveri & keep ).any():
+                    print('Not verified {}:{} rows'.format(split, np.count_nonzero(nonveri & keep)))
+                    metrics.count('nonverified', np.count_nonzero(nonveri & keep))
+                    keep &= ~nonveri
+            keep_any &= ~nonveri
+
+    yolo_all = None
+    if keep_any.any():
+        with metrics.timer('bbox'):
+            bboxes = BBoxArray(type_=BBox.OPEN_IMAGES,
+                               bbox=chunk.loc[keep_any, ['XMin', 'YMin', 'XMax', 'YMax']].to_numpy())
+            yolo = bboxes.get(type_=BBox.YOLO)
+        xmin, ymin, xmax, ymax = bboxes.get(type_=BBox.OPEN_IMAGES).T
+        _min_xmin = min(_min_xmin, xmin.min().item())
+        _min_ymin = min(_min_ymin, ymin.min().item())
+        _max_xmax = max(_max_xmax, xmax.max().item())
+        _max_ymax = max(_max_ymax, ymax.max().item())
+        yolo_all = np.zeros(( len(ids), yolo.shape[1], ), dtype=yolo.dtype)
+        yolo_all[keep_any] = yolo
+
+    n_images = 0
+    starts = np.r_[0, np.flatnonzero(ids[1:] != ids[:-1]) + 1]
+    ends = np.r_[starts[1:], len(ids)]
+    for ( _, fo, items, writer, OUT_dir ), table, keep, negative in zip(outs, tables, keeps, negatives):
+        use_for_negative = np.logical_or.reduceat(negative, starts)
+        # one line per (kept row, dst index): lines of rows [start, end) are lines[line_before[start]:line_before[end]]
+        n_lines = np.where(keep, np.count_nonzero(table >= 0, axis=1), 0)
+        line_before = np.r_[0, np.cumsum(n_lines)].tolist()
+
+        lines = []
+        if keep.any():
+            with metrics.timer('map'):
+                kept_table = table[keep]
+                rows, cols = np.nonzero(0 <= kept_table)
+                yolo = yolo_all[keep][rows].tolist()
+                for li, bbox in zip(kept_table[rows, cols].tolist(), yolo):
+                    lines.append('{} {:1.7f} {:1.7f} {:1.7f} {:1.7f}\n'.format(li, *bbox))
+        metrics.count('boxes', len(lines))
+
+        for start, end, neg in zip(starts.tolist(), ends.tolist(), use_for_negative.tolist()):
+            l0, l1 = line_before[start], line_before[end]
+            if not neg and l0 == l1:
+                continue
+            write_lines(fo, images, items, writer, OUT_dir, NAME, split, ids[start], lines[l0:l1])
+            n_images += 1
+    return n_images
+
+# writer: labelstore.Writer or sink.Sink
+def write_lines(flist, images, items, writer, OUT_dir, NAME, split, image_id, lines):
+    # the rows of an image are not a file: the lines made from them are the input of the manifest.
+    key = split + '/' + image_id
+    digest = manifest.digest(''.join(lines))
+    done = items.lookup(key, digest_=digest)
+    if done is not None:
+        flist.write('{}\n'.format(done))
+        metrics.count('images')
+        return
+    img = images.find(os.path.join(split, image_id), ( '.jpg', '.png', '.JPEG' ))
+    if not img: raise FileNotFoundError(os.path.join('images', NAME, split, image_id))
+    img = pathlib.PurePath(os.path.join('images', NAME, img)).as_posix()
     flist.write('{}\n'.format(img))
+    metrics.count('images')
     yolo = os.path.join(OUT_dir, 'labels', NAME, split, image_id + '.txt')
-    if os.path.exists(yolo):
-        if resume: return
-        raise FileExistsError(yolo)
-    with open(yolo, 'w', newline='\n') as f:
-        for line in lines:
-            f.write(line)
-    if use_mapping:
-        print('Written: {}'.format(yolo))
-    else:
-        print('.', end='', flush=True)
+    writer.write(yolo, lines)
+    items.record(key, ( None, None, digest, ), yolo, img)
 
 _min_xmin = 9999999999
 _min_ymin = 9999999999
@@ -64,7 +199,7 @@ _max_xmax = 0
 _max_ymax = 0
 
 def main():
-    global _min_xmin, _min_ymin, _max_xmax, _max_ymax, OUT_dir
+    global _min_xmin, _min_ymin, _max_xmax, _max_ymax
 
     #####
     # input
@@ -76,82 +211,52 @@ def main():
     # output
     NAME='openimages'
 
-    for d in ( 'images', 'labels', 'lists' ):
-        if not os.path.exists(os.path.join(OUT_dir, d)):
-            os.makedirs(os.path.join(OUT_dir, d), exist_ok=True)
-    if not os.path.exists(os.path.join(OUT_dir, 'images', NAME)):
-        os.symlink(os.path.join(OpenImages_dir, 'images'), os.path.join(OUT_dir, 'images', NAME))
-    ignore_image_ids = {}
-    for split in splits:
-        os.makedirs(os.path.join(OUT_dir, 'labels', NAME, split), exist_ok=True)
-        if use_mapping:
-            #ImageID,Source,LabelName,Confidence
-            #000002b66c9c498e,verification,/m/014j1m,0
-            conf = pd.read_csv(os.path.join(OpenImages_dir, files[1].format(split)))
-            print('confidence sources: {}'.format(conf['Source'].unique()))
-            ids = conf.loc[(conf['Confidence']==0) & (conf['LabelName'].isin(OpenImagesLabelNames.label_names())), 'ImageID'].values.reshape(-1)
-            ignore_image_ids[split] = ids
-            print('Ignoring ids({}):{}'.format(split, ids))
+    for _, OUT_dir in targets:
+        for d in ( 'images', 'labels', 'lists' ):
+            if not os.path.exists(os.path.join(OUT_dir, d)):
+                os.makedirs(os.path.join(OUT_dir, d), exist_ok=True)
+        if not os.path.exists(os.path.join(OUT_dir, 'images', NAME)):
+            os.symlink(os.path.join(OpenImages_dir, 'images'), os.path.join(OUT_dir, 'images', NAME))
+        for split in splits:
+            os.makedirs(os.path.join(OUT_dir, 'labels', NAME, split), exist_ok=True)
+    nonverified_keys = {}
+    if use_mapping:
+        # the source labels are the same for all the targets.
+        label_names = sorted(set().union(*( labels.label_names() for labels, _ in targets )))
+        for split in splits:
+            keys = read_nonverified(os.path.join(OpenImages_dir, files[1].format(split)), label_names)
+            nonverified_keys[split] = keys
+            print('Ignoring (ImageID,LabelName)({}):{}'.format(split, keys))
 
     # create labels and lists
-    with open(os.path.join(OUT_dir, 'lists', NAME + '.txt'), 'w') if use_mapping else contextlib.nullcontext() as fom:
+    with contextlib.ExitStack() as stack:
+        out = stack.enter_context(sink.Sink(io_threads))
+        fom = [ stack.enter_context(manifest.open_atomic(os.path.join(OUT_dir, 'lists', NAME + '.txt'), sink.buffer_size))
+                for _, OUT_dir in targets ] if use_mapping else None
+        writers = [ stack.enter_context(labelstore.Writer([ os.path.join(OUT_dir, 'labels', NAME, split) for split in splits ], resume))
+                    if packed else None for _, OUT_dir in targets ]
+        items = [ stack.enter_context(manifest.Manifest(os.path.join(OUT_dir, 'cache', 'manifest-' + NAME + '.sqlite'), labels.fingerprint(), resume,
+                                                        writer.exists if writer else None, out.flush))
+                  for ( labels, OUT_dir ), writer in zip(targets, writers) ]
+        progress = sink.Progress(NAME)
+        # the images are the same for all the targets.
+        OUT_dir = targets[0][1]
+        images = stack.enter_context(ImageIndex(os.path.join(OUT_dir, 'images', NAME), os.path.join(OUT_dir, 'cache', 'images-' + NAME + '.pickle')))
         for split in splits:
-            prev_skip = ''
-            prev_nonveri = ''
             file = os.path.join(OpenImages_dir, files[0].format(split))
-            with open(file, 'r') as fi, \
-              contextlib.nullcontext() if use_mapping else open(os.path.join(OUT_dir, 'lists', split + '.txt'), 'w') as fos:
-                fo = fom if use_mapping else fos
-                #ImageID,Source,LabelName,Confidence,XMin,XMax,YMin,YMax,IsOccluded,IsTruncated,IsGroupOf,IsDepiction,IsInside
-                #000026e7ee790996,freeform,/m/07j7r,1,0.071905,0.145346,0.206591,0.391306,0,1,1,0,0
-                lines = []
-                lines_id = ''
-                use_for_negative = False
-                for row in csv.DictReader(fi):
-                    if (use_for_negative or lines) and lines_id != row['ImageID']:
-                        write_lines(fo, OUT_dir, NAME, split, lines_id, lines)
-                        lines = []
-                        lines_id = ''
-                        use_for_negative = False
-                    try:
-                        label_index = OpenImagesLabelNames.label_index(row['LabelName'])
-                    except:
-                        assert use_mapping
-                        if prev_skip != row['ImageID'][:2]:
-                            prev_skip = row['ImageID'][:2]
-                            print('Skipping {}:{}...'.format(split, prev_skip))
-                        continue
-                    if not isinstance(label_index, (tuple, list)) and 0 > label_index:
-                        assert use_mapping
-                        use_for_negative = True
-                        lines_id = row['ImageID']
-                        continue
-                    if ignore_image_ids and row['ImageID'] in ignore_image_ids[split]:
-                        if prev_nonveri != row['ImageID'][:2]:
-                            prev_nonveri = row['ImageID'][:2]
-                            print('Not verified {}:{}...'.format(split, prev_nonveri))
-                        continue
-
-                    bbox = BBox(type_=BBox.OPEN_IMAGES, bbox=(float(row['XMin']), float(row['YMin']), float(row['XMax']), float(row['YMax'])))
-                    xmin, ymin, xmax, ymax = bbox.get(type_=BBox.OPEN_IMAGES)
-                    if  _min_xmin > xmin:
-                        _min_xmin = xmin
-                    if  _min_ymin > ymin:
-                        _min_ymin = ymin
-                    if  _max_xmax < xmax:
-                        _max_xmax = xmax
-                    if  _max_ymax < ymax:
-                        _max_ymax = ymax
-                    for li in label_index if isinstance(label_index, (tuple, list)) else ( label_index, ):
-                        line = '{} {:1.7f} {:1.7f} {:1.7f} {:1.7f}\n'.format(li, *bbox.get(type_=BBox.YOLO))
-                        lines.append(line)
-                    assert '' == lines_id or row['ImageID'] == lines_id, '{}, {}'.format(row['ImageID'], lines_id)
-                    lines_id = row['ImageID']
-
-                if use_for_negative or lines:
-                    write_lines(fo, OUT_dir, NAME, split, lines_id, lines)
+            with contextlib.ExitStack() as split_stack:
+                fo = fom if use_mapping else [ split_stack.enter_context(manifest.open_atomic(os.path.join(OUT_dir, 'lists', split + '.txt'), sink.buffer_size))
+                                               for _, OUT_dir in targets ]
+                outs = [ ( labels, fo_, items_, writer or out, OUT_dir, ) for ( labels, OUT_dir ), fo_, items_, writer in zip(targets, fo, items, writers) ]
+                for chunk in read_chunks(file, chunksize):
+                    progress.update(split, convert_chunk(outs, images, NAME, split, chunk, nonverified_keys.get(split)))
+                # the list files of the split are replaced after its label files are written.
+                out.flush()
+        progress.done()
 
     print('')
+    for items_, ( _, OUT_dir ) in zip(items, targets):
+        print('up to date: {}: {}'.format(OUT_dir, items_.n_up_to_date))
     print('min xmin: {:f}'.format(_min_xmin))
     print('min ymin: {:f}'.format(_min_ymin))
     print('max xmax: {:f}'.format(_max_xmax))
@@ -161,6 +266,10 @@ def main():
 # =============================================================================
 
 if __name__=='__main__':
-    main()
+    parser = argparse.ArgumentParser(description='convert OpenImages annotations to yolo.')
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    with metrics.session(args.metrics):
+        main()
 
 # end of file
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# ordered map on I/O threads: many reads in flight, where the latency per file dominates. e.g. NFS.
+# the results come in the order of the inputs, so the parse and the outputs after it stay as they were.
+# the inputs are taken from the iterable in the caller thread, at most in_flight ahead of the results.
+
+import collections
+import concurrent.futures
+
+# I/O threads, 0 to read in the caller thread.
+threads = 8
+# items submitted and not yet taken as results
+in_flight = 64
+
+def imap(func, iterable, threads_=None, in_flight_=None):
+    threads_ = threads if threads_ is None else threads_
+    in_flight_ = in_flight if in_flight_ is None else in_flight_
+    if threads_ <= 0 or in_flight_ <= 1:
+        yield from map(func, iterable)
+        return
+    with concurrent.futures.ThreadPoolExecutor(threads_) as executor:
+        pending = collections.deque()
+        for args in iterable:
+            pending.append(executor.submit(func, args))
+            if in_flight_ <= len(pending):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# end of file
@@ -5,15 +5,39 @@
 # Copyright (c) 2019 Fumiyuki Shimizu
 # MIT License: https://opensource.org/licenses/MIT
 import os
+import sys
+import socket
+import struct
 import contextlib
 import pathlib
 import tempfile
 import math
 import random
+import shutil
+import argparse
+import subprocess
+import collections
+import multiprocessing
 import numpy as np
 import cv2
-from bbox import BBox
-#random.seed(42)
+from bbox import BBox, BBoxArray
+import imagesize
+import background as background_
+import labelstore
+import metrics
+
+# base of the per image seeds. None: chosen at random, and printed.
+seed = None
+# images in flight per worker of --jobs
+window_per_job = 4
+# flips and right angle turns only: no jitter of the angle and the scale, and no free rotation.
+# the images are flipped and turned exactly, and JPEG losslessly by jpegtran if found.
+exact = False
+jpegtran = shutil.which('jpegtran')
+
+MODE_REPLACE_FILE = 0
+MODE_RENAME_NEW_DIR = 1
+MODE_RENAME_ORIG_RENAME_NEW_DIR = 2
 
 class BBoxes():
     BACKGROUND_RANDOM = -1
@@ -54,14 +78,18 @@ class BBoxes():
               ( -b, a, - ymin ), ))
         return M, ( 1 + math.ceil(n_h_1), 1 + math.ceil(n_w_1) )
 
-    def __init__(self, *, image=None, bboxes=None):
-        self._image = cv2.imread(image)
-        assert self._image is not None, image
-        if image:
+    # image: file, or decoded image with its image_ext.
+    # bboxes: BBoxArray of the boxes of the image, without its size.
+    def __init__(self, *, image=None, image_ext=None, bboxes=None):
+        if isinstance(image, np.ndarray):
+            self._image = image
+            self._image_ext = image_ext
+        else:
+            self._image = cv2.imread(image)
+            assert self._image is not None, image
             _, self._image_ext = os.path.splitext(image)
         self._bboxes = bboxes
-        for bbox in bboxes:
-            bbox.set_size(hw=self._image.shape[:2])
+        bboxes.set_size(hw=self._image.shape[:2])
 
     @property
     def image(self):
@@ -77,56 +105,204 @@ class BBoxes():
 
     def h_flip(self):
         self._image = cv2.flip(self._image, 1)
-        for bbox in self._bboxes:
-            bbox.h_flip()
+        self._bboxes.h_flip()
 
     def v_flip(self):
         self._image = cv2.flip(self._image, 0)
-        for bbox in self._bboxes:
-            bbox.v_flip()
-
-    def rotate(self, rad, scale, interpolation, background):
-        M, hw =  BBoxes.matrixRotate(self._image.shape[:2], rad, scale)
+        self._bboxes.v_flip()
+
+    # one warpAffine of the image and one of the boxes, for all the ops of the plan.
+    # a plan of flips and right angle turns only is done exactly, without interpolation nor background.
+    def warp(self, plan, interpolation, background):
+        op = plan.exact()
+        if op is not None:
+            self.exact(op)
+            return
+        M, hw = plan.matrix, plan.hw
         c = self._image.shape[2] if len(self._image.shape) > 2 else 1
+        # only the border which the image does not cover.
+        hwc_back = background_.zeros(hw, self._image)
+        spans = background_.uncovered(M, self._image.shape[:2], hw)
         if background == BBoxes.BACKGROUND_RANDOM:
-            hwc_back = np.random.randint(0, 256, (hw[0], hw[1], c), np.uint8)
+            background_.noise(hwc_back, spans)
+        elif background == BBoxes.BACKGROUND_RANDOM_PLAIN:
+            v = []
+            for _ in range(c):
+                v.append(random.randrange(0, 256))
+            background_.plain(hwc_back, spans, v)
         else:
-            hwc_back = np.zeros((hw[0], hw[1], 3), np.uint8)
-            if background == BBoxes.BACKGROUND_RANDOM_PLAIN:
-                v = []
-                for _ in range(c):
-                    v.append(random.randrange(0, 256))
-                hwc_back[:] = v[0] if 1 == c else v
-            elif background:
-                hwc_back[:] = background
+            background_.plain(hwc_back, spans, background or 0)
         self._image = cv2.warpAffine(self._image, M, hw[::-1], hwc_back,
                                      flags=interpolation, borderMode=cv2.BORDER_TRANSPARENT)
-        for bbox in self._bboxes:
-            bbox.warpAffine(M, hw[::-1])
+        self._bboxes.warpAffine(M, hw[::-1])
+
+    # op: AugPlan.exact()
+    def exact(self, op):
+        image_op, _ = _EXACT_OPS[op]
+        if image_op:
+            self._image = image_op(self._image)
+        exact_bboxes(self._bboxes, op)
+
+    # interpolation and background at random.
+    def warp_random(self, plan):
+        self.warp(plan,
+                  interpolation=random.choice(BBoxes.interps),
+                  background=random.choice(( BBoxes.BACKGROUND_RANDOM, BBoxes.BACKGROUND_RANDOM_PLAIN )))
+
+    def plan(self):
+        return AugPlan(self._image.shape[:2])
+
+    def rotate(self, rad, scale, interpolation, background):
+        self.warp(self.plan().rotate(rad, scale), interpolation, background)
 
     def rotate_random(self, jitter_scale=.3):
-        self.rotate(random.uniform(0, 2 * math.pi),
-                    scale=1 + random.uniform(-jitter_scale, jitter_scale),
-                    interpolation=random.choice(BBoxes.interps),
-                    background=random.choice(( BBoxes.BACKGROUND_RANDOM, BBoxes.BACKGROUND_RANDOM_PLAIN )))
+        self.warp_random(self.plan().rotate_random(jitter_scale))
 
     def rotate_random90(self, right_angle, jitter_degree=5, jitter_scale=.3):
-        jitter_rad = math.pi * jitter_degree / 180
-        self.rotate(right_angle * math.pi / 2 + random.uniform(-jitter_rad, jitter_rad),
-                    scale=1 + random.uniform(-jitter_scale, jitter_scale),
-                    interpolation=random.choice(BBoxes.interps),
-                    background=random.choice(( BBoxes.BACKGROUND_RANDOM, BBoxes.BACKGROUND_RANDOM_PLAIN )))
+        self.warp_random(self.plan().rotate_random90(right_angle, jitter_degree, jitter_scale))
 
     def draw(self, bgr=(255, 255, 0), px=5):
-        rc = self._image
-        for bbox in self._bboxes:
-            rc = bbox.draw(rc, bgr=bgr, px=px)
+        rc = np.copy(self._image)
+        for xmin, ymin, xmax, ymax in self._bboxes.get(BBox.ILSVRC).astype(int).tolist():
+            cv2.rectangle(rc, ( xmin, ymin ), ( xmax, ymax ), bgr, px)
         return rc
 
+# ops on an image of hw, composed into one 2x3 affine matrix: the image is resampled once, and the boxes moved once.
+# each op maps the image the ops so far make, and sets the size of the image it makes.
+#   BBoxes.warp(AugPlan(hw).h_flip().rotate(rad, scale), interpolation, background)
+# a new op is a matrix and a size given to affine().
+class AugPlan():
+    def __init__(self, hw):
+        self._M = np.eye(3)
+        self._hw0 = tuple(hw[:2])
+        self._hw = self._hw0
+
+    # 2x3
+    @property
+    def matrix(self):
+        return self._M[:2]
+
+    # of the image made
+    @property
+    def hw(self):
+        return self._hw
+
+    # M: 2x3 of the image made so far -> the image of hw.
+    def affine(self, M, hw):
+        self._M = np.vstack(( M, ( 0, 0, 1 ), )).dot(self._M)
+        self._hw = tuple(hw)
+        return self
+
+    def h_flip(self):
+        h, w = self._hw
+        return self.affine(( ( -1, 0, w-1 ),
+                             (  0, 1,   0 ), ), self._hw)
+
+    def v_flip(self):
+        h, w = self._hw
+        return self.affine(( ( 1,  0,   0 ),
+                             ( 0, -1, h-1 ), ), self._hw)
+
+    # the image made is large enough for all of the rotated image.
+    def rotate(self, rad, scale=1):
+        M, hw = BBoxes.matrixRotate(self._hw, rad, scale)
+        return self.affine(M, hw)
+
+    def scale(self, sx, sy=None):
+        sy = sx if sy is None else sy
+        h, w = self._hw
+        return self.affine(( ( sx,  0, 0 ),
+                             (  0, sy, 0 ), ), ( 1 + math.ceil(sy * (h-1)), 1 + math.ceil(sx * (w-1)) ))
+
+    # hw: of the image made, the same size if None.
+    def translate(self, dx, dy, hw=None):
+        return self.affine(( ( 1, 0, dx ),
+                             ( 0, 1, dy ), ), self._hw if hw is None else hw)
+
+    # -> ( transpose, h_flip, v_flip ) done in this order, if the plan is flips and right angle turns only.
+    # None otherwise. eps: of the matrix, e.g. cos(pi/2).
+    def exact(self, eps=1e-9):
+        A = self._M[:2, :2]
+        R = np.rint(A)
+        if eps < np.abs(A - R).max() or not ( 1 == np.abs(R).sum(axis=0) ).all() or not ( 1 == np.abs(R).sum(axis=1) ).all():
+            return None
+        transpose = 0 != R[0, 1]
+        h, w = self._hw0[::-1] if transpose else self._hw0
+        h_flip = 0 > R[0].sum()
+        v_flip = 0 > R[1].sum()
+        t = ( w-1 if h_flip else 0, h-1 if v_flip else 0, )
+        if eps * (1 + max(h, w)) < np.abs(self._M[:2, 2] - t).max():
+            return None
+        # matrixRotate() may make the image a pixel larger.
+        if not ( 0 <= self._hw[0] - h <= 1 and 0 <= self._hw[1] - w <= 1 ):
+            return None
+        return ( bool(transpose), bool(h_flip), bool(v_flip), )
+
+    def rotate_random(self, jitter_scale=.3):
+        return self.rotate(random.uniform(0, 2 * math.pi),
+                           scale=1 + random.uniform(-jitter_scale, jitter_scale))
+
+    def rotate_random90(self, right_angle, jitter_degree=5, jitter_scale=.3):
+        jitter_rad = math.pi * jitter_degree / 180
+        return self.rotate(right_angle * math.pi / 2 + random.uniform(-jitter_rad, jitter_rad),
+                           scale=1 + random.uniform(-jitter_scale, jitter_scale))
+
+# AugPlan.exact() -> image op or None, jpegtran arguments.
+_EXACT_OPS = {
+    ( False, False, False, ): ( None, [], ),
+    ( False, True,  False, ): ( lambda image: cv2.flip(image, 1), [ '-flip', 'horizontal', ], ),
+    ( False, False, True,  ): ( lambda image: cv2.flip(image, 0), [ '-flip', 'vertical', ], ),
+    ( False, True,  True,  ): ( lambda image: cv2.rotate(image, cv2.ROTATE_180), [ '-rotate', '180', ], ),
+    ( True,  False, False, ): ( cv2.transpose, [ '-transpose', ], ),
+    ( True,  True,  False, ): ( lambda image: cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE), [ '-rotate', '90', ], ),
+    ( True,  False, True,  ): ( lambda image: cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE), [ '-rotate', '270', ], ),
+    ( True,  True,  True,  ): ( lambda image: cv2.flip(cv2.transpose(image), -1), [ '-transverse', ], ),
+}
+
+def exact_bboxes(bboxes, op):
+    transpose, h_flip, v_flip = op
+    if transpose: bboxes.transpose()
+    if h_flip: bboxes.h_flip()
+    if v_flip: bboxes.v_flip()
+
+def _write_yolo(bboxes, fyolo):
+    for label, yolo in zip(bboxes.label.tolist(), bboxes.get(BBox.YOLO).tolist()):
+        fyolo.write('{} {} {} {} {}\n'.format(label, *yolo))
+
 def write_yolo(bboxes, fyolo):
-    for bbox in bboxes.bboxes:
-        yolo = bbox.get(BBox.YOLO)
-        fyolo.write('{} {} {} {} {}\n'.format(bbox.label, *yolo))
+    _write_yolo(bboxes.bboxes, fyolo)
+
+# JPEG -> JPEG by jpegtran: DCT coefficients transposed and flipped, neither decoded nor encoded.
+# bboxes: BBoxArray, sized and done the op already.
+# -> False if jpegtran cannot do it exactly, e.g. the size is not of whole MCU blocks. nothing written then.
+def jpegtran_image_labels(in_image_file, op, bboxes, out_image_file, out_label_file):
+    _, temp_image_file = tempfile.mkstemp(prefix='tmp.', suffix=os.path.splitext(in_image_file)[1],
+                                          dir=os.path.dirname(out_image_file))
+    os.close(_)
+    done = subprocess.run([ jpegtran, '-copy', 'none', '-perfect', *_EXACT_OPS[op][1], '-outfile', temp_image_file, in_image_file ],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if done.returncode:
+        os.remove(temp_image_file)
+        return False
+
+    with tempfile.NamedTemporaryFile(mode='w', newline='\n', delete=False,
+                                     prefix='tmp.', suffix='.txt', dir=os.path.dirname(out_label_file)) as flabel:
+        _write_yolo(bboxes, flabel)
+        temp_label_file = flabel.name
+
+    os.replace(temp_image_file, out_image_file)
+    os.replace(temp_label_file, out_label_file)
+    return True
+
+# whether jpegtran may transform the file as cv2.imread() would see it: no EXIF orientation to apply.
+# -> (height, width) if so, None otherwise.
+def jpegtran_hw(image_file):
+    if not jpegtran or os.path.splitext(image_file)[1].lower() not in ( '.jpg', '.jpeg', ):
+        return None
+    hwo = imagesize.probe_jpeg(image_file)
+    if hwo is None or hwo[2] not in ( None, 1, ):
+        return None
+    return hwo[:2]
 
 def write_image_labels(bboxes, out_image_file, out_label_file):
     if os.path.exists(out_image_file):
@@ -146,7 +322,17 @@ def write_image_labels(bboxes, out_image_file, out_label_file):
         with open(out_label_file, 'w') as flabel:
             write_yolo(bboxes, flabel)
 
-def symlink_image_labels(orig_image_file, orig_label_file, out_image_file, out_label_file):
+# decided by the input, not by orig_label_file: the dirs may be renamed to orig by finish_dirs() later.
+# a label file of the input is linked to, as orig_label_file by then.
+# a packed label directory without the file has nothing to link to: the rows are written instead.
+def link_labels(in_label_file, in_packed, orig_label_file, rows, out_label_file, start):
+    if not in_packed or os.path.exists(in_label_file):
+        os.symlink(os.path.relpath(orig_label_file, start=start), out_label_file)
+    else:
+        with open(out_label_file, 'w', newline='\n') as flabel:
+            flabel.writelines(labelstore.to_lines(rows))
+
+def symlink_image_labels(in_label_file, in_packed, orig_image_file, orig_label_file, rows, out_image_file, out_label_file):
     if os.path.exists(out_image_file):
         _, temp_image_file = tempfile.mkstemp(prefix='tmp.', dir=os.path.dirname(out_image_file))
         os.close(_)
@@ -156,155 +342,416 @@ def symlink_image_labels(orig_image_file, orig_label_file, out_image_file, out_l
         _, temp_label_file = tempfile.mkstemp(prefix='tmp.', dir=os.path.dirname(out_label_file))
         os.close(_)
         os.remove(temp_label_file)
-        os.symlink(os.path.relpath(orig_label_file, start=os.path.dirname(out_label_file)), temp_label_file)
+        link_labels(in_label_file, in_packed, orig_label_file, rows, temp_label_file, os.path.dirname(out_label_file))
 
         os.replace(temp_image_file, out_image_file)
         os.replace(temp_label_file, out_label_file)
     else:
         os.symlink(os.path.relpath(orig_image_file, start=os.path.dirname(out_image_file)), out_image_file)
-        os.symlink(os.path.relpath(orig_label_file, start=os.path.dirname(out_image_file)), out_label_file)
-
-def aug_all(orig_image_dir, orig_label_dir, in_list_file, in_list_file_base, new_image_dir, new_label_dir, out_list_file,
-            h_flip_prob, rotate90_prob):
-    MODE_REPLACE_FILE = 0
-    MODE_RENAME_NEW_DIR = 1
-    MODE_RENAME_ORIG_RENAME_NEW_DIR = 2
-
-    #orig, new   tmp file, replace file
-    #orig        tmp dir, rename tmp->new
-    #      new   tmp dir, rename new->orig, rename tmp->new
-
-    if os.path.exists(orig_image_dir) and os.path.exists(new_image_dir):
-        assert os.path.exists(new_label_dir), new_label_dir
-        assert os.path.exists(orig_label_dir), orig_label_dir
+        link_labels(in_label_file, in_packed, orig_label_file, rows, out_label_file, os.path.dirname(out_image_file))
+
+# the same seeds for the same image of the same variant, whichever worker it runs on.
+def seed_task(base, variant, rel_image_file):
+    random.seed('{}:{}:{}'.format(base, variant, rel_image_file))
+    np.random.seed(random.getrandbits(32))
+
+# the flip and the rotation in one warp. draws from random after seed_task().
+# exact_: the module global exact of the parent process, given in the task: a spawned worker does not inherit it.
+def random_plan(hw, n_bboxes, do_h_flip, do_rotate, exact_):
+    plan = AugPlan(hw)
+    if do_h_flip: plan.h_flip()
+    if do_rotate:
+        if exact_:
+            plan.rotate_random90(random.randrange(4), jitter_degree=0, jitter_scale=0)
+        elif 1 > n_bboxes:
+            plan.rotate_random()
+        else:
+            plan.rotate_random90(random.randrange(4))
+    return plan
+
+# one image -> all the variants. decoded once, if any variant needs it.
+# -> metrics.take() of the image, to be merged by the parent process.
+# rows: labelstore rows of the image, from labelstore.dataset() of the parent process.
+def aug_image(task):
+    ( rel_image_file, in_image_file, in_label_file, in_packed, rows, orig_image_file, orig_label_file,
+      outs, h_flip_prob, rotate90_prob, base_seed, exact_ ) = task
+    print('Processing {}'.format(rel_image_file))
+    try:
+        BBoxArray(type_=BBox.YOLO, bbox=rows['bbox'], label=rows['label'])
+    except:
+        print('Warning: invalid line: {}'.format(rel_image_file))
+        raise
+    image = None
+    hw = None
+    # (height, width) if jpegtran may do the exact ops, None if not. not probed yet if False.
+    jpeg_hw = False
+    for variant, ( out_image_file, out_label_file ) in enumerate(outs):
+        seed_task(base_seed, variant, rel_image_file)
+        os.makedirs(os.path.dirname(out_image_file), exist_ok=True)
+        os.makedirs(os.path.dirname(out_label_file), exist_ok=True)
+        do_h_flip = h_flip_prob   >= random.random()
+        do_rotate = rotate90_prob >= random.random()
+        op = None
+        if do_h_flip or do_rotate:
+            if hw is None:
+                # from the header: the image may never be decoded.
+                hw = imagesize.probe(in_image_file)
+            if hw is None:
+                with metrics.timer('read'):
+                    image = cv2.imread(in_image_file)
+                assert image is not None, in_image_file
+                hw = image.shape[:2]
+            plan = random_plan(hw, len(rows), do_h_flip, do_rotate, exact_)
+            op = plan.exact()
+        if not ( do_h_flip or do_rotate ) or ( False, False, False, ) == op:
+            with metrics.timer('link'):
+                symlink_image_labels(in_label_file, in_packed, orig_image_file, orig_label_file, rows, out_image_file, out_label_file)
+            metrics.count('linked')
+            continue
+        boxes = BBoxArray(type_=BBox.YOLO, bbox=rows['bbox'], label=rows['label'])
+        if op is not None and jpeg_hw is False:
+            jpeg_hw = jpegtran_hw(in_image_file)
+        if op is not None and jpeg_hw == tuple(hw):
+            with metrics.timer('aug'):
+                boxes.set_size(hw)
+                exact_bboxes(boxes, op)
+            with metrics.timer('write'):
+                done = jpegtran_image_labels(in_image_file, op, boxes, out_image_file, out_label_file)
+            if done:
+                metrics.count('lossless')
+                metrics.count('augmented')
+                metrics.count('boxes', len(boxes))
+                continue
+            boxes = BBoxArray(type_=BBox.YOLO, bbox=rows['bbox'], label=rows['label'])
+        if image is None:
+            with metrics.timer('read'):
+                image = cv2.imread(in_image_file)
+            assert image is not None, in_image_file
+            assert tuple(hw) == image.shape[:2], '{}: {}, {}'.format(in_image_file, hw, image.shape[:2])
+        with metrics.timer('aug'):
+            bboxes = BBoxes(image=image, image_ext=os.path.splitext(in_image_file)[1], bboxes=boxes)
+            bboxes.warp_random(plan)
+        with metrics.timer('write'):
+            write_image_labels(bboxes, out_image_file, out_label_file)
+        if op is not None:
+            metrics.count('exact')
+        metrics.count('augmented')
+        metrics.count('boxes', len(bboxes.bboxes))
+    metrics.count('images')
+    return metrics.take()
+
+# ordered results, at most window tasks in flight.
+def imap_bounded(pool, func, iterable, window):
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, ( args, )))
+        if window <= len(pending):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# one image -> a sample of the epoch, as the variant of the same number would be written by aug_image().
+# -> rel_image_file, image, labels (N,), YOLO style BBOX (N, 4), metrics.take()
+def aug_sample(task):
+    rel_image_file, in_image_file, rows, h_flip_prob, rotate90_prob, base_seed, exact_, epoch = task
+    seed_task(base_seed, epoch, rel_image_file)
+    do_h_flip = h_flip_prob   >= random.random()
+    do_rotate = rotate90_prob >= random.random()
+    with metrics.timer('read'):
+        image = cv2.imread(in_image_file)
+    assert image is not None, in_image_file
+    bboxes = BBoxArray(type_=BBox.YOLO, bbox=rows['bbox'], label=rows['label'])
+    if do_h_flip or do_rotate:
+        with metrics.timer('aug'):
+            augmented = BBoxes(image=image, image_ext=os.path.splitext(in_image_file)[1], bboxes=bboxes)
+            augmented.warp_random(random_plan(image.shape[:2], len(rows), do_h_flip, do_rotate, exact_))
+            image = augmented.image
+        metrics.count('augmented')
+    metrics.count('boxes', len(bboxes))
+    return rel_image_file, image, bboxes.label, bboxes.get(BBox.YOLO), metrics.take()
+
+# samples of the list augmented on the fly, instead of written as variants: epochs passes, 0 for endless.
+# in the order of the list, while jobs worker processes make the next ones, at most window_per_job * jobs ahead.
+# -> ( rel_image_file, image, labels (N,), YOLO style BBOX (N, 4) ), ...
+def samples(in_image_dir, in_label_dir, in_list_file, in_list_file_base, h_flip_prob, rotate90_prob, epochs=1, jobs=1):
+    base_seed = seed
+    if base_seed is None:
+        base_seed = random.randrange(2 ** 32)
+    print('Seed: {}'.format(base_seed))
+
+    dataset = labelstore.dataset(in_label_dir)
+    def tasks():
+        epoch = 0
+        while not epochs or epoch < epochs:
+            for rel_image_file, rows in dataset.iter_list(in_list_file, in_list_file_base):
+                yield ( rel_image_file, os.path.join(in_image_dir, rel_image_file), rows,
+                        h_flip_prob, rotate90_prob, base_seed, exact, epoch )
+            epoch += 1
+
+    with multiprocessing.Pool(jobs, metrics.init_worker, ( metrics.enabled(), )) if 1 < jobs else contextlib.nullcontext() as pool:
+        for rel_image_file, image, labels, yolos, taken in \
+              imap_bounded(pool, aug_sample, tasks(), window_per_job * jobs) if pool else map(aug_sample, tasks()):
+            metrics.merge(taken)
+            metrics.count('samples')
+            yield rel_image_file, image, labels, yolos
+
+# a sample on a stream: header, rel_image_file utf-8, image uint8 (h, w, c), labels int32 (N,), YOLO style BBOX float64 (N, 4).
+_SAMPLE_HEADER = struct.Struct('<5I')
+
+def sample_bytes(rel_image_file, image, labels, yolos):
+    rel = rel_image_file.encode()
+    h, w = image.shape[:2]
+    c = image.shape[2] if 2 < image.ndim else 1
+    return b''.join(( _SAMPLE_HEADER.pack(len(rel), h, w, c, len(labels)),
+                      rel,
+                      np.ascontiguousarray(image, dtype=np.uint8).tobytes(),
+                      np.asarray(labels, dtype='<i4').tobytes(),
+                      np.asarray(yolos, dtype='<f8').tobytes(), ))
+
+def write_sample(stream, rel_image_file, image, labels, yolos):
+    stream.write(sample_bytes(rel_image_file, image, labels, yolos))
+
+def _read_exactly(stream, n):
+    data = stream.read(n)
+    assert len(data) == n, 'Truncated sample: {} of {} bytes'.format(len(data), n)
+    return data
+
+# for the reader of the stream, e.g. a training process.
+# -> ( rel_image_file, image, labels (N,), YOLO style BBOX (N, 4) ), ... until the end of the stream.
+def read_samples(stream):
+    while True:
+        header = stream.read(_SAMPLE_HEADER.size)
+        if not header:
+            return
+        assert len(header) == _SAMPLE_HEADER.size, 'Truncated header: {} bytes'.format(len(header))
+        len_rel, h, w, c, n = _SAMPLE_HEADER.unpack(header)
+        rel_image_file = _read_exactly(stream, len_rel).decode()
+        image = np.frombuffer(_read_exactly(stream, h * w * c), dtype=np.uint8).reshape(( h, w, c ) if 1 < c else ( h, w ))
+        labels = np.frombuffer(_read_exactly(stream, 4 * n), dtype='<i4')
+        yolos = np.frombuffer(_read_exactly(stream, 8 * 4 * n), dtype='<f8').reshape(n, 4)
+        yield rel_image_file, image, labels, yolos
+
+# the messages, of this process and of the processes it starts, go to stderr while stdout is to be the stream.
+# -> binary stream of stdout, for serve().
+@contextlib.contextmanager
+def messages_to_stderr():
+    sys.stdout.flush()
+    saved = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    try:
+        with os.fdopen(os.dup(saved), 'wb') as stream:
+            yield stream
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, sys.stdout.fileno())
+        os.close(saved)
+
+# writes the samples to address: - for stdout, a binary stream, or a unix socket, listened to for one reader.
+# the messages go to stderr while stdout is the stream.
+def serve(samples_, address):
+    with contextlib.ExitStack() as stack:
+        if '-' == address:
+            stream = sys.stdout.buffer
+            stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+            send = stream.write
+        elif not isinstance(address, str):
+            stream = address
+            send = stream.write
+        else:
+            server = stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            if os.path.exists(address):
+                os.remove(address)
+            server.bind(address)
+            stack.callback(os.remove, address)
+            server.listen(1)
+            print('Listening: {}'.format(address))
+            conn, _ = server.accept()
+            stack.enter_context(conn)
+            stream = None
+            send = conn.sendall
+        try:
+            for sample in samples_:
+                data = sample_bytes(*sample)
+                with metrics.timer('send'):
+                    send(data)
+            if stream:
+                stream.flush()
+        except ( BrokenPipeError, ConnectionResetError, ):
+            print('Closed by the reader: {}'.format(address))
+            if stream:
+                # nothing to flush at exit.
+                os.dup2(os.open(os.devnull, os.O_WRONLY), stream.fileno())
+
+#orig, new   tmp file, replace file
+#orig        tmp dir, rename tmp->new
+#      new   tmp dir, rename new->orig, rename tmp->new
+def prepare_dirs(orig_image_dir, orig_label_dir, new_image_dir, new_label_dir, orig_exists):
+    if orig_exists and os.path.exists(new_image_dir):
+        assert os.path.exists(new_label_dir) or labelstore.is_packed(new_label_dir), new_label_dir
         print('{} -> {}'.format(orig_image_dir, new_image_dir))
-        mode = MODE_REPLACE_FILE
+        return MODE_REPLACE_FILE, orig_image_dir, orig_label_dir, new_image_dir, new_label_dir
+    if orig_exists:
+        print('{} -> {}(tmp)'.format(orig_image_dir, new_image_dir))
+        mode = MODE_RENAME_NEW_DIR
         in_image_dir  = orig_image_dir
         in_label_dir  = orig_label_dir
-        out_image_dir = new_image_dir
-        out_label_dir = new_label_dir
     else:
-        if os.path.exists(orig_image_dir):
-            assert os.path.exists(orig_label_dir), orig_label_dir
-            print('{} -> {}(tmp)'.format(orig_image_dir, new_image_dir))
-            mode = MODE_RENAME_NEW_DIR
-            in_image_dir  = orig_image_dir
-            in_label_dir  = orig_label_dir
-        else:
-            assert os.path.exists(new_image_dir), new_image_dir
-            assert os.path.exists(new_label_dir), new_label_dir
-            print('{}({})-> {}(tmp)'.format(new_image_dir, orig_image_dir, new_image_dir))
-            mode = MODE_RENAME_ORIG_RENAME_NEW_DIR
-            in_image_dir  = new_image_dir
-            in_label_dir  = new_label_dir
-        os.makedirs(os.path.dirname(new_image_dir), exist_ok=True)
-        os.makedirs(os.path.dirname(new_label_dir), exist_ok=True)
-        out_image_dir = tempfile.mkdtemp(prefix='tmp.', dir=os.path.dirname(new_image_dir))
-        out_label_dir = tempfile.mkdtemp(prefix='tmp.', dir=os.path.dirname(new_label_dir))
-
-    with open(in_list_file, 'r', newline='\n') as in_image_list, \
-         open(out_list_file, 'w', newline='\n') if out_list_file else contextlib.nullcontext() as out_image_list:
-        for image_file in in_image_list:
-            if image_file.endswith('\n'):
-                image_file = image_file[:-1]
-            rel_image_file = os.path.relpath(image_file, start=in_list_file_base)
-            assert '..' not in rel_image_file, '{},{},{}'.format(image_file, new_image_dir, rel_image_file)
-            rel_label_file, image_ext = os.path.splitext(rel_image_file)
-            rel_label_file += '.txt'
-            in_image_file = os.path.join(in_image_dir, rel_image_file)
-            in_label_file = os.path.join(in_label_dir, rel_label_file)
-            out_image_file = os.path.join(out_image_dir, rel_image_file)
-            out_label_file = os.path.join(out_label_dir, rel_label_file)
-            print('Processing {}'.format(rel_image_file))
-            if out_list_file:
-                out_image_list.write('{}\n'.format(pathlib.PurePath(os.path.join(new_image_dir, rel_image_file)).as_posix()))
-            os.makedirs(os.path.dirname(out_image_file), exist_ok=True)
-            os.makedirs(os.path.dirname(out_label_file), exist_ok=True)
-            with open(in_label_file, 'r') as flabel:
-                bboxes = []
-                for lline in flabel:
-                    vals = lline.split()
-                    if not vals:
-                        continue
-                    try:
-                        label, *bbox = vals
-                        bbox = tuple(map(float, bbox))
-                        bboxes.append(BBox(type_=BBox.YOLO, bbox=bbox, label=label))
-                    except:
-                        print('Warning: invalid line: {}'.format(lline))
-                        raise
-                do_h_flip = h_flip_prob   >= random.random()
-                do_rotate = rotate90_prob >= random.random()
-                if do_h_flip or do_rotate:
-                    bboxes = BBoxes(image=in_image_file, bboxes=bboxes)
-                    if do_h_flip: bboxes.h_flip()
-                    if do_rotate:
-                        if 1 > len(bboxes.bboxes):
-                            bboxes.rotate_random()
-                        else:
-                            bboxes.rotate_random90(random.randrange(4))
-                    write_image_labels(bboxes, out_image_file, out_label_file)
-                else:
-                    symlink_image_labels(os.path.join(orig_image_dir, rel_image_file),
-                                         os.path.join(orig_label_dir, rel_label_file),
-                                         out_image_file, out_label_file)
-
+        assert os.path.exists(new_image_dir), new_image_dir
+        assert os.path.exists(new_label_dir) or labelstore.is_packed(new_label_dir), new_label_dir
+        print('{}({})-> {}(tmp)'.format(new_image_dir, orig_image_dir, new_image_dir))
+        mode = MODE_RENAME_ORIG_RENAME_NEW_DIR
+        in_image_dir  = new_image_dir
+        in_label_dir  = new_label_dir
+    os.makedirs(os.path.dirname(new_image_dir), exist_ok=True)
+    os.makedirs(os.path.dirname(new_label_dir), exist_ok=True)
+    out_image_dir = tempfile.mkdtemp(prefix='tmp.', dir=os.path.dirname(new_image_dir))
+    out_label_dir = tempfile.mkdtemp(prefix='tmp.', dir=os.path.dirname(new_label_dir))
+    return mode, in_image_dir, in_label_dir, out_image_dir, out_label_dir
+
+def finish_dirs(mode, orig_image_dir, orig_label_dir, new_image_dir, new_label_dir, out_image_dir, out_label_dir):
     if MODE_REPLACE_FILE == mode:
-        pass
+        return
+    if MODE_RENAME_ORIG_RENAME_NEW_DIR == mode:
+        print('{} -> {}'.format(new_image_dir, orig_image_dir))
+        os.rename(new_image_dir, orig_image_dir)
+        print('{} -> {}'.format(new_label_dir, orig_label_dir))
+        labelstore.rename(new_label_dir, orig_label_dir)
     else:
-        if MODE_RENAME_ORIG_RENAME_NEW_DIR == mode:
-            print('{} -> {}'.format(new_image_dir, orig_image_dir))
-            os.rename(new_image_dir, orig_image_dir)
-            print('{} -> {}'.format(new_label_dir, orig_label_dir))
-            os.rename(new_label_dir, orig_label_dir)
-        else:
-            assert MODE_RENAME_NEW_DIR == mode
+        assert MODE_RENAME_NEW_DIR == mode
+
+    print('{} -> {}'.format(out_image_dir, new_image_dir))
+    os.rename(out_image_dir, new_image_dir)
+    print('{} -> {}'.format(out_label_dir, new_label_dir))
+    os.rename(out_label_dir, new_label_dir)
+
+# variants: [ ( new_image_dir, new_label_dir, out_list_file or None ), ... ]
+# each source image is read once for all the variants.
+# the first variant may rename its new dir to the orig dir, as aug_all() one by one would.
+def aug_variants(orig_image_dir, orig_label_dir, in_list_file, in_list_file_base, variants,
+                 h_flip_prob, rotate90_prob, jobs=1):
+    base_seed = seed
+    if base_seed is None:
+        base_seed = random.randrange(2 ** 32)
+    print('Seed: {}'.format(base_seed))
+
+    orig_exists = os.path.exists(orig_image_dir)
+    if orig_exists:
+        assert os.path.exists(orig_label_dir) or labelstore.is_packed(orig_label_dir), orig_label_dir
+    dirs = []
+    for new_image_dir, new_label_dir, _ in variants:
+        dirs.append(prepare_dirs(orig_image_dir, orig_label_dir, new_image_dir, new_label_dir, orig_exists))
+        # the first one has renamed the new dir to the orig dir by then.
+        orig_exists = True
+    _, in_image_dir, in_label_dir, _, _ = dirs[0]
+
+    # the labels are parsed once per process, whichever aug_all() asks for them again.
+    dataset = labelstore.dataset(in_label_dir)
+    in_packed = labelstore.is_packed(in_label_dir)
+    with contextlib.ExitStack() as stack, \
+         multiprocessing.Pool(jobs, metrics.init_worker, ( metrics.enabled(), )) if 1 < jobs else contextlib.nullcontext() as pool:
+        out_image_lists = [ stack.enter_context(open(out_list_file, 'w', newline='\n')) if out_list_file else None
+                            for _, _, out_list_file in variants ]
+
+        def tasks():
+            for rel_image_file, rows in dataset.iter_list(in_list_file, in_list_file_base):
+                rel_label_file, image_ext = os.path.splitext(rel_image_file)
+                rel_label_file += '.txt'
+                outs = []
+                for ( new_image_dir, _, _ ), ( _, _, _, out_image_dir, out_label_dir ), out_image_list \
+                      in zip(variants, dirs, out_image_lists):
+                    if out_image_list:
+                        out_image_list.write('{}\n'.format(pathlib.PurePath(os.path.join(new_image_dir, rel_image_file)).as_posix()))
+                    outs.append(( os.path.join(out_image_dir, rel_image_file),
+                                  os.path.join(out_label_dir, rel_label_file), ))
+                yield ( rel_image_file,
+                        os.path.join(in_image_dir, rel_image_file),
+                        os.path.join(in_label_dir, rel_label_file),
+                        in_packed,
+                        rows,
+                        os.path.join(orig_image_dir, rel_image_file),
+                        os.path.join(orig_label_dir, rel_label_file),
+                        outs, h_flip_prob, rotate90_prob, base_seed, exact )
+
+        for taken in imap_bounded(pool, aug_image, tasks(), window_per_job * jobs) if pool else map(aug_image, tasks()):
+            metrics.merge(taken)
+
+    for ( new_image_dir, new_label_dir, _ ), ( mode, _, _, out_image_dir, out_label_dir ) in zip(variants, dirs):
+        finish_dirs(mode, orig_image_dir, orig_label_dir, new_image_dir, new_label_dir, out_image_dir, out_label_dir)
 
-        print('{} -> {}'.format(out_image_dir, new_image_dir))
-        os.rename(out_image_dir, new_image_dir)
-        print('{} -> {}'.format(out_label_dir, new_label_dir))
-        os.rename(out_label_dir, new_label_dir)
+def aug_all(orig_image_dir, orig_label_dir, in_list_file, in_list_file_base, new_image_dir, new_label_dir, out_list_file,
+            h_flip_prob, rotate90_prob, jobs=1):
+    aug_variants(orig_image_dir, orig_label_dir, in_list_file, in_list_file_base,
+                 [ ( new_image_dir, new_label_dir, out_list_file, ) ], h_flip_prob, rotate90_prob, jobs)
 
 if __name__=='__main__':
-    #os.chdir('m:/data/work/dog/00input-chihuahua')
-    params = {
-        'orig_image_dir': 'images.orig/G',
-        'orig_label_dir': 'labels.orig/G',
-          'in_list_file': 'lists/G.txt.orig',
-     'in_list_file_base': 'images/G',
-
-         'new_image_dir': 'images/G.0',
-         'new_label_dir': 'labels/G.0',
-         'out_list_file': 'lists/G.0.txt',
-
-         'h_flip_prob'  : 0.0,
-         'rotate90_prob': 0.0,
-    }
-    #aug_all(**params)
-    
-    params['h_flip_prob']   = 0.1
-    params['rotate90_prob'] = 1.0
-    for i in range(1, 10):
-        params['new_image_dir'] = 'images/G.{}'.format(i)
-        params['new_label_dir'] = 'labels/G.{}'.format(i)
-        params['out_list_file'] = 'lists/G.{}.txt'.format(i)
-        aug_all(**params)
-
-    for name in ( 'coco', 'ilsvrc', 'openimages', 'voc2012' ):
+    parser = argparse.ArgumentParser(description='augment images by flipping and rotating.')
+    parser.add_argument('--jobs', '-j', default=1, type=int, help='number of worker processes.')
+    parser.add_argument('--seed', '-s', default=None, type=int, help='base of the per image seeds, for reproducible runs.')
+    parser.add_argument('--exact', '-x', action='store_true', help='flips and right angle turns only, done exactly. JPEG losslessly by jpegtran if found.')
+    parser.add_argument('--stream', metavar='OUT', help='stream the samples of G instead of writing G.1 .. G.9: - for stdout, or a unix socket to listen on. '
+                                                         'the other datasets are augmented in place first.')
+    parser.add_argument('--epochs', default=9, type=int, help='passes over G by --stream, as G.1 .. G.9. 0 for endless.')
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    seed = args.seed
+    exact = args.exact
+
+    # with --stream -, stdout is the samples alone from the start: the other datasets and the metrics print too.
+    with messages_to_stderr() if '-' == args.stream else contextlib.nullcontext() as stdout, \
+         metrics.session(args.metrics):
+        #os.chdir('m:/data/work/dog/00input-chihuahua')
         params = {
-            'orig_image_dir': 'images.orig/' + name,
-            'orig_label_dir': 'labels.orig/' + name,
-              'in_list_file': 'lists/' + name + '.txt',
-         'in_list_file_base': 'images/' + name,
-    
-             'new_image_dir': 'images/' + name,
-             'new_label_dir': 'labels/' + name,
-             'out_list_file': None,
-    
-             'h_flip_prob'  : 0.1,
-             'rotate90_prob': 1.0,
+            'orig_image_dir': 'images.orig/G',
+            'orig_label_dir': 'labels.orig/G',
+              'in_list_file': 'lists/G.txt.orig',
+         'in_list_file_base': 'images/G',
+         'in_label_dir_base': 'labels/G',
+
+             'new_image_dir': 'images/G.0',
+             'new_label_dir': 'labels/G.0',
+             'out_list_file': 'lists/G.0.txt',
+
+             'h_flip_prob'  : 0.0,
+             'rotate90_prob': 0.0,
         }
-        aug_all(**params)
+        #aug_all(**params)
+
+        params['h_flip_prob']   = 0.1
+        params['rotate90_prob'] = 1.0
+        del params['new_image_dir'], params['new_label_dir'], params['out_list_file']
+        if not args.stream:
+            # G.1 .. G.9 from one read of G.
+            del params['in_label_dir_base']
+            params['variants'] = [ ( 'images/G.{}'.format(i), 'labels/G.{}'.format(i), 'lists/G.{}.txt'.format(i), ) for i in range(1, 10) ]
+            aug_variants(**params, jobs=args.jobs)
+        stream_params = params
+
+        # with --stream too, before the samples of G: they may be endless.
+        for name in ( 'coco', 'ilsvrc', 'openimages', 'voc2012' ):
+            params = {
+                'orig_image_dir': 'images.orig/' + name,
+                'orig_label_dir': 'labels.orig/' + name,
+                  'in_list_file': 'lists/' + name + '.txt',
+             'in_list_file_base': 'images/' + name,
+
+                 'new_image_dir': 'images/' + name,
+                 'new_label_dir': 'labels/' + name,
+                 'out_list_file': None,
+
+                 'h_flip_prob'  : 0.1,
+                 'rotate90_prob': 1.0,
+            }
+            aug_all(**params, jobs=args.jobs)
+
+        if args.stream:
+            # G.1 .. G.9 as epochs of samples, not written.
+            params = stream_params
+            orig_exists = os.path.exists(params['orig_image_dir'])
+            serve(samples(params['orig_image_dir'] if orig_exists else params['in_list_file_base'],
+                          params['orig_label_dir'] if orig_exists else params['in_label_dir_base'],
+                          params['in_list_file'], params['in_list_file_base'],
+                          params['h_flip_prob'], params['rotate90_prob'], epochs=args.epochs, jobs=args.jobs),
+                  stdout or args.stream)
 
 # =============================================================================
 #     import matplotlib.pyplot as plt
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# output sink of the converters: label files written in batches, by background I/O threads.
+#   each label file is joined and written at once, instead of a write() per line.
+#   flush() waits until all the files queued so far are written, e.g. at the end of a split,
+#   and before the manifest commits the records of them: manifest.Manifest(before_commit=sink.flush).
+# progress: a line every so many items or seconds, instead of a flush of stdout per item.
+
+import sys
+import time
+import collections
+import concurrent.futures
+import metrics
+
+# bytes per batch, also the buffer of the list files.
+buffer_size = 1 << 20
+# files per batch
+batch_files = 1024
+# batches in flight per thread. the caller waits when more.
+window_per_thread = 4
+
+def _write_file(file, data):
+    with metrics.timer('write'), open(file, 'w', newline='\n') as f:
+        f.write(data)
+
+def _write_files(batch):
+    for file, data in batch:
+        _write_file(file, data)
+
+class Sink():
+    # threads: background I/O threads, 0 to write in the caller.
+    def __init__(self, threads=1):
+        self._threads = threads
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads) if 0 < threads else None
+        self._batch = []
+        self._batch_bytes = 0
+        self._pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+
+    # lines of a label file
+    def write(self, file, lines):
+        data = ''.join(lines)
+        if not self._executor:
+            _write_file(file, data)
+            return
+        self._batch.append(( file, data, ))
+        self._batch_bytes += len(data)
+        if batch_files <= len(self._batch) or buffer_size <= self._batch_bytes:
+            self._submit()
+
+    def _submit(self):
+        if self._batch:
+            self._pending.append(self._executor.submit(_write_files, self._batch))
+            self._batch = []
+            self._batch_bytes = 0
+        while window_per_thread * self._threads < len(self._pending):
+            # raises the error of the batch, if any.
+            self._pending.popleft().result()
+
+    def flush(self):
+        if not self._executor:
+            return
+        self._submit()
+        while self._pending:
+            self._pending.popleft().result()
+
+class Progress():
+    # every: items, interval: seconds. whichever comes first.
+    def __init__(self, name, every=1000, interval=5.0, file=sys.stdout):
+        self._name = name
+        self._every = every
+        self._interval = interval
+        self._file = file
+        self._n = 0
+        self._n_printed = 0
+        self._printed = time.monotonic()
+
+    @property
+    def n(self):
+        return self._n
+
+    # item: shown when the line is printed. n: items done.
+    def update(self, item='', n=1):
+        self._n += n
+        if self._every <= self._n - self._n_printed or self._interval <= time.monotonic() - self._printed:
+            self._print(item)
+
+    def _print(self, item):
+        print('{}: {} {}'.format(self._name, self._n, item), file=self._file, flush=True)
+        self._n_printed = self._n
+        self._printed = time.monotonic()
+
+    def done(self):
+        if self._n != self._n_printed:
+            self._print('done')
+
+# end of file
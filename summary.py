@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# detections of yolo summarized per image.
+#   row: CSV: confidence, VOC style BBOX(float*4), label
+# per image file: <summary_dir>/<id>.csv: rows of the id.
+# consolidated file: CSV: id, row. sorted by id.
+#   <consolidated>.index: CSV: id, offset, size. byte range of the rows of the id.
+
+import os
+import heapq
+import itertools
+import tempfile
+
+# str object and list slot per row, roughly.
+_ROW_OVERHEAD = 64
+
+def format_row(flts, label):
+    return '{:1.15f},{:1.15f},{:1.15f},{:1.15f},{:1.15f},{}\n'.format(*flts, label)
+
+# row -> ( confidence, ( xmin, ymin, xmax, ymax ), label )
+def parse_row(row):
+    confidence, xmin, ymin, xmax, ymax, label = row.rstrip('\n').split(',')
+    return float(confidence), ( float(xmin), float(ymin), float(xmax), float(ymax), ), label
+
+def _id_of(line):
+    return line.split(',', 1)[0]
+
+# rows grouped by id, in the order added.
+# over budget bytes, the groups are spilled to a run file sorted by id.
+# the runs are merged at the end, earlier runs first for the same id.
+class Grouper():
+    def __init__(self, budget, tmp_dir='.'):
+        self._budget = budget
+        self._tmp_dir = tmp_dir
+        self._groups = {}
+        self._size = 0
+        self._runs = []
+
+    def add(self, id_, row):
+        self._groups.setdefault(id_, []).append(row)
+        self._size += len(row) + _ROW_OVERHEAD
+        if self._budget < self._size:
+            self._spill()
+
+    def _spill(self):
+        with tempfile.NamedTemporaryFile(mode='w', newline='\n', delete=False,
+                                         prefix='tmp.run.', dir=self._tmp_dir) as f:
+            self._runs.append(f.name)
+            for id_ in sorted(self._groups):
+                for row in self._groups[id_]:
+                    f.write('{},{}'.format(id_, row))
+        print('Spilled {} images to {}'.format(len(self._groups), f.name))
+        self._groups = {}
+        self._size = 0
+
+    # -> ( id, [ row, ... ] ), sorted by id.
+    def groups(self):
+        if not self._runs:
+            for id_ in sorted(self._groups):
+                yield id_, self._groups[id_]
+            self._groups = {}
+            return
+        if self._groups:
+            self._spill()
+        files = []
+        try:
+            for run in self._runs:
+                files.append(open(run, 'r', newline='\n'))
+            # heapq.merge() takes equal keys in the order of the runs.
+            for id_, lines in itertools.groupby(heapq.merge(*files, key=_id_of), key=_id_of):
+                yield id_, [ line[len(id_) + 1:] for line in lines ]
+        finally:
+            for f in files:
+                f.close()
+            for run in self._runs:
+                os.remove(run)
+            self._runs = []
+
+# writes each id once: per image files and/or the consolidated file with its index.
+# the consolidated file and the index are replaced atomically on success.
+class Writer():
+    def __init__(self, summary_dir=None, consolidated=None):
+        self._summary_dir = summary_dir
+        self._consolidated = consolidated
+        self._fo = None
+        self._findex = None
+        if consolidated:
+            dir_ = os.path.dirname(consolidated) or '.'
+            os.makedirs(dir_, exist_ok=True)
+            self._fo = tempfile.NamedTemporaryFile(mode='wb', delete=False, prefix='tmp.', dir=dir_)
+            self._findex = tempfile.NamedTemporaryFile(mode='w', newline='\n', delete=False, prefix='tmp.', dir=dir_)
+            self._offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._fo:
+            self._fo.close()
+            self._findex.close()
+            if exc_type is None:
+                os.replace(self._fo.name, self._consolidated)
+                os.replace(self._findex.name, self._consolidated + '.index')
+            else:
+                os.remove(self._fo.name)
+                os.remove(self._findex.name)
+
+    def write(self, id_, rows):
+        if self._summary_dir:
+            with open(os.path.join(self._summary_dir, id_ + '.csv'), 'w') as fsummary:
+                fsummary.writelines(rows)
+        if self._fo:
+            data = ''.join('{},{}'.format(id_, row) for row in rows).encode()
+            self._fo.write(data)
+            self._findex.write('{},{},{}\n'.format(id_, self._offset, len(data)))
+            self._offset += len(data)
+
+# consolidated file -> ( id, [ row, ... ] ), sorted by id.
+def read_consolidated(file):
+    with open(file, 'r', newline='\n') as f:
+        for id_, lines in itertools.groupby(f, key=_id_of):
+            yield id_, [ line[len(id_) + 1:] for line in lines ]
+
+# <consolidated>.index -> { id: ( offset, size ) }
+def load_index(file):
+    index = {}
+    with open(file + '.index', 'r') as f:
+        for line in f:
+            id_, offset, size = line.rstrip('\n').split(',')
+            index[id_] = ( int(offset), int(size), )
+    return index
+
+# rows of an id in the consolidated file, [] if none.
+def read_rows(file, index, id_):
+    if id_ not in index:
+        return []
+    offset, size = index[id_]
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size).decode()
+    return [ line[len(id_) + 1:] for line in data.splitlines(keepends=True) ]
+
+# end of file
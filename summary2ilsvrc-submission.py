@@ -7,66 +7,173 @@
 
 # convert summary to ILSVRC submission file.
 # summary file: CSV: confidence, VOC style BBOX(float*4), label
+# the top k detections per image are kept in a bounded heap while reading either
+#   the summary files of yoloresults2summary.py (per image, or consolidated), or
+#   the results of darknet (comp4_det_test_*) directly.
 
 import os
+import glob
 import math
+import heapq
 import pathlib
 import argparse
-import pandas as pd
+import contextlib
+import multiprocessing
+import summary
+import metrics
 from bbox import BBox
 #from label_chihuahua import ChihuahuaLabelNames as LabelNames
 #predefined_labels = '/data/work/dog/00input-chihuahua/chihuahua.txt'
 from label_default import ILSVRCLabelNames as LabelNames
 predefined_labels = '/data/huge/ILSVRC/LOC_synset_mapping.txt'
 
+# initialized by main()
+labels = None
+# detections per image in the submission
+k = 5
+# ids per task of --jobs
+shard_size = 256
+
+# heap entry: ( confidence, -file order, -line order, VOC style BBOX, label )
+# for the same confidence, the earlier one is preferred.
+def push(heap, entry):
+    if len(heap) < k:
+        heapq.heappush(heap, entry)
+    elif heap[0] < entry:
+        heapq.heapreplace(heap, entry)
+
+def push_rows(heap, rows):
+    for i, row in enumerate(rows):
+        confidence, bbox, label = summary.parse_row(row)
+        push(heap, ( confidence, 0, -i, bbox, label, ))
+    return heap
+
+# summary directory, ids -> [ ( id, heap or None ), ... ], metrics.take()
+def read_summaries(shard):
+    summary_dir, ids = shard
+    heaps = []
+    for id_ in ids:
+        file = os.path.join(summary_dir, id_ + '.csv')
+        if not os.path.exists(file):
+            heaps.append(( id_, None, ))
+            continue
+        with metrics.timer('read'), open(file, 'r') as f:
+            heaps.append(( id_, push_rows([], f), ))
+        metrics.count('summaries')
+    return heaps, metrics.take()
+
+# file order, ( comp4_det_test_*.txt, label ) -> { id: heap }, metrics.take()
+def read_results(task):
+    order, ( pred, label ) = task
+    print('Reading: {}'.format(pred))
+    heaps = {}
+    with metrics.timer('read'), open(pred, 'r') as fpred:
+        for i, line in enumerate(fpred):
+            id_, *flts = line.split()
+            # confidence, VOC style values: 1<->width, 1<->height, 1<->width, 1<->height
+            confidence, *bbox = map(float, flts)
+            heap = heaps.get(id_)
+            if heap is None:
+                heap = heaps[id_] = []
+            push(heap, ( confidence, -order, -i, tuple(bbox), label, ))
+    metrics.count('results')
+    return heaps, metrics.take()
+
+def find_results(results_dir):
+    preds = []
+    for label in labels.label_names():
+        pred = None
+        is_first = True
+        for pred in glob.glob(pathlib.PurePath(results_dir).as_posix() + '/comp4_det_test*_' + label + '.txt'):
+            if not is_first:
+                raise ValueError('Multiple files exist for {}: {}'.format(label, pred))
+            is_first = False
+        if pred is None:
+            print('Skipping label: {}'.format(label))
+            continue
+        preds.append(( pred, label, ))
+    return preds
+
+def prediction(heap, threshold):
+    pred = ''
+    bboxes = []
+    for confidence, _, _, bbox, label in sorted(heap, reverse=True):
+        if 1 > len(bboxes) or confidence >= threshold:
+            bboxes.append(BBox(type_=BBox.VOC, bbox=bbox, label=label))
+    for b in bboxes:
+        bbox = b.get(type_=BBox.ILSVRC)
+        #bbox = b.get(type_=BBox.VOC)
+        if pred:
+            pred += ' '
+        # OC_synset_mapping.txt: The mapping between the 1000 synset id and their descriptions.
+        # For example, Line 1 says n01440764 tench, Tinca tinca means this is class 1, has a synset id of n01440764,
+        # and it contains the fish tench.
+        pred += '{} {} {} {} {}'.format(
+            1 + labels.label_index(b.label),
+            #labels.label_index(b.label),
+            math.floor(bbox[0]), math.floor(bbox[1]),
+            math.ceil(bbox[2]),  math.ceil(bbox[3]))
+    return pred
+
 def main(args):
-    global predefined_labels
-    global _min_x_w, _min_y_h, _max_x_w, _max_y_h
-    global _max_w, _max_h, _max_w_h, _max_h_w
+    global predefined_labels, labels
 
-    LabelNames.init(predefined_labels)
+    labels = LabelNames.init(predefined_labels)
 
     print('Reading: {}'.format(args.test_list))
-    with open(args.test_list, 'r') as ftest, open(args.output_file, 'w') as fo:
+    with open(args.test_list, 'r') as ftest:
+        ids = [ pathlib.PurePath(line).stem for line in ftest ]
+
+    with multiprocessing.Pool(args.jobs, metrics.init_worker, ( metrics.enabled(), )) if 1 < args.jobs else contextlib.nullcontext() as pool:
+        imap = pool.imap if pool else map
+        if args.results_dir:
+            heaps = {}
+            for heaps_label, taken in imap(read_results, enumerate(find_results(args.results_dir))):
+                metrics.merge(taken)
+                for id_, heap in heaps_label.items():
+                    if id_ in heaps:
+                        for entry in heap:
+                            push(heaps[id_], entry)
+                    else:
+                        heaps[id_] = heap
+        elif args.consolidated:
+            print('Reading: {}'.format(args.consolidated))
+            with metrics.timer('read'):
+                heaps = { id_: push_rows([], rows) for id_, rows in summary.read_consolidated(args.consolidated) }
+            metrics.count('summaries', len(heaps))
+        else:
+            shards = [ ( args.summary_dir, ids[i:i + shard_size], ) for i in range(0, len(ids), shard_size) ]
+            heaps = {}
+            for heaps_shard, taken in imap(read_summaries, shards):
+                metrics.merge(taken)
+                heaps.update(( id_, heap, ) for id_, heap in heaps_shard if heap is not None)
+
+    with metrics.timer('write'), open(args.output_file, 'w') as fo:
         fo.write('ImageId,PredictionString\n')
-        for line in ftest:
-            id_ = pathlib.PurePath(line).stem
+        for id_ in ids:
             pred = ''
-            summary = os.path.join(args.summary_dir, id_ + '.csv')
-            if not os.path.exists(summary):
+            heap = heaps.get(id_)
+            if heap is None:
                 print('***** CAUTION *****: no summary for {}'.format(id_))
+                metrics.count('missing')
             else:
-                df = pd.read_csv(os.path.join(args.summary_dir, id_ + '.csv'), header=None)
-                df.columns = [ 'confidence', 'voc_xmin', 'voc_ymin', 'voc_xmax', 'voc_ymax', 'label' ]
-                df.sort_values(by='confidence', ascending=False, inplace=True)
-                df = df.head(5)
-                bboxes = []
-                for index, row in df.iterrows():
-                    if 1 > len(bboxes) or float(row[0]) >= args.threshold:
-                        bboxes.append(BBox(type_=BBox.VOC, bbox=(tuple(map(float, row[1:5]))), label=row[5]))
-                for b in bboxes:
-                    bbox = b.get(type_=BBox.ILSVRC)
-                    #bbox = b.get(type_=BBox.VOC)
-                    if pred:
-                        pred += ' '
-                    # OC_synset_mapping.txt: The mapping between the 1000 synset id and their descriptions.
-                    # For example, Line 1 says n01440764 tench, Tinca tinca means this is class 1, has a synset id of n01440764,
-                    # and it contains the fish tench. 
-                    pred += '{} {} {} {} {}'.format(
-                        1 + LabelNames.label_index(b.label),
-                        #LabelNames.label_index(b.label),
-                        math.floor(bbox[0]), math.floor(bbox[1]),
-                        math.ceil(bbox[2]),  math.ceil(bbox[3]))
+                pred = prediction(heap, args.threshold)
             fo.write('{},{}\n'.format(id_, pred))
+            metrics.count('images')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='convert summary to ILSVRC submission.')
     parser.add_argument('--summary-dir', '-s', default='summary', help='dirctory that contains ID + .csv files.')
+    parser.add_argument('--consolidated', '-i', help='consolidated summary file, instead of --summary-dir.')
+    parser.add_argument('--results-dir', '-r', help='dirctory that contains the results of darknet, instead of --summary-dir.')
     parser.add_argument('--test-list',   '-t', default='/data/huge/ILSVRC/yolo/lists/test.txt')
     parser.add_argument('--output-file', '-o', default='summary/submission.csv')
     parser.add_argument('--threshold',   '-c', default='0.0', type=float, help='threshold of confidence.')
-    
-    args = parser.parse_args() 
-    main(args)
+    parser.add_argument('--jobs',        '-j', default=1, type=int, help='number of worker processes.')
+
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    with metrics.session(args.metrics):
+        main(args)
 
 # end of file
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# python -m pytest test_sideaug.py
+
+import os
+import numpy as np
+import cv2
+import pytest
+import sideaug
+
+# more digits than float32 or {:1.9f} keep.
+_LABELS = {
+    'im0': '0 0.512345678901234 0.487654321098765 0.234567890123456 0.345678901234567\n',
+    'sub/im1': '1 0.3 0.4 0.2 0.1\n2 0.612345678901234 0.5 0.3 0.25\n',
+}
+
+def _make(root, image_dir, label_dir):
+    with open(os.path.join(root, 'lists', 'G.txt.orig'), 'w', newline='\n') as f:
+        for key, text in _LABELS.items():
+            image_file = os.path.join(root, image_dir, key + '.png')
+            label_file = os.path.join(root, label_dir, key + '.txt')
+            os.makedirs(os.path.dirname(image_file), exist_ok=True)
+            os.makedirs(os.path.dirname(label_file), exist_ok=True)
+            cv2.imwrite(image_file, np.zeros(( 24, 32, 3, ), np.uint8))
+            with open(label_file, 'w', newline='\n') as fl:
+                fl.write(text)
+            f.write('images/G/{}.png\n'.format(key))
+
+# mode: how prepare_dirs() finds the dirs on the first pass.
+@pytest.mark.parametrize('mode', [ sideaug.MODE_RENAME_ORIG_RENAME_NEW_DIR, sideaug.MODE_RENAME_NEW_DIR, sideaug.MODE_REPLACE_FILE, ])
+def test_unaugmented_labels_are_links(tmp_path, monkeypatch, mode):
+    root = str(tmp_path)
+    monkeypatch.chdir(root)
+    for d in ( 'lists', 'images.orig', 'labels.orig', ):
+        os.makedirs(d)
+    if sideaug.MODE_RENAME_ORIG_RENAME_NEW_DIR == mode:
+        _make(root, 'images/G.1', 'labels/G.1')
+    else:
+        _make(root, 'images.orig/G', 'labels.orig/G')
+    if sideaug.MODE_REPLACE_FILE == mode:
+        _make(root, 'images/G.1', 'labels/G.1')
+    monkeypatch.setattr(sideaug, 'seed', 0)
+
+    # nothing augmented: every variant links to the originals.
+    sideaug.aug_variants('images.orig/G', 'labels.orig/G', 'lists/G.txt.orig', 'images/G',
+                         [ ( 'images/G.1', 'labels/G.1', 'lists/G.1.txt', ), ( 'images/G.2', 'labels/G.2', None, ), ],
+                         0.0, 0.0)
+
+    for key, text in _LABELS.items():
+        for variant in ( 'G.1', 'G.2', ):
+            label_file = os.path.join('labels', variant, key + '.txt')
+            assert os.path.islink(label_file), label_file
+            with open(label_file, 'r', newline='') as f:
+                assert text == f.read(), label_file
+            assert os.path.islink(os.path.join('images', variant, key + '.png'))
+
+# end of file
@@ -8,29 +8,46 @@
 import os
 import pathlib
 import contextlib
-from xml.etree import ElementTree as ET
-from bbox import BBox
+import argparse
+import multiprocessing
+from bbox import BBox, BBoxArray
+import vocxml
+from imageindex import ImageIndex
+import manifest
+import labelstore
+import prefetch
+import sink
+import metrics
 use_mapping=True
+# ( label mapping, output directory ) per target.
+# each annotation is parsed once for all the targets.
+targets = []
 if not use_mapping:
     from label_default import VOCLabelNames
-    VOCLabelNames.init('/opt/darknet/data/voc.names')
-    assert 0 <= VOCLabelNames.label_index('dog')
-    OUT_dir = '/data/huge/VOC/yolo/VOC2012'
-elif False:
-    from label_chihuahua import ChihuahuaVOCLabelNames as VOCLabelNames
-    VOCLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', '/opt/darknet/data/voc.names')
-    assert 0 == VOCLabelNames.label_index_dst('dog')
-    assert 0 <= VOCLabelNames.label_index_src('dog')
-    assert 0 > VOCLabelNames.label_index('cat')
-    OUT_dir = '/data/work/dog/00input-chihuahua'
+    labels = VOCLabelNames.init('/opt/darknet/data/voc.names')
+    assert 0 <= labels.label_index('dog')
+    targets.append(( labels, '/data/huge/VOC/yolo/VOC2012', ))
 else:
-    from label_dog import DogVOCLabelNames as VOCLabelNames
-    VOCLabelNames.init('/data/work/dog/00input-dog/dog.txt', '/opt/darknet/data/voc.names')
-    assert 0 == VOCLabelNames.label_index_dst('dog')
-    assert 0 <= VOCLabelNames.label_index_src('dog')
-    assert 0 == VOCLabelNames.label_index('dog')
-    OUT_dir = '/data/work/dog/00input-dog'
-resume=False
+    if False:
+        from label_chihuahua import ChihuahuaVOCLabelNames
+        labels = ChihuahuaVOCLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', '/opt/darknet/data/voc.names')
+        assert 0 == labels.label_index_dst('dog')
+        assert 0 <= labels.label_index_src('dog')
+        assert 0 > labels.label_index('cat')
+        targets.append(( labels, '/data/work/dog/00input-chihuahua', ))
+    if True:
+        from label_dog import DogVOCLabelNames
+        labels = DogVOCLabelNames.init('/data/work/dog/00input-dog/dog.txt', '/opt/darknet/data/voc.names')
+        assert 0 == labels.label_index_dst('dog')
+        assert 0 <= labels.label_index_src('dog')
+        assert 0 == labels.label_index('dog')
+        targets.append(( labels, '/data/work/dog/00input-dog', ))
+# skip the items which the manifest says are up to date. False to convert all again.
+resume=True
+# labels into packed directories of labelstore.py, instead of a file per image.
+packed=False
+# ids per task of --jobs
+shard_size=64
 
 _min_x_w = 9999999999
 _min_y_h = 9999999999
@@ -42,16 +59,46 @@ _max_w_h = 0
 _max_h_w = 0
 _have_difficult = False
 
-def xml2yolo(xml, yolo, yolo_wo_difficult):
-    global resume
-    global _min_x_w, _min_y_h, _max_x_w, _max_y_h
-    global _max_w, _max_h, _max_w_h, _max_h_w
+# labels and bboxes of a target -> ( lines, lines without difficult, use for negative )
+def target_lines(labels, names, obj_difficults, obj_yolos):
     global _have_difficult
-    xml = ET.parse(xml)
+    lines = []
+    lines_wo_difficult = []
+    use_for_negative = False
+    n_discarded = 0
+    n_negative = 0
+    for label, difficult, yolo_bbox in zip(names, obj_difficults, obj_yolos):
+        try:
+            label_index = labels.label_index(label)
+        except:
+            assert use_mapping
+            n_discarded += 1
+            continue
+        if not isinstance(label_index, (tuple, list)) and 0 > label_index:
+            assert use_mapping
+            use_for_negative = True
+            n_negative += 1
+            continue
+
+        for li in label_index if isinstance(label_index, (tuple, list)) else ( label_index, ):
+            line = '{} {:1.15f} {:1.15f} {:1.15f} {:1.15f}\n'.format(li, *yolo_bbox)
+            lines.append(line)
+            if 0 != int(difficult):
+                _have_difficult = True
+            else:
+                lines_wo_difficult.append(line)
+    metrics.count('boxes', len(lines))
+    metrics.count('discarded', n_discarded)
+    metrics.count('negatives', n_negative)
+    return lines, lines_wo_difficult, use_for_negative
 
-    tree_size = xml.find('size')
-    w = float(tree_size.find('width').text)
-    h = float(tree_size.find('height').text)
+# ts: targets to convert.
+# -> ( lines, lines without difficult ) per target of ts, None if not used.
+def xml2yolo(xml, ts):
+    global _min_x_w, _min_y_h, _max_x_w, _max_y_h
+    global _max_w, _max_h, _max_w_h, _max_h_w
+    with metrics.timer('parse'):
+        h, w, names, obj_difficults, obj_bboxes = vocxml.parse(xml)
 
     if _max_w < w:
         _max_w = w
@@ -70,76 +117,147 @@ def xml2yolo(xml, yolo, yolo_wo_difficult):
             _max_h_w = h_w
             print('New height / width: {}'.format(h_w))
 
-    lines = []
-    lines_wo_difficult = []
-    prev_ignore = ''
-    use_for_negative = False
-    for tree_obj in xml.findall('object'):
-        label = tree_obj.find('name').text
-        try:
-            label_index = VOCLabelNames.label_index(label)
-        except:
-            assert use_mapping
-            if prev_ignore != label:
-                prev_ignore = label
-                #print(',Ignoring {}'.format(label), end='', flush=True)
-                print('.', end='', flush=True)
-            continue
-        if not isinstance(label_index, (tuple, list)) and 0 > label_index:
-            assert use_mapping
-            use_for_negative = True
-            continue
-
-        is_difficult = (0 != int(tree_obj.find('difficult').text.strip()))
-
-        tree_bbox = tree_obj.find('bndbox')
-        bbox = BBox(hw=(h, w), type_=BBox.VOC, bbox=tuple(map(lambda k: float(tree_bbox.find(k).text.strip()), ('xmin', 'ymin', 'xmax', 'ymax'))))
-        xmin, ymin, xmax, ymax = bbox.get(type_=BBox.OPEN_IMAGES)
-        if _min_x_w > xmin:
-            _min_x_w = xmin
+    # objects which any of the targets uses, converted at once.
+    used = [ i for i, label in enumerate(names)
+             if any(is_labeled(targets[t][0], label) for t in ts) ]
+    obj_yolos = [ None ] * len(names)
+    if used:
+        with metrics.timer('bbox'):
+            bboxes = BBoxArray(hw=(h, w), type_=BBox.VOC, bbox=[ obj_bboxes[i] for i in used ])
+            yolos = bboxes.get(type_=BBox.YOLO).tolist()
+        xmin, ymin, xmax, ymax = bboxes.get(type_=BBox.OPEN_IMAGES).T
+        if _min_x_w > xmin.min():
+            _min_x_w = xmin.min().item()
             print('New min xmin / (width-1): {}'.format(_min_x_w))
-        if _min_y_h > ymin:
-            _min_y_h = ymin
+        if _min_y_h > ymin.min():
+            _min_y_h = ymin.min().item()
             print('New min ymin / (height-1): {}'.format(_min_y_h))
-        if _max_x_w < xmax:
-            _max_x_w = xmax
+        if _max_x_w < xmax.max():
+            _max_x_w = xmax.max().item()
             print('New max xmax / (width-1): {}'.format(_max_x_w))
-        if _max_y_h < ymax:
-            _max_y_h = ymax
+        if _max_y_h < ymax.max():
+            _max_y_h = ymax.max().item()
             print('New max ymax / (height-1): {}'.format(_max_y_h))
-        for li in label_index if isinstance(label_index, (tuple, list)) else ( label_index, ):
-            line = '{} {:1.15f} {:1.15f} {:1.15f} {:1.15f}\n'.format(li, *bbox.get(type_=BBox.YOLO))
-            lines.append(line)
-            if is_difficult:
-                _have_difficult = True
-            else:
-                lines_wo_difficult.append(line)
+        for i, yolo_bbox in zip(used, yolos):
+            obj_yolos[i] = yolo_bbox
 
-    if lines_wo_difficult and yolo_wo_difficult:
-        os.makedirs(os.path.dirname(yolo_wo_difficult), exist_ok=True)
-        with open(yolo_wo_difficult, 'w', newline='\n') as f_wo_difficult:
-            for line in lines_wo_difficult:
-                f_wo_difficult.write(line)
-
-    is_used = False
-    if use_for_negative or lines:
-        is_used = True
-        if os.path.exists(yolo):
-            if resume: return is_used
-            raise FileExistsError(yolo)
-        os.makedirs(os.path.dirname(yolo), exist_ok=True)
-        with open(yolo, 'w', newline='\n') as f:
+    results = []
+    with metrics.timer('map'):
+        for t in ts:
+            lines, lines_wo_difficult, use_for_negative = target_lines(targets[t][0], names, obj_difficults, obj_yolos)
+            results.append(( lines, lines_wo_difficult, ) if use_for_negative or lines else None)
+    metrics.count('skipped', results.count(None))
+    return results
+
+# writer: labelstore.Writer, None to write the files.
+def write_label(writer, file, lines):
+    if writer:
+        writer.write(file, lines)
+        return
+    with metrics.timer('write'):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, 'w', newline='\n') as f:
             for line in lines:
                 f.write(line)
-        print('{},'.format(yolo), end='', flush=True)
 
-    return is_used
+def write_labels(writer, yolo, yolo_wo_difficult, lines, lines_wo_difficult):
+    if lines_wo_difficult and yolo_wo_difficult:
+        write_label(writer, yolo_wo_difficult, lines_wo_difficult)
+    write_label(writer, yolo, lines)
 
-def main():
+# the label gives a bbox, not discarded nor negative.
+def is_labeled(labels, label):
+    try:
+        label_index = labels.label_index(label)
+    except ValueError:
+        return False
+    return isinstance(label_index, (tuple, list)) or 0 <= label_index
+
+def get_stats():
+    return ( _min_x_w, _min_y_h, _max_x_w, _max_y_h,
+             _max_w, _max_h, _max_w_h, _max_h_w, _have_difficult )
+
+# reduce the statistics of a worker process
+def merge_stats(stats):
+    global _min_x_w, _min_y_h, _max_x_w, _max_y_h
+    global _max_w, _max_h, _max_w_h, _max_h_w
+    global _have_difficult
+    min_x_w, min_y_h, max_x_w, max_y_h, max_w, max_h, max_w_h, max_h_w, have_difficult = stats
+    _min_x_w = min(_min_x_w, min_x_w)
+    _min_y_h = min(_min_y_h, min_y_h)
+    _max_x_w = max(_max_x_w, max_x_w)
+    _max_y_h = max(_max_y_h, max_y_h)
+    _max_w = max(_max_w, max_w)
+    _max_h = max(_max_h, max_h)
+    _max_w_h = max(_max_w_h, max_w_h)
+    _max_h_w = max(_max_h_w, max_h_w)
+    _have_difficult = _have_difficult or have_difficult
+
+# -> ( image for the list file or None, xml, yolo )
+def find_image(images, NAME, id_):
+    img = images.find(id_, ('.jpg', '.png', '.jpeg', '.JPEG'))
+    if not img: raise FileNotFoundError(os.path.join('images', NAME, id_))
+    return pathlib.PurePath(os.path.join('images', NAME, img)).as_posix()
+
+def xml_path(VOC_dir, id_):
+    return os.path.join(VOC_dir, 'Annotations', id_ + '.xml')
+
+def yolo_paths(OUT_dir, NAME, id_):
+    yolo              = os.path.join(OUT_dir, 'labels',              NAME, id_ + '.txt')
+    yolo_wo_difficult = os.path.join(OUT_dir, 'labels-wo-difficult', NAME, id_ + '.txt')
+    return yolo, yolo_wo_difficult
+
+# checks: manifest.check() of each target, None to convert.
+# the xml is read and parsed once if any of the targets is to be converted.
+# the label files are written here, or by the parent process into the packed directories.
+# -> ( xml, [ ( manifest.check() if up to date or None, image for the list file or None, ( yolo, yolo_wo_difficult if written ),
+#               stamp of xml or None if not converted,
+#               ( yolo_wo_difficult, lines, lines without difficult ) to be packed or None ), ... ] ), per target
+# data: the xml, if read_item() has read it ahead.
+def convert(VOC_dir, NAME, id_, img, checks, data=None):
+    xml = xml_path(VOC_dir, id_)
+    results = []
+    outs = []
+    for t, ( ( _, OUT_dir ), checked ) in enumerate(zip(targets, checks)):
+        yolo, yolo_wo_difficult = yolo_paths(OUT_dir, NAME, id_)
+        results.append(( checked, checked[0] or None if checked else None, ( yolo, ), None, None, ))
+        if checked is None:
+            outs.append(( t, yolo, yolo_wo_difficult, ))
+    if outs:
+        if data is None:
+            with metrics.timer('read'), open(xml, 'rb') as f:
+                data = f.read()
+        stamp = manifest.stamp(xml, data)
+        for ( t, yolo, yolo_wo_difficult ), labels in zip(outs, xml2yolo(data, [ t for t, _, _ in outs ])):
+            assert labels or use_mapping
+            if labels and not packed:
+                write_labels(None, yolo, yolo_wo_difficult, *labels)
+            # the labels without difficult are written only if any.
+            outputs = ( yolo, yolo_wo_difficult, ) if labels and labels[1] else ( yolo, )
+            results[t] = ( None, img if labels else None, outputs, stamp,
+                           ( yolo_wo_difficult, *labels, ) if labels and packed else None, )
+    return xml, results
+
+# the manifests checked, and the xml of an item to be converted read, on an I/O thread of prefetch.py.
+# recorded: Manifest.recorded() of each target.
+# -> arguments of convert()
+def read_item(args):
+    VOC_dir, NAME, id_, img, recorded = args
+    xml = xml_path(VOC_dir, id_)
+    checks = [ manifest.check(recorded_, xml) for recorded_ in recorded ]
+    if all(checked is not None for checked in checks):
+        return ( VOC_dir, NAME, id_, img, checks, None, )
+    with metrics.timer('read'), open(xml, 'rb') as f:
+        return ( VOC_dir, NAME, id_, img, checks, f.read(), )
+
+# the xmls of the shard are read ahead, and converted in order.
+def convert_shard(shard):
+    return [ convert(*args) for args in prefetch.imap(read_item, shard) ], get_stats(), metrics.take()
+
+def main(args):
     global _min_x_w, _min_y_h, _max_x_w, _max_y_h
     global _max_w, _max_h, _max_w_h, _max_h_w
     global _have_difficult
-    global OUT_dir
 
     #####
     # input
@@ -154,44 +272,69 @@ def main():
     # output
     NAME='voc2012'
 
-    for d in ( 'images', 'labels', 'labels-wo-difficult', 'lists' ):
-        if not os.path.exists(os.path.join(OUT_dir, d)):
-            os.makedirs(os.path.join(OUT_dir, d), exist_ok=True)
-    if not os.path.exists(os.path.join(OUT_dir, 'images', NAME)):
-        os.symlink(os.path.join(VOC_dir, 'JPEGImages'), os.path.join(OUT_dir, 'images', NAME))
+    for _, OUT_dir in targets:
+        for d in ( 'images', 'labels', 'labels-wo-difficult', 'lists' ):
+            if not os.path.exists(os.path.join(OUT_dir, d)):
+                os.makedirs(os.path.join(OUT_dir, d), exist_ok=True)
+        if not os.path.exists(os.path.join(OUT_dir, 'images', NAME)):
+            os.symlink(os.path.join(VOC_dir, 'JPEGImages'), os.path.join(OUT_dir, 'images', NAME))
 
     # create labels and lists
-    with open(os.path.join(OUT_dir, 'lists', NAME + '.txt'), 'w') if use_mapping else contextlib.nullcontext() as fom:
+    with contextlib.ExitStack() as stack:
+        fom = [ stack.enter_context(manifest.open_atomic(os.path.join(OUT_dir, 'lists', NAME + '.txt'), sink.buffer_size))
+                for _, OUT_dir in targets ] if use_mapping else None
+        writers = [ stack.enter_context(labelstore.Writer(( os.path.join(OUT_dir, 'labels', NAME),
+                                                            os.path.join(OUT_dir, 'labels-wo-difficult', NAME), ), resume))
+                    if packed else None for _, OUT_dir in targets ]
+        items = [ stack.enter_context(manifest.Manifest(os.path.join(OUT_dir, 'cache', 'manifest-' + NAME + '.sqlite'), labels.fingerprint(), resume,
+                                                        writer.exists if writer else None))
+                  for ( labels, OUT_dir ), writer in zip(targets, writers) ]
+        # the images are the same for all the targets.
+        OUT_dir = targets[0][1]
+        images = stack.enter_context(ImageIndex(os.path.join(OUT_dir, 'images', NAME), os.path.join(OUT_dir, 'cache', 'images-' + NAME + '.pickle')))
+        # the workers drop the metrics inherited by fork.
+        pool = stack.enter_context(multiprocessing.Pool(args.jobs, metrics.init_worker, ( metrics.enabled(), )) if 1 < args.jobs else contextlib.nullcontext())
+        progress = sink.Progress(NAME)
         for split, file in files.items():
-            with open(file, 'r') as fi, \
-              contextlib.nullcontext() if use_mapping else open(os.path.join(OUT_dir, 'lists', split + '.txt'), 'w') as fos:
-                fo = fom if use_mapping else fos
-                prev_yolo_dir = ''
+            with open(file, 'r') as fi, contextlib.ExitStack() as split_stack:
+                fo = fom if use_mapping else [ split_stack.enter_context(manifest.open_atomic(os.path.join(OUT_dir, 'lists', split + '.txt'), sink.buffer_size))
+                                               for _, OUT_dir in targets ]
+                keys = []
+                ids = []
                 for line in fi:
                     id_ = line.split()
                     if not id_ or (2 <= len(id_) and int(id_[1]) < 1): continue
-                    id_ = id_[0]
-                    xml               = os.path.join(VOC_dir, 'Annotations',               id_ + '.xml')
-                    yolo              = os.path.join(OUT_dir, 'labels',              NAME, id_ + '.txt')
-                    yolo_wo_difficult = os.path.join(OUT_dir, 'labels-wo-difficult', NAME, id_ + '.txt')
-                    img_stem = os.path.join('images', NAME, id_)
-                    img = None
-                    for ext in ('.jpg', '.png', '.jpeg', '.JPEG'):
-                        if os.path.isfile(os.path.join(OUT_dir, img_stem + ext)):
-                            img = img_stem + ext
-                            break
-                    if not img: raise FileNotFoundError(img_stem)
-                    img = pathlib.PurePath(img).as_posix()
-                    if xml2yolo(xml, yolo, yolo_wo_difficult):
-                        fo.write('{}\n'.format(img))
-                        cur_yolo_dir = os.path.dirname(yolo)
-                        if prev_yolo_dir != cur_yolo_dir:
-                            prev_yolo_dir = cur_yolo_dir
-                            print('{} -> {}'.format(xml, yolo))
-                    else:
-                        assert use_mapping
-
-    print('')
+                    keys.append(id_[0])
+                    # only the queries of the manifests here: the xml is stat'ed by read_item().
+                    ids.append(( VOC_dir, NAME, id_[0], find_image(images, NAME, id_[0]), [ it.recorded(id_[0]) for it in items ] ))
+                shards = [ ids[i:i + shard_size] for i in range(0, len(ids), shard_size) ]
+                key_shards = [ keys[i:i + shard_size] for i in range(0, len(keys), shard_size) ]
+                prev_yolo_dir = [ '' ] * len(targets)
+                # imap() keeps the order of the list file.
+                for shard_keys, ( results, stats, taken ) in zip(key_shards, pool.imap(convert_shard, shards) if pool else map(convert_shard, shards)):
+                    merge_stats(stats)
+                    metrics.merge(taken)
+                    for key, ( xml, results_targets ) in zip(shard_keys, results):
+                        progress.update(key)
+                        for t, ( checked, img, outputs, stamp, labels ) in enumerate(results_targets):
+                            yolo = outputs[0]
+                            if checked:
+                                items[t].up_to_date(key, checked)
+                            if labels:
+                                write_labels(writers[t], yolo, *labels)
+                            if stamp:
+                                items[t].record(key, stamp, outputs if img else None, img)
+                            if not img: continue
+                            fo[t].write('{}\n'.format(img))
+                            metrics.count('images')
+                            cur_yolo_dir = os.path.dirname(yolo)
+                            if prev_yolo_dir[t] != cur_yolo_dir:
+                                prev_yolo_dir[t] = cur_yolo_dir
+                                print('{} -> {}'.format(xml, yolo))
+        progress.done()
+
+    for it, ( _, OUT_dir ) in zip(items, targets):
+        print('up to date: {}: {}'.format(OUT_dir, it.n_up_to_date))
     print('max width : {}'.format(_max_w))
     print('max height: {}'.format(_max_h))
     print('max width  / height    : {:f}'.format(_max_w_h))
@@ -202,7 +345,8 @@ def main():
     print('max ymax   / (height-1): {:f}'.format(_max_y_h))
     print('have difficult: {}'.format(_have_difficult))
     if not _have_difficult:
-        print('remove redundant directory manually: {}'.format(os.path.join(OUT_dir, 'labels-wo-difficult')))
+        for _, OUT_dir in targets:
+            print('remove redundant directory manually: {}'.format(os.path.join(OUT_dir, 'labels-wo-difficult')))
     if not use_mapping:
         print('to create trainval: cat lists/train.txt lists/val.txt >lists/trainval.txt')
 
@@ -220,6 +364,11 @@ def main():
 # =============================================================================
 
 if __name__=='__main__':
-    main()
+    parser = argparse.ArgumentParser(description='convert VOC annotations to yolo.')
+    parser.add_argument('--jobs', '-j', default=1, type=int, help='number of worker processes.')
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    with metrics.session(args.metrics):
+        main(args)
 
 # end of file
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2019 Abacus Technologies, Inc.
+# Copyright (c) 2019 Fumiyuki Shimizu
+# MIT License: https://opensource.org/licenses/MIT
+
+# PASCAL VOC style annotation (VOC, ILSVRC) parser.
+# the whole file is read at once and the tree is walked once.
+# for files of a few KB, this is faster than iterparse() or lxml.
+
+import argparse
+import timeit
+from xml.etree import ElementTree as ET
+
+_BNDBOX = ( 'xmin', 'ymin', 'xmax', 'ymax', )
+
+def _parse_object(tree_obj):
+    name = None
+    difficult = None
+    bbox = None
+    # direct children only: <part> of VOC has its own name and bndbox.
+    for child in tree_obj:
+        tag = child.tag
+        if tag == 'name':
+            name = child.text
+        elif tag == 'difficult':
+            difficult = int(child.text.strip())
+        elif tag == 'bndbox':
+            vals = {}
+            for k in child:
+                vals[k.tag] = k.text
+            try:
+                bbox = tuple(float(vals[k].strip()) for k in _BNDBOX)
+            except KeyError as e:
+                raise ValueError('bndbox without {}'.format(e)) from None
+    return name, difficult, bbox
+
+# xml file or its content -> ( height, width, names, difficults, bboxes )
+#   difficults: int, None if not given.
+#   bboxes: VOC style ( xmin, ymin, xmax, ymax ) to be given to BBoxArray.
+def parse(xml):
+    if isinstance(xml, (bytes, bytearray)):
+        root = ET.fromstring(xml)
+    else:
+        with open(xml, 'rb') as f:
+            root = ET.fromstring(f.read())
+    h = w = None
+    names = []
+    difficults = []
+    bboxes = []
+    for elem in root:
+        if elem.tag == 'object':
+            name, difficult, bbox = _parse_object(elem)
+            names.append(name)
+            difficults.append(difficult)
+            bboxes.append(bbox)
+        elif elem.tag == 'size':
+            for child in elem:
+                if child.tag == 'width':
+                    w = float(child.text)
+                elif child.tag == 'height':
+                    h = float(child.text)
+    if h is None or w is None:
+        raise ValueError('No size: {}'.format(xml if isinstance(xml, str) else root.findtext('filename')))
+    return h, w, names, difficults, bboxes
+
+# ElementTree DOM, as xml2yolo did. for the benchmark.
+def parse_dom(xml):
+    xml = ET.parse(xml)
+    tree_size = xml.find('size')
+    w = float(tree_size.find('width').text)
+    h = float(tree_size.find('height').text)
+    names = []
+    difficults = []
+    bboxes = []
+    for tree_obj in xml.findall('object'):
+        names.append(tree_obj.find('name').text)
+        difficults.append(int(tree_obj.find('difficult').text.strip()))
+        tree_bbox = tree_obj.find('bndbox')
+        bboxes.append(tuple(map(lambda k: float(tree_bbox.find(k).text.strip()), _BNDBOX)))
+    return h, w, names, difficults, bboxes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro-benchmark of the annotation parsers.')
+    parser.add_argument('--repeat', '-n', default=5, type=int)
+    parser.add_argument('xml', nargs='+')
+    args = parser.parse_args()
+
+    for xml in args.xml:
+        assert parse(xml) == parse_dom(xml), xml
+    for func in ( parse_dom, parse, ):
+        sec = min(timeit.repeat(lambda: [ func(xml) for xml in args.xml ], number=1, repeat=args.repeat))
+        print('{:10s}: {:f} sec, {:f} msec/file'.format(func.__name__, sec, 1000 * sec / len(args.xml)))
+
+# end of file
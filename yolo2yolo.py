@@ -6,12 +6,21 @@
 # MIT License: https://opensource.org/licenses/MIT
 
 import os
+import io
 import pathlib
 import glob
+import argparse
+from imageindex import ImageIndex
+import manifest
+import sink
+import metrics
 # mapping only. yolo -> yolo
 use_mapping=True
-from label_chihuahua import ChihuahuaGLabelNames as GLabelNames
-resume=False
+from label_chihuahua import ChihuahuaGLabelNames
+# skip the items which the manifest says are up to date. False to convert all again.
+resume=True
+# label files written by background I/O threads of sink.py, 0 to write them in the main thread.
+io_threads=1
 
 def main():
     #####
@@ -19,7 +28,7 @@ def main():
     YOLO_images_dir = '/data/huge/AI/G/images'
     YOLO_labels_dir = '/data/huge/AI/G/labels'
     YOLO_classes_txt = '/data/huge/AI/G/labels/classes.txt'
-    GLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', YOLO_classes_txt)
+    GLabelNames = ChihuahuaGLabelNames.init('/data/work/dog/00input-chihuahua/chihuahua.txt', YOLO_classes_txt)
     assert 'G' in GLabelNames.label_names()
     assert 0 == GLabelNames.label_index_src('G')
     assert 2 == GLabelNames.label_index_dst('G')
@@ -40,13 +49,29 @@ def main():
     os.makedirs(os.path.join(OUT_dir, 'labels', NAME), exist_ok=True)
 
     # create labels and lists
-    with open(os.path.join(OUT_dir, 'lists', NAME + '.txt'), 'w') as flist:
+    with sink.Sink(io_threads) as out, \
+      manifest.open_atomic(os.path.join(OUT_dir, 'lists', NAME + '.txt'), sink.buffer_size) as flist, \
+      manifest.Manifest(os.path.join(OUT_dir, 'cache', 'manifest-' + NAME + '.sqlite'), GLabelNames.fingerprint(), resume,
+                        before_commit=out.flush) as items, \
+      ImageIndex(os.path.join(OUT_dir, 'images', NAME), os.path.join(OUT_dir, 'cache', 'images-' + NAME + '.pickle')) as images:
+        progress = sink.Progress(NAME)
         for bbox_in in glob.glob(pathlib.PurePath(os.path.join(YOLO_labels_dir, '*.txt')).as_posix(), recursive=False):
             if os.path.samefile(bbox_in, YOLO_classes_txt): continue
+            rel = os.path.relpath(bbox_in, start=YOLO_labels_dir)
+            progress.update(rel)
+            done = items.lookup(rel, bbox_in)
+            if done is not None:
+                flist.write('{}\n'.format(done))
+                metrics.count('images')
+                continue
+            # read once: stamped and mapped from the same bytes.
+            with metrics.timer('read'), open(bbox_in, 'rb') as fbbox_in:
+                data = fbbox_in.read()
+                stamp = manifest.stamp(bbox_in, data)
             lines = []
             #use_for_negative = False
-            with open(bbox_in, 'r', newline='\n') as fbbox_in:
-                for line in fbbox_in:
+            with metrics.timer('map'):
+                for line in io.StringIO(data.decode(), newline='\n'):
                     try:
                         id_, bbox = line.split(maxsplit=1)
                     except ValueError:
@@ -55,6 +80,7 @@ def main():
                     try:
                         id_ = GLabelNames.label_index(int(id_))
                     except ValueError:
+                        metrics.count('discarded')
                         continue
                     if isinstance(id_, (tuple, list)):
                         for i in id_:
@@ -64,26 +90,24 @@ def main():
                     #else:
                     #    use_for_negative = True
             #if use_for_negative or lines:
-            rel = os.path.relpath(bbox_in, start=YOLO_labels_dir)
-            img_stem = os.path.join('images', NAME, rel[:-4])
-            img = None
-            for ext in ('.jpg', '.png', '.jpeg', ):
-                for ex in ( ext, ext.upper() ):
-                    if os.path.isfile(os.path.join(OUT_dir, img_stem + ex)):
-                        img = img_stem + ex
-                        break
-            if not img: raise FileNotFoundError(img_stem)
-            img = pathlib.PurePath(img).as_posix()
+            img = images.find(rel[:-4], ('.jpg', '.JPG', '.png', '.PNG', '.jpeg', '.JPEG', ))
+            if not img: raise FileNotFoundError(os.path.join('images', NAME, rel[:-4]))
+            img = pathlib.PurePath(os.path.join('images', NAME, img)).as_posix()
             bbox_out = os.path.join(OUT_dir, 'labels', NAME, rel)
-            print('write {}'.format(bbox_out))
-            with open(bbox_out, 'w') as fbbox_out:
-                for line in lines:
-                    fbbox_out.write(line)
+            out.write(bbox_out, lines)
+            metrics.count('boxes', len(lines))
             flist.write('{}\n'.format(img))
+            metrics.count('images')
+            items.record(rel, stamp, bbox_out, img)
             #else:
             #    print('skip {}'.format(os.path.basename(bbox_in)))
+        progress.done()
 
 if __name__=='__main__':
-    main()
+    parser = argparse.ArgumentParser(description='map the labels of yolo to my own dataset.')
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    with metrics.session(args.metrics):
+        main()
 
 # end of file
@@ -12,6 +12,8 @@ import glob
 import pathlib
 import math
 import argparse
+import summary
+import metrics
 from bbox import BBox
 if True:
     from label_default import ILSVRCLabelNames as LabelNames
@@ -25,15 +27,20 @@ def main(args):
     global _min_x_w, _min_y_h, _max_x_w, _max_y_h
     global _max_w, _max_h, _max_w_h, _max_h_w
 
-    LabelNames.init(predefined_labels)
+    labels = LabelNames.init(predefined_labels)
 
-    args.results_dir
-    args.summary_dir
-
-    os.makedirs(args.summary_dir, exist_ok=True)
-    for f in glob.glob(pathlib.PurePath(args.summary_dir).as_posix() + '/*.csv'):
-        os.remove(f)
-    for label in LabelNames.label_names():
+    assert args.summary_dir or args.consolidated, 'Neither --summary-dir nor --consolidated is given.'
+    if args.summary_dir:
+        os.makedirs(args.summary_dir, exist_ok=True)
+        for f in glob.glob(pathlib.PurePath(args.summary_dir).as_posix() + '/*.csv'):
+            os.remove(f)
+        tmp_dir = args.summary_dir
+    else:
+        tmp_dir = os.path.dirname(args.consolidated) or '.'
+        os.makedirs(tmp_dir, exist_ok=True)
+    # every summary is written once, after all the results are read.
+    grouper = summary.Grouper(args.memory_budget * 1024 * 1024, tmp_dir=tmp_dir)
+    for label in labels.label_names():
         print('Label: {}'.format(label))
         pred = None
         is_first = True
@@ -45,19 +52,30 @@ def main(args):
             print('Skipping label: {}'.format(label))
             continue
         print('Reading: {}'.format(pred))
-        with open(pred, 'r') as fpred:
+        n = 0
+        with metrics.timer('read'), open(pred, 'r') as fpred:
             for line in fpred:
                 id_, *flts = line.split()
                 # confidence, VOC style values: 1<->width, 1<->height, 1<->width, 1<->height
                 flts = tuple(map(float, flts))
-                with open(os.path.join(args.summary_dir, id_ + '.csv'), 'a') as fsummary:
-                    fsummary.write('{:1.15f},{:1.15f},{:1.15f},{:1.15f},{:1.15f},{}\n'.format(*flts,label))
+                grouper.add(id_, summary.format_row(flts, label))
+                n += 1
+        metrics.count('rows', n)
+    print('Writing summaries.')
+    with metrics.timer('write'), summary.Writer(args.summary_dir, args.consolidated) as writer:
+        for id_, rows in grouper.groups():
+            writer.write(id_, rows)
+            metrics.count('summaries')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='summarize validation results produced by darknet.')
     parser.add_argument('--results-dir', '-r', default='results')
-    parser.add_argument('--summary-dir', '-s', required=True, help='output directory. *** existing files will be deleted.')
+    parser.add_argument('--summary-dir', '-s', help='output directory. *** existing files will be deleted.')
+    parser.add_argument('--consolidated', '-o', help='output file: all the summaries sorted by id, with its .index.')
+    parser.add_argument('--memory-budget', '-m', default=1024, type=int, help='MB of rows held in memory before spilling to disk.')
+    metrics.add_argument(parser)
     args = parser.parse_args() 
-    main(args)
+    with metrics.session(args.metrics):
+        main(args)
 
 # end of file
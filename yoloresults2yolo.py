@@ -11,8 +11,11 @@ import os
 import glob
 import pathlib
 import math
-import cv2
-from bbox import BBox
+import argparse
+import metrics
+from bbox import BBox, BBoxArray
+from imageindex import ImageIndex
+from imagesize import ImageSize
 from label_chihuahua import ChihuahuaLabelNames as LabelNames
 
 # darknet/src/utils.c
@@ -28,22 +31,23 @@ _max_h = 0
 _max_w_h = 0
 _max_h_w = 0
 
-def write_label(img_dir, img_id, label, bboxes):
+def write_label(images, sizes, rel_dir, img_id, label, bboxes):
     global _min_x_w, _min_y_h, _max_x_w, _max_y_h
     global _max_w, _max_h, _max_w_h, _max_h_w
+    img_dir = os.path.join(images.root, rel_dir)
     img = None
-    for f in glob.glob(os.path.join(img_dir, img_id + '.*')):
+    for f in images.find_all(os.path.join(rel_dir, img_id)):
         if f.endswith('.txt'):
             continue
+        f = os.path.join(img_dir, f)
         if img:
             raise FileExistsError('{} and\n{}'.format(img, f))
         img = f
-    if img:
-        img = cv2.imread(f)
     if img is None:
         raise FileNotFoundError(os.path.join(img_dir, img_id))
 
-    h, w = img.shape[:2]
+    with metrics.timer('read'):
+        h, w = sizes.get(img)
     if _max_w < w:
         _max_w = w
         print('New max width: {}'.format(w))
@@ -61,23 +65,25 @@ def write_label(img_dir, img_id, label, bboxes):
             _max_h_w = h_w
             print('New height / width: {}'.format(h_w))
 
-    with open(find_replace(os.path.join(img_dir, img_id + '.txt.' + label), 'images', 'labels'), 'w') as flabel:
-        for bbox_tuple in bboxes:
-            bbox = BBox(hw=(h, w), type_=BBox.VOC, bbox=bbox_tuple)
-            xmin, ymin, xmax, ymax = bbox.get(type_=BBox.OPEN_IMAGES)
-            if _min_x_w > xmin:
-                _min_x_w = xmin
-                print('New min xmin / (width-1): {}'.format(_min_x_w))
-            if _min_y_h > ymin:
-                _min_y_h = ymin
-                print('New min ymin / (height-1): {}'.format(_min_y_h))
-            if _max_x_w < xmax:
-                _max_x_w = xmax
-                print('New max xmax / (width-1): {}'.format(_max_x_w))
-            if _max_y_h < ymax:
-                _max_y_h = ymax
-                print('New max ymax / (height-1): {}'.format(_max_y_h))
-            flabel.write('{:1.15f} {:1.15f} {:1.15f} {:1.15f}\n'.format(*bbox.get(type_=BBox.YOLO)))
+    with metrics.timer('write'), open(find_replace(os.path.join(img_dir, img_id + '.txt.' + label), 'images', 'labels'), 'w') as flabel:
+        bboxes = BBoxArray(hw=(h, w), type_=BBox.VOC, bbox=bboxes)
+        xmin, ymin, xmax, ymax = bboxes.get(type_=BBox.OPEN_IMAGES).T
+        if _min_x_w > xmin.min():
+            _min_x_w = xmin.min().item()
+            print('New min xmin / (width-1): {}'.format(_min_x_w))
+        if _min_y_h > ymin.min():
+            _min_y_h = ymin.min().item()
+            print('New min ymin / (height-1): {}'.format(_min_y_h))
+        if _max_x_w < xmax.max():
+            _max_x_w = xmax.max().item()
+            print('New max xmax / (width-1): {}'.format(_max_x_w))
+        if _max_y_h < ymax.max():
+            _max_y_h = ymax.max().item()
+            print('New max ymax / (height-1): {}'.format(_max_y_h))
+        for yolo in bboxes.get(type_=BBox.YOLO).tolist():
+            flabel.write('{:1.15f} {:1.15f} {:1.15f} {:1.15f}\n'.format(*yolo))
+    metrics.count('boxes', len(bboxes))
+    metrics.count('images')
 
 def main():
     global _min_x_w, _min_y_h, _max_x_w, _max_y_h
@@ -91,9 +97,11 @@ def main():
     images_dir = 'images.test'
     # output
     labels_dir = find_replace(images_dir, 'images', 'labels')
-    LabelNames.init(predefined_labels)
+    labels = LabelNames.init(predefined_labels)
     labelImgNotice = []
-    for label in LabelNames.label_names():
+    images = ImageIndex(images_dir, os.path.join('cache', 'images-' + os.path.basename(images_dir) + '.pickle'))
+    sizes = ImageSize(os.path.join('cache', 'sizes-' + os.path.basename(images_dir) + '.pickle'))
+    for label in labels.label_names():
         print('Label {}'.format(label))
         for pred in glob.glob(pathlib.PurePath(results_dir).as_posix() + '/**/comp4_det_test_' + label + '.txt', recursive=True):
             bboxes = []
@@ -103,7 +111,7 @@ def main():
             lbl_dir = os.path.join(labels_dir, rel_dir)
             os.makedirs(lbl_dir, exist_ok=True)
             cls_file = os.path.join(lbl_dir, 'classes.txt')
-            LabelNames.save(cls_file)
+            labels.save(cls_file)
             labelImgNotice.append('python3 /opt/labelImg/labelImg.py {} {} {}'.format(
                 pathlib.PurePath(img_dir).as_posix(),
                 pathlib.PurePath(cls_file).as_posix(),
@@ -113,11 +121,11 @@ def main():
                 pathlib.PurePath(cls_file).as_posix()))
             print('Reading: {}'.format(pred))
             with open(pred, 'r') as fpred:
-                for line in fpred:
+                for line in metrics.timed('read', fpred):
                     id_, *flts = line.split()
                     if bboxes and id_ != bboxes_id:
                         print(',{}'.format(bboxes_id), end='', flush=True)
-                        write_label(img_dir, bboxes_id, label, bboxes)
+                        write_label(images, sizes, rel_dir, bboxes_id, label, bboxes)
                         bboxes = []
                     bboxes_id = id_
                     prec, *bbox_tuple = tuple(map(float, flts))
@@ -125,7 +133,9 @@ def main():
                         bboxes.append(bbox_tuple)
                 if bboxes:
                     print(',{}'.format(bboxes_id), end='', flush=True)
-                    write_label(img_dir, bboxes_id, label, bboxes)
+                    write_label(images, sizes, rel_dir, bboxes_id, label, bboxes)
+    images.save()
+    sizes.save()
 
     for file in glob.glob(pathlib.PurePath(labels_dir).as_posix() + '/**/*.txt.*', recursive=True):
         lbl_dir = os.path.dirname(file)
@@ -134,16 +144,17 @@ def main():
             raise FileExistsError('Possible cause of some mistakes: {}'.format(lbl_file))
         if os.path.isfile(lbl_file) and os.path.getmtime(lbl_file) - os.path.getmtime(file) > 0:
             continue
-        with open(lbl_file, 'w', newline='\n') as flbl:
+        with metrics.timer('merge'), open(lbl_file, 'w', newline='\n') as flbl:
             for filex in glob.glob(pathlib.PurePath(lbl_file).as_posix() + '.*'):
                 ext = pathlib.PurePath(filex).suffix[1:]
-                if ext not in LabelNames.label_names():
+                if ext not in labels.label_names():
                     raise ValueError('Unknown label: {}, {}'.format(ext, lbl_file))
-                lbl =  LabelNames.label_index(ext)
+                lbl =  labels.label_index(ext)
                 assert 0 <= lbl, '{}: {}'.format(ext, lbl)
                 with open(filex, 'r', newline='\n') as f:
                     for line in f:
                         flbl.write('{} {}'.format(lbl, line))
+        metrics.count('merged')
         print(',{}'.format(lbl_file), end='', flush=True)
 
     print('')
@@ -161,6 +172,10 @@ def main():
             print(line)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='convert validation results of yolo to annotations of yolo.')
+    metrics.add_argument(parser)
+    args = parser.parse_args()
+    with metrics.session(args.metrics):
+        main()
 
 # end of file